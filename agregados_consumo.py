@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Agregados de consumo (rollups) para EnerVirgil
+
+Mantiene la tabla consumption_rollups con el consumo sumado por usuario y
+por dispositivo a nivel de hora, día y mes (hora local de Lima). El escritor
+de consumo la actualiza en la misma transacción en que inserta las muestras,
+de modo que los gráficos y estadísticas leen unas pocas filas ya agregadas
+en lugar de recorrer meses de muestras.
+
+Uso como comando (reconstruye los agregados a partir de la tabla consumption):
+    python agregados_consumo.py --recalcular              # solo el rango con muestras crudas
+    python agregados_consumo.py --recalcular --completo   # todo (borra el historial ya retenido)
+
+Tras la retención (retencion_consumo.py) las muestras crudas antiguas ya no
+existen y los agregados son el único registro de ese consumo: por defecto se
+reconstruyen solo los buckets completos a partir de la muestra más antigua
+que queda, y los anteriores se conservan tal cual.
+"""
+
+import sys
+import time
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+
+LIMA_TZ = pytz.timezone('America/Lima')
+
+# Formato del bucket de cada granularidad (también sirve de etiqueta en los gráficos)
+FORMATOS_BUCKET = {
+    'hour': '%Y-%m-%d %H',
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+}
+
+# Lima no tiene horario de verano: UTC-5 fijo, válido también dentro de SQLite
+DESFASE_LIMA_SQL = '-5 hours'
+
+SQL_CREAR_TABLA = '''CREATE TABLE IF NOT EXISTS consumption_rollups
+                     (scope TEXT NOT NULL,
+                      scope_id INTEGER NOT NULL,
+                      granularity TEXT NOT NULL,
+                      bucket TEXT NOT NULL,
+                      total_kwh REAL NOT NULL DEFAULT 0,
+                      samples INTEGER NOT NULL DEFAULT 0,
+                      PRIMARY KEY (scope, scope_id, granularity, bucket)) WITHOUT ROWID'''
+
+SQL_ACUMULAR = '''INSERT INTO consumption_rollups (scope, scope_id, granularity, bucket, total_kwh, samples)
+                  VALUES (?, ?, ?, ?, ?, ?)
+                  ON CONFLICT(scope, scope_id, granularity, bucket) DO UPDATE SET
+                      total_kwh = total_kwh + excluded.total_kwh,
+                      samples = samples + excluded.samples'''
+
+# Los timestamps de consumption son segundos epoch (INTEGER, UTC).
+# Toda conversión entre datetime y la columna ts pasa por estas dos funciones.
+
+def a_epoch(momento):
+    """Convierte un datetime a segundos epoch (naive = hora de Lima)"""
+    if momento.tzinfo is None:
+        momento = LIMA_TZ.localize(momento)
+    return int(momento.timestamp())
+
+def desde_epoch(ts):
+    """Convierte segundos epoch a un datetime en hora de Lima"""
+    return datetime.fromtimestamp(ts, LIMA_TZ)
+
+def acumular(muestras):
+    """
+    Agrupa muestras (user_id, device_id, consumption_kwh, ts) por ámbito
+    y bucket. Devuelve filas listas para SQL_ACUMULAR.
+    """
+    acumulado = {}
+    for user_id, device_id, consumption_kwh, ts in muestras:
+        local = desde_epoch(ts)
+        for granularidad, formato in FORMATOS_BUCKET.items():
+            bucket = local.strftime(formato)
+            for ambito, ambito_id in (('user', user_id), ('device', device_id)):
+                if ambito_id is None:
+                    continue
+                clave = (ambito, ambito_id, granularidad, bucket)
+                total, cantidad = acumulado.get(clave, (0.0, 0))
+                acumulado[clave] = (total + (consumption_kwh or 0.0), cantidad + 1)
+    return [clave + valores for clave, valores in acumulado.items()]
+
+def actualizar_agregados(conn, muestras):
+    """Suma un lote de muestras a los agregados (dentro de la transacción del llamador)"""
+    conn.executemany(SQL_ACUMULAR, acumular(muestras))
+
+def leer_agregados(conn, ambito, ambito_id, granularidad, desde, hasta):
+    """Devuelve {bucket: total_kwh} para los buckets entre desde y hasta (inclusive)"""
+    c = conn.cursor()
+    c.execute("""SELECT bucket, total_kwh FROM consumption_rollups
+                 WHERE scope = ? AND scope_id = ? AND granularity = ? AND bucket BETWEEN ? AND ?""",
+              (ambito, ambito_id, granularidad, desde, hasta))
+    return dict(c.fetchall())
+
+def _inicio_de_bucket(momento, bucket):
+    """Trunca un datetime de Lima al inicio de su bucket"""
+    if bucket == 'hour':
+        return momento.replace(minute=0, second=0, microsecond=0)
+    if bucket == 'month':
+        return momento.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return momento.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _siguiente_bucket(momento, bucket):
+    if bucket == 'hour':
+        return LIMA_TZ.normalize(momento + timedelta(hours=1))
+    if bucket == 'day':
+        return LIMA_TZ.normalize(momento + timedelta(days=1))
+    if bucket == 'week':
+        return LIMA_TZ.normalize(momento + timedelta(days=7))
+    anio, mes = (momento.year, momento.month + 1) if momento.month < 12 else (momento.year + 1, 1)
+    return momento.replace(year=anio, month=mes)
+
+def serie_consumo(conn, ambito, ambito_id, inicio, fin, bucket, tz=LIMA_TZ):
+    """
+    Serie de consumo de un usuario o dispositivo en [inicio, fin).
+
+    ambito: 'user' o 'device'
+    bucket: 'hour', 'day', 'week', 'month' o un número de segundos
+    inicio, fin: datetimes (naive = hora de `tz`)
+
+    Hace una sola consulta: las granularidades con agregado leen
+    consumption_rollups, 'week' agrupa días de 7 en 7 alineados a `fin`,
+    y un bucket en segundos recorre una vez las muestras del rango.
+    Devuelve {'labels': [...], 'data': [...]}.
+    """
+    inicio = tz.localize(inicio) if inicio.tzinfo is None else inicio.astimezone(tz)
+    fin = tz.localize(fin) if fin.tzinfo is None else fin.astimezone(tz)
+
+    if isinstance(bucket, (int, float)):
+        return _serie_muestras(conn, ambito, ambito_id, inicio, fin, bucket)
+
+    if bucket == 'week':
+        # Bloques de 7 días que terminan en el día de `fin`
+        ultimo = _inicio_de_bucket(fin - timedelta(microseconds=1), 'day')
+        semanas = max(1, -(-(fin - inicio).days // 7))
+        inicios = [LIMA_TZ.normalize(ultimo - timedelta(days=7 * i + 6)) for i in range(semanas - 1, -1, -1)]
+        por_dia = leer_agregados(conn, ambito, ambito_id, 'day',
+                                 inicios[0].strftime(FORMATOS_BUCKET['day']), ultimo.strftime(FORMATOS_BUCKET['day']))
+        totales = [0.0] * len(inicios)
+        for dia, total in por_dia.items():
+            indice = (datetime.strptime(dia, FORMATOS_BUCKET['day']).date() - inicios[0].date()).days // 7
+            if 0 <= indice < len(totales):
+                totales[indice] += total
+        return {'labels': [i.strftime(FORMATOS_BUCKET['day']) for i in inicios],
+                'data': [round(t, 2) for t in totales]}
+
+    formato = FORMATOS_BUCKET[bucket]
+    etiquetas = []
+    actual = _inicio_de_bucket(inicio, bucket)
+    while actual < fin:
+        etiquetas.append(actual.strftime(formato))
+        actual = _siguiente_bucket(actual, bucket)
+    if not etiquetas:
+        return {'labels': [], 'data': []}
+    totales = leer_agregados(conn, ambito, ambito_id, bucket, etiquetas[0], etiquetas[-1])
+    return {'labels': etiquetas, 'data': [round(totales.get(e, 0), 2) for e in etiquetas]}
+
+def _serie_muestras(conn, ambito, ambito_id, inicio, fin, segundos):
+    """Serie con buckets de `segundos`, en una sola pasada sobre la tabla consumption"""
+    columna = 'user_id' if ambito == 'user' else 'device_id'
+    cantidad = max(1, int(-(-(fin - inicio).total_seconds() // segundos)))
+    totales = [0.0] * cantidad
+    desde, hasta = a_epoch(inicio), a_epoch(fin)
+    c = conn.cursor()
+    c.execute(f"""SELECT ts, consumption_kwh FROM consumption
+                  WHERE {columna} = ? AND ts >= ? AND ts < ?""",
+              (ambito_id, desde, hasta))
+    for ts, consumption_kwh in c:
+        indice = int((ts - desde) // segundos)
+        if 0 <= indice < cantidad:
+            totales[indice] += consumption_kwh or 0.0
+    etiquetas = [(inicio + timedelta(seconds=segundos * i)).strftime('%Y-%m-%d %H:%M') for i in range(cantidad)]
+    return {'labels': etiquetas, 'data': [round(t, 2) for t in totales]}
+
+def limites_retenidos(conn):
+    """
+    Inicio (hora de Lima) del primer bucket completo de cada granularidad
+    dentro de las muestras crudas que quedan, o None si no queda ninguna.
+    El bucket que contiene la muestra más antigua puede haber perdido parte
+    de sus muestras en la retención, por eso se empieza en el siguiente.
+    """
+    ts = conn.execute("SELECT MIN(ts) FROM consumption").fetchone()[0]
+    if ts is None:
+        return None
+    primera = desde_epoch(ts)
+    limites = {}
+    for granularidad in FORMATOS_BUCKET:
+        inicio = _inicio_de_bucket(primera, granularidad)
+        limites[granularidad] = inicio if inicio == primera else _siguiente_bucket(inicio, granularidad)
+    return limites
+
+def recalcular_agregados(conn, completo=False, usuarios=None):
+    """
+    Reconstruye los agregados a partir de la tabla consumption. Devuelve
+    cuántas filas de agregados escribió.
+
+    Por defecto solo los buckets desde limites_retenidos(): los anteriores
+    ya no tienen muestras crudas y se conservan.
+    completo: reconstruye todo el historial (solo si nunca corrió la retención)
+    usuarios: range de ids de usuario cuyas muestras están todas en consumption
+              (p. ej. recién generados); se reconstruyen por completo solo sus
+              agregados y los de sus dispositivos
+    """
+    c = conn.cursor()
+    if usuarios is not None:
+        limites = dict.fromkeys(FORMATOS_BUCKET)
+        primero, ultimo = usuarios.start, usuarios.stop - 1
+        filtro = """(scope = 'user' AND scope_id BETWEEN ? AND ?
+                     OR scope = 'device' AND scope_id IN (SELECT id FROM devices WHERE user_id BETWEEN ? AND ?))"""
+        parametros_filtro = (primero, ultimo, primero, ultimo)
+        filtro_muestras, parametros_muestras = "user_id BETWEEN ? AND ?", (primero, ultimo)
+    else:
+        limites = dict.fromkeys(FORMATOS_BUCKET) if completo else limites_retenidos(conn)
+        if limites is None:
+            return 0
+        filtro, parametros_filtro = "1", ()
+        filtro_muestras, parametros_muestras = "1", ()
+
+    def desde(granularidad):
+        limite = limites[granularidad]
+        return limite.strftime(FORMATOS_BUCKET[granularidad]) if limite is not None else ''
+
+    for granularidad in FORMATOS_BUCKET:
+        c.execute(f"DELETE FROM consumption_rollups WHERE granularity = ? AND bucket >= ? AND {filtro}",
+                  (granularidad, desde(granularidad)) + parametros_filtro)
+
+    escritas = 0
+    ts_desde = a_epoch(limites['hour']) if limites['hour'] is not None else 0
+    expresion_hora = f"strftime('%Y-%m-%d %H', ts, 'unixepoch', '{DESFASE_LIMA_SQL}')"
+    for ambito, columna in (('user', 'user_id'), ('device', 'device_id')):
+        c.execute(f"""INSERT INTO consumption_rollups (scope, scope_id, granularity, bucket, total_kwh, samples)
+                      SELECT '{ambito}', {columna}, 'hour', {expresion_hora}, SUM(consumption_kwh), COUNT(*)
+                      FROM consumption
+                      WHERE {columna} IS NOT NULL AND ts >= ? AND {filtro_muestras}
+                      GROUP BY {columna}, {expresion_hora}""", (ts_desde,) + parametros_muestras)
+        escritas += c.rowcount
+    # Días y meses se derivan de las horas (y días) ya agregadas del mismo rango
+    for granularidad, origen, longitud in (('day', 'hour', 10), ('month', 'day', 7)):
+        c.execute(f"""INSERT INTO consumption_rollups (scope, scope_id, granularity, bucket, total_kwh, samples)
+                      SELECT scope, scope_id, '{granularidad}', substr(bucket, 1, {longitud}), SUM(total_kwh), SUM(samples)
+                      FROM consumption_rollups
+                      WHERE granularity = '{origen}' AND bucket >= ? AND {filtro}
+                      GROUP BY scope, scope_id, substr(bucket, 1, {longitud})""",
+                  (desde(granularidad),) + parametros_filtro)
+        escritas += c.rowcount
+    conn.commit()
+    return escritas
+
+def main():
+    if '--recalcular' not in sys.argv:
+        print(__doc__)
+        return 1
+
+    sys.path.insert(0, '.')
+    from app import get_db_connection
+
+    completo = '--completo' in sys.argv
+    print("🔄 RECALCULANDO AGREGADOS DE CONSUMO")
+    print("=" * 60)
+    inicio = time.monotonic()
+    conn = get_db_connection()
+    try:
+        if completo:
+            print("⚠️ Reconstrucción completa: se pierden los agregados de muestras ya eliminadas por la retención")
+        else:
+            limites = limites_retenidos(conn)
+            if limites is None:
+                print("ℹ️ No hay muestras crudas: los agregados se conservan sin cambios")
+                return 0
+            print(f"📅 Desde {limites['hour'].strftime('%Y-%m-%d %H:%M')} (buckets anteriores conservados)")
+        filas = recalcular_agregados(conn, completo=completo)
+        print(f"✅ {filas} filas de agregados generadas en {time.monotonic() - inicio:.1f}s")
+        return 0
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"Error recalculando agregados: {e}")
+        print(f"❌ Error recalculando agregados: {e}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,18 +6,28 @@ import logging
 from flask import Flask, render_template, request, jsonify, redirect, url_for, session
 from flask_mail import Mail, Message
 import sqlite3
+import json
 from datetime import datetime, timedelta
 import pytz
 LIMA_TZ = pytz.timezone('America/Lima')
-from kasa import SmartPlug
 import asyncio
+import bucle_async
+from pool_enchufes import PoolEnchufes
+from escritor_consumo import EscritorConsumo
+from cache_memoria import CacheLRU, EstadisticasCache
+from cache_compartida import CacheSQLite
+from vuelo_unico import VueloUnico
+import agregados_consumo
+import circuito_enchufes
+import metricas
+import perfilador
 from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.security import generate_password_hash, check_password_hash
 import hashlib
+import hmac
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
-from functools import lru_cache
 from authlib.integrations.flask_client import OAuth
 import secrets
 
@@ -25,6 +35,10 @@ import secrets
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
 app = Flask(__name__)
+# Latencia por endpoint y tiempo en SQLite, enchufes, Google, plantillas y cache (/metrics)
+metricas.instrumentar(app)
+# Perfilado con cProfile de peticiones firmadas por un operador (solo con PROFILER_SECRETO)
+perfilador.instrumentar(app)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', secrets.token_hex(32))
 
 # Configuración adicional para sesiones
@@ -84,38 +98,218 @@ else:
     logging.warning("Google OAuth no configurado - usando credenciales por defecto")
 
 # Configuración de la base de datos
-DB_PATH = 'ener_virgil.db'
-
-# Cache en memoria para optimización
-_cache = {}
-_cache_lock = threading.Lock()
-CACHE_TIMEOUT = 300  # 5 minutos
+DB_PATH = os.environ.get('DB_PATH', 'ener_virgil.db')
+
+# Cache para optimización (acotada: LRU con TTL por entrada)
+# CACHE_BACKEND=memoria: una cache por proceso
+# CACHE_BACKEND=compartida: un archivo SQLite común a todos los workers de gunicorn
+# Por defecto se comparte cuando hay más de un worker.
+CACHE_TIMEOUT = 300  # 5 minutos, TTL por defecto
+CACHE_TTL_TIEMPO_REAL = 30  # lecturas de enchufes y dashboard
+
+# Prefijos de clave: las estadísticas de la cache se agrupan por ellos
+ESPACIOS_CACHE = (
+    'dashboard_', 'energy_data_', 'energy_data_user_', 'devices_user_', 'devices_list_', 'device_detail_',
+    'user_receipt_', 'user_username_', 'user_google_', 'user_email_', 'user_escritura_',
+    'consumo_completo_', 'google_consumo_', 'google_fragmentos_', 'reserva_',
+)
+
+def crear_cache():
+    """Crea la cache según CACHE_BACKEND"""
+    limites = dict(max_entradas=int(os.environ.get('CACHE_MAX_ENTRADAS', 5000)),
+                   max_bytes=int(os.environ.get('CACHE_MAX_MB', 32)) * 1024 * 1024,
+                   ttl=CACHE_TIMEOUT,
+                   espacios=ESPACIOS_CACHE)
+    por_defecto = 'compartida' if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 else 'memoria'
+    backend = os.environ.get('CACHE_BACKEND', por_defecto).lower()
+    if backend == 'compartida':
+        return CacheSQLite(os.environ.get('CACHE_DB_PATH', 'cache_compartida.db'), **limites)
+    if backend != 'memoria':
+        logging.warning(f"CACHE_BACKEND desconocido '{backend}', usando cache en memoria")
+    return CacheLRU(**limites)
+
+_cache = crear_cache()
 
 # Pool de threads para operaciones asíncronas
 executor = ThreadPoolExecutor(max_workers=4)
 
+# Clientes SmartPlug reutilizables por IP (se cierran tras 5 minutos sin uso), con
+# límite de consultas simultáneas por proceso y por red de destino (hogar)
+pool_enchufes = PoolEnchufes(expiracion_inactivo=int(os.environ.get('POOL_ENCHUFES_EXPIRACION', 300)),
+                             max_concurrencia=int(os.environ.get('PLUG_MAX_CONCURRENCIA', 64)),
+                             max_por_red=int(os.environ.get('PLUG_MAX_POR_RED', 4)))
+
 def get_cache(key):
     """Obtiene un valor del cache si no ha expirado"""
-    with _cache_lock:
-        if key in _cache:
-            value, timestamp = _cache[key]
-            if time.time() - timestamp < CACHE_TIMEOUT:
-                return value
-            else:
-                del _cache[key]
-    return None
+    with metricas.medir('cache'):
+        return _cache.get(key)
+
+def set_cache(key, value, ttl=None, tags=()):
+    """
+    Guarda un valor en el cache (ttl en segundos, por defecto CACHE_TIMEOUT).
+    tags: entidades de las que depende el valor, p. ej. "user:3", "device:7", "receipt:123456"
+    """
+    with metricas.medir('cache'):
+        _cache.set(key, value, ttl=ttl, etiquetas=tags)
+
+def delete_cache(key):
+    """Elimina una entrada concreta del cache"""
+    with metricas.medir('cache'):
+        _cache.delete(key)
+
+def invalidar_cache(*tags):
+    """Elimina exactamente las entradas que dependen de alguna de las etiquetas"""
+    with metricas.medir('cache'):
+        _cache.invalidar(*tags)
+
+def envejecer_cache(*tags):
+    """
+    Marca como vencidas las entradas de obtener_con_renovacion() que llevan
+    alguna de las etiquetas: se siguen sirviendo y se recalculan en segundo
+    plano en la siguiente petición, en vez de borrarse
+    """
+    with metricas.medir('cache'):
+        _cache.modificar(lambda cached: (0, cached[1]), *tags)
+
+# Coalescencia: si vence una entrada muy pedida, solo una petición la recalcula
+ESPERA_VUELO = 10  # segundos máximos esperando el cálculo de otra petición
+vuelo_unico = VueloUnico()
+
+def obtener_o_calcular(key, calcular, ttl=None, tags=(), espera=ESPERA_VUELO):
+    """
+    Devuelve el valor de cache de key o lo calcula con calcular() una sola vez
+    aunque lleguen peticiones simultáneas. Dentro del proceso los demás hilos
+    esperan al que calcula; entre workers, una reserva en la cache hace que
+    los demás esperen a que aparezca el valor. Pasados `espera` segundos la
+    petición lo calcula por su cuenta. tags se lee después de calcular().
+    """
+    cached = get_cache(key)
+    if cached is not None:
+        return cached
+    try:
+        return vuelo_unico.ejecutar(key, lambda: _calcular_con_reserva(key, calcular, ttl, tags, espera),
+                                    timeout=espera)
+    except TimeoutError:
+        logging.warning(f"Espera agotada para {key}, calculando sin coalescencia")
+        return calcular()
+
+def _calcular_con_reserva(key, calcular, ttl, tags, espera):
+    reserva = f"reserva_{key}"
+    with metricas.medir('cache'):
+        reservada = _cache.agregar(reserva, os.getpid(), ttl=espera)
+    if not reservada:
+        # Otro worker lo está calculando: esperar su resultado
+        limite = time.monotonic() + espera
+        while time.monotonic() < limite:
+            time.sleep(0.05)
+            cached = get_cache(key)
+            if cached is not None:
+                return cached
+            if get_cache(reserva) is None:
+                break  # terminó sin guardar valor (error): calcular aquí
+    try:
+        value = calcular()
+        set_cache(key, value, ttl=ttl, tags=tags)
+        return value
+    finally:
+        delete_cache(reserva)
 
-def set_cache(key, value):
-    """Guarda un valor en el cache"""
-    with _cache_lock:
-        _cache[key] = (value, time.time())
+# Stale-while-revalidate: pasado el tiempo "fresco" se sigue sirviendo el valor
+# anterior (hasta CACHE_TTL_OBSOLETO) mientras se recalcula en segundo plano
+CACHE_TTL_OBSOLETO = int(os.environ.get('CACHE_TTL_OBSOLETO', 600))
 
-def clear_cache_pattern(pattern):
-    """Limpia entradas del cache que coincidan con un patrón"""
-    with _cache_lock:
-        keys_to_delete = [k for k in _cache.keys() if pattern in k]
-        for key in keys_to_delete:
-            del _cache[key]
+def obtener_con_renovacion(key, calcular, fresco, ttl=CACHE_TTL_OBSOLETO, tags=()):
+    """
+    Como obtener_o_calcular(), pero si el valor en cache tiene más de `fresco`
+    segundos se devuelve igual y se lanza su recálculo en segundo plano.
+    Solo se espera al cálculo cuando no hay ningún valor en cache.
+    """
+    def calcular_con_fecha():
+        return time.time(), calcular()
+    
+    cached = get_cache(key)
+    if cached is not None:
+        calculado_en, value = cached
+        if time.time() - calculado_en > fresco:
+            vuelo_unico.enviar(key, executor,
+                               lambda: _calcular_con_reserva(key, calcular_con_fecha, ttl, tags, ESPERA_VUELO))
+        return value
+    return obtener_o_calcular(key, calcular_con_fecha, ttl=ttl, tags=tags)[1]
+
+def resumen_cache():
+    """Estadísticas de la cache por espacio de claves, con totales"""
+    espacios = _cache.resumen()
+    totales = {}
+    for datos in espacios.values():
+        for campo, valor in datos.items():
+            if campo != 'tasa_aciertos':
+                totales[campo] = totales.get(campo, 0) + valor
+    consultas = totales.get('aciertos', 0) + totales.get('fallos', 0)
+    totales['tasa_aciertos'] = round(totales['aciertos'] / consultas, 3) if consultas else None
+    return {
+        'backend': type(_cache).__name__,
+        'pid': os.getpid(),
+        'espacios': dict(sorted(espacios.items())),
+        'totales': totales,
+    }
+
+def registrar_resumen_cache():
+    """Escribe en el log una línea con la eficacia de la cache por espacio"""
+    resumen = resumen_cache()
+    partes = []
+    for espacio, datos in resumen['espacios'].items():
+        tasa = f"{datos['tasa_aciertos']:.0%}" if datos['tasa_aciertos'] is not None else "-"
+        partes.append(f"{espacio} {tasa} ({datos['aciertos']}/{datos['aciertos'] + datos['fallos']}, "
+                      f"{datos['entradas']} entradas, {datos['bytes'] / 1024:.0f} KB, "
+                      f"{datos['expiraciones']} exp, {datos['descartes']} desc)")
+    logging.info(f"Cache {resumen['backend']} [pid {resumen['pid']}]: " + "; ".join(partes))
+
+# Estimaciones de electrodomésticos (base local y Google): cambian muy poco y son
+# caras de obtener, así que también se guardan en la tabla cache_persistente y
+# sobreviven al reciclaje de workers (max_requests) y a los reinicios.
+CACHE_TTL_PERSISTENTE = int(os.environ.get('CACHE_TTL_PERSISTENTE_DIAS', 30)) * 86400
+
+def get_cache_persistente(key):
+    """Obtiene un valor del cache o, si no está, de la tabla cache_persistente"""
+    cached = get_cache(key)
+    if cached is not None:
+        return cached
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT value, expires FROM cache_persistente WHERE key = ? AND expires > ?",
+                      (key, int(time.time())))
+            row = c.fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"No se pudo leer la cache persistente: {e}")
+        return None
+    if row is None:
+        return None
+    value = json.loads(row[0])
+    set_cache(key, value, ttl=row[1] - int(time.time()))
+    return value
+
+def set_cache_persistente(key, value):
+    """Guarda un valor en el cache y en disco"""
+    set_cache(key, value, ttl=CACHE_TTL_PERSISTENTE)
+    try:
+        with get_db_connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache_persistente (key, value, expires) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), int(time.time()) + CACHE_TTL_PERSISTENTE))
+    except sqlite3.Error as e:
+        logging.warning(f"No se pudo guardar en la cache persistente: {e}")
+
+def cargar_cache_persistente():
+    """Precarga en el cache las estimaciones guardadas en disco. Devuelve cuántas se cargaron"""
+    ahora = int(time.time())
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM cache_persistente WHERE expires <= ?", (ahora,))
+        c.execute("SELECT key, value, expires FROM cache_persistente")
+        filas = c.fetchall()
+    for key, value, expires in filas:
+        set_cache(key, json.loads(value), ttl=expires - ahora)
+    return len(filas)
 
 # Utilidades centralizadas
 
@@ -157,95 +351,218 @@ def safe_generate_password_hash(password):
         # Fallback a un método simple (solo para desarrollo)
         return generate_password_hash(password)
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    conn.execute("PRAGMA journal_mode=WAL")  # Mejora el rendimiento
-    conn.execute("PRAGMA synchronous=NORMAL")
-    conn.execute("PRAGMA cache_size=10000")
-    return conn
+# Conexiones SQLite: una por hilo (y por proceso), reutilizada entre peticiones
+# para no repetir la apertura ni los PRAGMA y conservar la caché de páginas caliente
+_conexiones = threading.local()
+_conexiones_heredadas = []  # Conexiones del proceso padre tras un fork: no se usan ni se cierran
+VERIFICAR_CONEXION_TRAS = 30  # segundos sin uso antes de comprobar la conexión
+
+class _ConexionHilo:
+    """Conexión física de un hilo y su estado"""
+    __slots__ = ('conn', 'pid', 'db_path', 'prestamos', 'ultimo_uso')
+    
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # Mejora el rendimiento
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA cache_size=10000")
+        self.pid = os.getpid()
+        self.db_path = db_path
+        self.prestamos = 0
+        self.ultimo_uso = time.monotonic()
+    
+    def sana(self):
+        if time.monotonic() - self.ultimo_uso < VERIFICAR_CONEXION_TRAS:
+            return True
+        try:
+            self.conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
 
-@lru_cache(maxsize=128)
-def get_user_by_receipt(receipt_number):
-    cache_key = f"user_receipt_{receipt_number}"
-    cached = get_cache(cache_key)
-    if cached:
-        return cached
+class ConexionDB:
+    """
+    Préstamo de la conexión del hilo. Se usa como una conexión sqlite3;
+    close() la devuelve al hilo en lugar de cerrarla. Como context manager
+    hace commit (o rollback si hubo excepción) y la libera:
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE receipt_number = ?", (receipt_number,))
-    user = c.fetchone()
-    conn.close()
+        with get_db_connection() as conn:
+            conn.execute(...)
     
-    if user:
-        set_cache(cache_key, user)
-    return user
-
-@lru_cache(maxsize=128)
-def get_user_by_username(username):
-    cache_key = f"user_username_{username}"
-    cached = get_cache(cache_key)
-    if cached:
-        return cached
+    Si el hilo ya tenía otro préstamo (una función que abre su propio `with`
+    dentro de otra), el bloque trabaja en un SAVEPOINT: su commit solo lo
+    incorpora a la transacción de fuera y su rollback solo deshace lo suyo.
+    Confirmar o descartar la transacción completa es cosa del préstamo externo.
+    """
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user = c.fetchone()
-    conn.close()
+    def __init__(self, fisica):
+        self._fisica = fisica
+        self._liberada = False
+        self._punto = None
+        fisica.prestamos += 1
     
-    if user:
-        set_cache(cache_key, user)
-    return user
-
-def get_devices_by_user(user_id):
-    cache_key = f"devices_user_{user_id}"
-    cached = get_cache(cache_key)
-    if cached:
-        return cached
+    def __getattr__(self, nombre):
+        return getattr(self._fisica.conn, nombre)
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, name, ip_address FROM devices WHERE user_id = ?", (user_id,))
-    devices = c.fetchall()
-    conn.close()
+    # Cursores que miden su tiempo en SQLite para las métricas de la petición
+    def cursor(self):
+        return self._fisica.conn.cursor(metricas.CursorMedido)
     
-    set_cache(cache_key, devices)
-    return devices
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+    
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+    
+    def commit(self):
+        with metricas.medir('sqlite'):
+            if self._punto:
+                # Préstamo anidado: consolidar lo hecho sin confirmar lo del préstamo externo
+                self._fisica.conn.execute(f"RELEASE {self._punto}")
+                self._fisica.conn.execute(f"SAVEPOINT {self._punto}")
+            else:
+                self._fisica.conn.commit()
+    
+    def rollback(self):
+        if self._punto:
+            self._fisica.conn.execute(f"ROLLBACK TO {self._punto}")
+        else:
+            self._fisica.conn.rollback()
+    
+    def close(self):
+        if self._liberada:
+            return
+        self._liberada = True
+        fisica = self._fisica
+        fisica.prestamos = max(0, fisica.prestamos - 1)
+        fisica.ultimo_uso = time.monotonic()
+        # El último préstamo descarta lo que quedó sin confirmar (rutas que retornan antes del commit)
+        if fisica.prestamos == 0 and fisica.conn.in_transaction:
+            fisica.conn.rollback()
+    
+    def __enter__(self):
+        if self._fisica.prestamos > 1:
+            self._punto = f"prestamo_{self._fisica.prestamos}"
+            self._fisica.conn.execute(f"SAVEPOINT {self._punto}")
+        return self
+    
+    def __exit__(self, tipo, valor, traza):
+        conn = self._fisica.conn
+        try:
+            if self._punto:
+                if tipo is not None:
+                    conn.execute(f"ROLLBACK TO {self._punto}")
+                conn.execute(f"RELEASE {self._punto}")
+            elif tipo is None:
+                conn.commit()
+            else:
+                conn.rollback()
+        finally:
+            self._punto = None
+            self.close()
+        return False
 
-def get_user_by_google_id(google_id):
-    """Obtiene usuario por Google ID"""
-    cache_key = f"user_google_{google_id}"
+@app.teardown_request
+def liberar_conexion_db(exc):
+    """Al terminar cada petición, descarta lo que una ruta dejó sin confirmar ni liberar"""
+    fisica = getattr(_conexiones, 'fisica', None)
+    if fisica is not None and fisica.pid == os.getpid():
+        fisica.prestamos = 0
+        if fisica.conn.in_transaction:
+            fisica.conn.rollback()
+
+def get_db_connection():
+    """Devuelve la conexión reutilizable del hilo actual"""
+    fisica = getattr(_conexiones, 'fisica', None)
+    if fisica is not None:
+        if fisica.pid != os.getpid():
+            # Heredada de gunicorn (preload_app): no debe usarse en el worker
+            _conexiones_heredadas.append(fisica)
+            fisica = None
+        elif fisica.db_path != DB_PATH or (fisica.prestamos == 0 and not fisica.sana()):
+            try:
+                fisica.conn.close()
+            except sqlite3.Error:
+                pass
+            fisica = None
+    if fisica is None:
+        fisica = _ConexionHilo(DB_PATH)
+        _conexiones.fisica = fisica
+    return ConexionDB(fisica)
+
+# Repositorio de usuarios
+# Una sola cache para las búsquedas de usuarios. Cada entrada guarda el momento
+# en que se leyó la fila; toda escritura a users llama a invalidar_usuario(),
+# que descarta las entradas del usuario y registra en la cache (compartida por
+# los workers) el momento de la escritura, dejando obsoleta cualquier lectura
+# que estuviera en curso. La marca se puede desalojar igual que cualquier otra
+# entrada, así que cada lectura cacheada deja una marca (0 si no hay escritura)
+# que dura más que ella: si al servirla la marca ya no está, se relee la fila.
+
+_CAMPOS_USUARIO = {
+    'receipt': 'receipt_number',
+    'username': 'username',
+    'google': 'google_id',
+    'email': 'email',
+}
+
+def buscar_usuario(campo, valor):
+    """Devuelve la fila de users cuyo campo ('receipt', 'username', 'google', 'email') vale valor"""
+    cache_key = f"user_{campo}_{valor}"
     cached = get_cache(cache_key)
     if cached:
-        return cached
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE google_id = ?", (google_id,))
-    user = c.fetchone()
-    conn.close()
+        leido_en, user = cached
+        escrita_en = get_cache(f"user_escritura_{user[0]}")
+        if escrita_en is not None and leido_en >= escrita_en:
+            return user
+        delete_cache(cache_key)
+    
+    leido_en = time.time()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT * FROM users WHERE {_CAMPOS_USUARIO[campo]} = ?", (valor,))
+        user = c.fetchone()
     
     if user:
-        set_cache(cache_key, user)
+        # Sin pisar la marca de una escritura concurrente
+        with metricas.medir('cache'):
+            _cache.agregar(f"user_escritura_{user[0]}", 0, ttl=CACHE_TIMEOUT + 1)
+        set_cache(cache_key, (leido_en, user), tags=(f"account:{user[0]}", f"receipt:{user[5]}"))
     return user
 
+def invalidar_usuario(user_id):
+    """Debe llamarse tras confirmar cualquier escritura a la fila del usuario"""
+    # Debe sobrevivir a cualquier entrada leída antes de la escritura
+    set_cache(f"user_escritura_{user_id}", time.time(), ttl=CACHE_TIMEOUT + 1)
+    invalidar_cache(f"account:{user_id}")
+
+def get_user_by_receipt(receipt_number):
+    return buscar_usuario('receipt', receipt_number)
+
+def get_user_by_username(username):
+    return buscar_usuario('username', username)
+
+def get_user_by_google_id(google_id):
+    """Obtiene usuario por Google ID"""
+    return buscar_usuario('google', google_id)
+
 def get_user_by_email(email):
     """Obtiene usuario por email"""
-    cache_key = f"user_email_{email}"
+    return buscar_usuario('email', email)
+
+def get_devices_by_user(user_id):
+    cache_key = f"devices_user_{user_id}"
     cached = get_cache(cache_key)
     if cached:
         return cached
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE email = ?", (email,))
-    user = c.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, name, ip_address FROM devices WHERE user_id = ?", (user_id,))
+        devices = c.fetchall()
     
-    if user:
-        set_cache(cache_key, user)
-    return user
+    set_cache(cache_key, devices, tags=(f"user:{user_id}",))
+    return devices
 
 def create_google_user(google_id, email, name, picture_url):
     """Crea un nuevo usuario desde Google OAuth"""
@@ -286,8 +603,7 @@ def create_google_user(google_id, email, name, picture_url):
         logging.info(f"Usuario Google creado exitosamente: ID={user_id}, username={username}")
         
         # Limpiar cache relacionado
-        clear_cache_pattern(f"user_google_{google_id}")
-        clear_cache_pattern(f"user_email_{email}")
+        invalidar_usuario(user_id)
         
         return user_id
         
@@ -317,14 +633,16 @@ def update_google_user_info(google_id, email, name, picture_url):
                   (name or '', email or '', picture_url, google_id))
         
         rows_affected = c.rowcount
+        c.execute("SELECT id FROM users WHERE google_id = ?", (google_id,))
+        actualizados = [row[0] for row in c.fetchall()]
         conn.commit()
         conn.close()
         
         logging.info(f"Usuario Google actualizado: {rows_affected} filas afectadas")
         
         # Limpiar cache
-        clear_cache_pattern(f"user_google_{google_id}")
-        clear_cache_pattern(f"user_email_{email}")
+        for user_id in actualizados:
+            invalidar_usuario(user_id)
         
         return rows_affected > 0
         
@@ -336,17 +654,83 @@ def update_google_user_info(google_id, email, name, picture_url):
             conn.close()
         return False
 
+def invalidar_consumo_usuarios(lote):
+    """
+    Tras guardar un lote, marca vencidos los datos de consumo de sus usuarios
+    (dashboard, lecturas) y descarta el historial de sus dispositivos. No se
+    borran: el poller escribe en cada ciclo y cada consulta sería en frío.
+    Los cambios de estructura (enchufes, perfil) siguen invalidando user:<id>
+    """
+    envejecer_cache(*{f"consumo:{user_id}" for user_id, _, _, _ in lote})
+    invalidar_cache(*{f"historial:{device_id}" for _, device_id, _, _ in lote})
+
+# Escritor diferido: las muestras se insertan por lotes en una sola transacción
+escritor_consumo = EscritorConsumo(
+    get_db_connection,
+    max_lote=int(os.environ.get('ESCRITOR_MAX_LOTE', 500)),
+    intervalo=float(os.environ.get('ESCRITOR_INTERVALO', 2)),
+    max_cola=int(os.environ.get('ESCRITOR_MAX_COLA', 10000)),
+    al_escribir=agregados_consumo.actualizar_agregados,
+    al_confirmar=invalidar_consumo_usuarios
+)
+
 def save_consumption(user_id, device_id, consumption_kwh):
+    """Encola una muestra de consumo para el escritor diferido"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO consumption (user_id, device_id, consumption_kwh, timestamp) VALUES (?, ?, ?, ?)",
-                  (user_id, device_id, consumption_kwh, datetime.now()))
-        conn.commit()
-        conn.close()
+        escritor_consumo.encolar(user_id, device_id, consumption_kwh)
     except Exception as e:
         logging.error(f"Error guardando consumo: {e}")
 
+def save_device_snapshots(lecturas):
+    """
+    Guarda la última lectura de cada enchufe (una fila por dispositivo).
+    Si la lectura falló se registra el error, pero se conservan el consumo,
+    el estado y read_ts de la última lectura correcta. También lleva la
+    cuenta de fallos seguidos que abre el cortacircuitos del enchufe.
+    """
+    if not lecturas:
+        return
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            ahora = datetime.now(LIMA_TZ).strftime('%Y-%m-%d %H:%M:%S')
+            ahora_ts = int(time.time())
+            ids = [l['id'] for l in lecturas]
+            c.execute(f"SELECT device_id, failures FROM device_snapshots WHERE device_id IN ({','.join('?' * len(ids))})",
+                      ids)
+            fallos_previos = dict(c.fetchall())
+            filas = []
+            for l in lecturas:
+                if l.get('error'):
+                    fallos = (fallos_previos.get(l['id']) or 0) + 1
+                    filas.append((l['id'], l['user_id'], l['ip_address'], None, None, l['error'], ahora, None, ahora_ts,
+                                  fallos, circuito_enchufes.proximo_intento(fallos, ahora_ts)))
+                    if fallos == circuito_enchufes.UMBRAL_FALLOS:
+                        logging.warning(f"Enchufe {l['id']} ({l['ip_address']}) sin respuesta {fallos} veces: circuito abierto")
+                else:
+                    filas.append((l['id'], l['user_id'], l['ip_address'], l['consumption'],
+                                  1 if l['status'] else 0, None, ahora, ahora_ts, ahora_ts, 0, None))
+            c.executemany("""INSERT INTO device_snapshots
+                             (device_id, user_id, ip_address, consumption_kwh, status, error, updated_at, read_ts, checked_ts,
+                              failures, retry_at_ts)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                             ON CONFLICT(device_id) DO UPDATE SET
+                                 user_id = excluded.user_id,
+                                 ip_address = excluded.ip_address,
+                                 consumption_kwh = CASE WHEN excluded.error IS NULL
+                                                   THEN excluded.consumption_kwh ELSE consumption_kwh END,
+                                 status = CASE WHEN excluded.error IS NULL THEN excluded.status ELSE status END,
+                                 read_ts = CASE WHEN excluded.error IS NULL THEN excluded.read_ts ELSE read_ts END,
+                                 error = excluded.error,
+                                 updated_at = excluded.updated_at,
+                                 checked_ts = excluded.checked_ts,
+                                 failures = excluded.failures,
+                                 retry_at_ts = excluded.retry_at_ts""", filas)
+            # Los dispositivos eliminados no deben conservar lectura
+            c.execute("DELETE FROM device_snapshots WHERE device_id NOT IN (SELECT id FROM devices)")
+    except Exception as e:
+        logging.error(f"Error guardando snapshots de dispositivos: {e}")
+
 # Funciones de correo electrónico
 
 def verificar_configuracion_correo():
@@ -379,10 +763,10 @@ def obtener_estadisticas_usuario(user_id):
         c.execute("SELECT COUNT(*) FROM devices WHERE user_id = ?", (user_id,))
         dispositivos_conectados = c.fetchone()[0] or 0
         
-        # Calcular consumo total del último mes
-        fecha_inicio = datetime.now(LIMA_TZ) - timedelta(days=30)
-        c.execute("""SELECT SUM(consumption_kwh) FROM consumption 
-                     WHERE user_id = ? AND timestamp >= ?""", 
+        # Calcular consumo total del último mes (desde los agregados diarios)
+        fecha_inicio = (datetime.now(LIMA_TZ) - timedelta(days=30)).strftime('%Y-%m-%d')
+        c.execute("""SELECT SUM(total_kwh) FROM consumption_rollups 
+                     WHERE scope = 'user' AND scope_id = ? AND granularity = 'day' AND bucket >= ?""", 
                   (user_id, fecha_inicio))
         consumo_mes = c.fetchone()[0] or 0
         
@@ -542,6 +926,36 @@ def check_column_exists(cursor, table_name, column_name):
     columns = [column[1] for column in cursor.fetchall()]
     return column_name in columns
 
+def migrar_consumo_a_epoch(c):
+    """
+    Reconstruye la tabla consumption cambiando la columna de texto timestamp
+    por ts INTEGER (segundos epoch). Los textos antiguos se guardaron con
+    datetime.now(), es decir en hora local del servidor; el modificador 'utc'
+    de SQLite hace justo esa conversión. Filas con fecha ilegible se descartan.
+    """
+    c.execute("SELECT COUNT(*) FROM consumption")
+    total = c.fetchone()[0]
+    logging.info(f"Convirtiendo {total} muestras de consumo a timestamps epoch...")
+    
+    c.execute("DROP TABLE IF EXISTS consumption_epoch")
+    c.execute('''CREATE TABLE consumption_epoch
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  device_id INTEGER,
+                  consumption_kwh REAL,
+                  ts INTEGER NOT NULL,
+                  FOREIGN KEY (user_id) REFERENCES users(id))''')
+    c.execute("""INSERT INTO consumption_epoch (id, user_id, device_id, consumption_kwh, ts)
+                 SELECT id, user_id, device_id, consumption_kwh,
+                        CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                 FROM consumption
+                 WHERE strftime('%s', timestamp, 'utc') IS NOT NULL""")
+    convertidas = c.rowcount
+    # Al eliminar la tabla se eliminan también sus índices sobre timestamp
+    c.execute("DROP TABLE consumption")
+    c.execute("ALTER TABLE consumption_epoch RENAME TO consumption")
+    logging.info(f"Muestras convertidas: {convertidas} (descartadas: {total - convertidas})")
+
 def migrate_database():
     """Migra la base de datos existente para agregar nuevas columnas"""
     conn = get_db_connection()
@@ -568,6 +982,23 @@ def migrate_database():
         # Hacer que phone, dni y receipt_number sean opcionales para usuarios existentes
         # (SQLite no permite modificar columnas, pero los datos existentes seguirán funcionando)
         
+        # Consumo con timestamp de texto: convertir a segundos epoch
+        if check_column_exists(c, 'consumption', 'timestamp'):
+            migrar_consumo_a_epoch(c)
+        
+        # Snapshots: momento de la última lectura correcta y del último intento,
+        # y estado del cortacircuitos del enchufe
+        snapshot_columns = [
+            ('read_ts', 'INTEGER'),
+            ('checked_ts', 'INTEGER'),
+            ('failures', 'INTEGER NOT NULL DEFAULT 0'),
+            ('retry_at_ts', 'INTEGER'),
+        ]
+        for column_name, column_type in snapshot_columns:
+            if not check_column_exists(c, 'device_snapshots', column_name):
+                c.execute(f'ALTER TABLE device_snapshots ADD COLUMN {column_name} {column_type}')
+                logging.info(f"Columna {column_name} agregada a la tabla device_snapshots")
+        
         conn.commit()
         logging.info("Migración de base de datos completada")
         
@@ -590,12 +1021,13 @@ def init_db():
                   dni TEXT NOT NULL UNIQUE,
                   receipt_number TEXT NOT NULL UNIQUE,
                   password TEXT NOT NULL)''')
+    # ts: segundos epoch (UTC); ver agregados_consumo.a_epoch/desde_epoch
     c.execute('''CREATE TABLE IF NOT EXISTS consumption
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   device_id INTEGER,
                   consumption_kwh REAL,
-                  timestamp DATETIME,
+                  ts INTEGER NOT NULL,
                   FOREIGN KEY (user_id) REFERENCES users(id))''')
     c.execute('''CREATE TABLE IF NOT EXISTS devices
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -604,6 +1036,31 @@ def init_db():
                   ip_address TEXT NOT NULL UNIQUE,
                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users(id))''')
+    # Última lectura de cada enchufe, escrita por poller_telemetria.py
+    # read_ts: última lectura correcta; checked_ts: último intento (segundos epoch)
+    # failures/retry_at_ts: cortacircuitos del enchufe (ver circuito_enchufes.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS device_snapshots
+                 (device_id INTEGER PRIMARY KEY,
+                  user_id INTEGER,
+                  ip_address TEXT,
+                  consumption_kwh REAL,
+                  status INTEGER,
+                  error TEXT,
+                  updated_at DATETIME,
+                  read_ts INTEGER,
+                  checked_ts INTEGER,
+                  failures INTEGER NOT NULL DEFAULT 0,
+                  retry_at_ts INTEGER,
+                  FOREIGN KEY (device_id) REFERENCES devices(id))''')
+    # Consumo agregado por hora/día/mes, mantenido por el escritor de consumo
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='consumption_rollups'")
+    agregados_nuevos = c.fetchone() is None
+    c.execute(agregados_consumo.SQL_CREAR_TABLA)
+    # Estimaciones de electrodomésticos que sobreviven al reciclaje de workers
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_persistente
+                 (key TEXT PRIMARY KEY,
+                  value TEXT NOT NULL,
+                  expires INTEGER NOT NULL)''')
     
     conn.commit()
     conn.close()
@@ -611,6 +1068,17 @@ def init_db():
     # Ejecutar migración para agregar nuevas columnas
     migrate_database()
     
+    # Primera vez con agregados: generarlos a partir del consumo ya registrado
+    if agregados_nuevos:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM consumption LIMIT 1")
+        if c.fetchone():
+            # La tabla está vacía y la retención aún no ha podido borrar nada: todo el historial
+            filas = agregados_consumo.recalcular_agregados(conn, completo=True)
+            logging.info(f"Agregados de consumo generados: {filas} filas")
+        conn.close()
+    
     # Crear índices después de la migración
     conn = get_db_connection()
     c = conn.cursor()
@@ -621,9 +1089,12 @@ def init_db():
         c.execute('CREATE INDEX IF NOT EXISTS idx_users_receipt ON users(receipt_number)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_devices_user ON devices(user_id)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_devices_ip ON devices(ip_address)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_consumption_user ON consumption(user_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_consumption_device ON consumption(device_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_consumption_timestamp ON consumption(timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_consumption_ts ON consumption(ts)')
+        # Índices compuestos: filtran por usuario/dispositivo y rango de fechas,
+        # ordenan por fecha y cubren consumption_kwh sin leer la tabla
+        c.execute('CREATE INDEX IF NOT EXISTS idx_consumption_user_ts ON consumption(user_id, ts, consumption_kwh)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_consumption_device_ts ON consumption(device_id, ts, consumption_kwh)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_user ON device_snapshots(user_id)')
         
         # Crear índices para nuevas columnas (solo si existen)
         if check_column_exists(c, 'users', 'google_id'):
@@ -641,22 +1112,53 @@ def init_db():
 
 init_db()
 
+# Consultas frecuentes; verificar_planes_consulta.py comprueba con EXPLAIN QUERY PLAN
+# que ninguna recorra una tabla completa ni ordene con un B-tree temporal
+CONSULTAS_CRITICAS = {
+    'usuario_por_recibo': ("SELECT * FROM users WHERE receipt_number = ?", ('123456',)),
+    'usuario_por_username': ("SELECT * FROM users WHERE username = ?", ('usuario',)),
+    'usuario_por_google_id': ("SELECT * FROM users WHERE google_id = ?", ('123',)),
+    'usuario_por_email': ("SELECT * FROM users WHERE email = ?", ('a@b.c',)),
+    'dispositivos_usuario': ("SELECT id, name, ip_address FROM devices WHERE user_id = ?", (1,)),
+    'detalle_dispositivo': ("SELECT name, ip_address, created_at FROM devices WHERE id = ? AND user_id = ?", (1, 1)),
+    'snapshots_usuario': ("""SELECT d.id, d.name, d.ip_address, s.consumption_kwh, s.status, s.error, s.updated_at
+                             FROM devices d
+                             LEFT JOIN device_snapshots s ON s.device_id = d.id
+                             WHERE d.user_id = ?""", (1,)),
+    'historial_dispositivo': ("SELECT ts, consumption_kwh FROM consumption WHERE device_id = ? ORDER BY ts DESC LIMIT 20", (1,)),
+    'muestras_usuario_rango': ("SELECT ts, consumption_kwh FROM consumption WHERE user_id = ? AND ts >= ? AND ts < ?",
+                               (1, 1704085200, 1706763600)),
+    'muestras_dispositivo_rango': ("SELECT ts, consumption_kwh FROM consumption WHERE device_id = ? AND ts >= ? AND ts < ?",
+                                   (1, 1704085200, 1706763600)),
+    'suma_usuario_rango': ("SELECT SUM(consumption_kwh) FROM consumption WHERE user_id = ? AND ts >= ? AND ts < ?",
+                           (1, 1704085200, 1706763600)),
+    'retencion_muestras_antiguas': ("SELECT id FROM consumption WHERE ts < ? LIMIT ?", (1704085200, 5000)),
+    'retencion_muestras_dispositivo': ("SELECT id FROM consumption WHERE device_id = ? LIMIT ?", (1, 5000)),
+    'agregados_rango': ("""SELECT bucket, total_kwh FROM consumption_rollups
+                           WHERE scope = ? AND scope_id = ? AND granularity = ? AND bucket BETWEEN ? AND ?""",
+                        ('user', 1, 'day', '2024-01-01', '2024-01-31')),
+    'agregados_30_dias': ("""SELECT SUM(total_kwh) FROM consumption_rollups 
+                             WHERE scope = 'user' AND scope_id = ? AND granularity = 'day' AND bucket >= ?""",
+                          (1, '2024-01-01')),
+}
+
 COST_PER_KWH = 0.50  # En PEN
 
 # Obtener datos de consumo energético real desde TP-Link Tapo P110 (optimizado)
-async def get_real_energy_data(device_id, ip_address, user_id=None, timeout=3):
+async def get_real_energy_data(device_id, ip_address, user_id=None, timeout=3, usar_cache=True):
     cache_key = f"energy_data_{device_id}"
-    cached = get_cache(cache_key)
-    if cached:
-        return cached
+    if usar_cache:
+        cached = get_cache(cache_key)
+        if cached:
+            return cached
     
     try:
-        plug = SmartPlug(ip_address)
-        # Timeout más corto para evitar bloqueos
-        await asyncio.wait_for(plug.update(), timeout=timeout)
-        consumption_watts = plug.emeter_realtime.get("power", 0)
+        async with pool_enchufes.usar(ip_address) as plug:
+            # Timeout más corto para evitar bloqueos
+            await asyncio.wait_for(plug.update(), timeout=timeout)
+            consumption_watts = plug.emeter_realtime.get("power", 0)
+            status = plug.is_on
         consumption_kwh = consumption_watts / 1000
-        status = plug.is_on
         
         result = {
             "id": device_id,
@@ -667,15 +1169,17 @@ async def get_real_energy_data(device_id, ip_address, user_id=None, timeout=3):
         }
         
         # Cache por 30 segundos para datos en tiempo real
-        with _cache_lock:
-            _cache[cache_key] = (result, time.time())
+        if usar_cache:
+            etiquetas = (f"device:{device_id}",) + ((f"user:{user_id}",) if user_id is not None else ())
+            set_cache(cache_key, result, ttl=CACHE_TTL_TIEMPO_REAL, tags=etiquetas)
         
-        # Guardar consumo en background
+        # Guardar consumo en background (escritor diferido por lotes)
         if user_id is not None:
-            executor.submit(save_consumption, user_id, device_id, consumption_kwh)
+            save_consumption(user_id, device_id, consumption_kwh)
         
         return result
     except asyncio.TimeoutError:
+        metricas.incrementar('enervirgil_enchufe_timeouts_total', origen='lectura')
         logging.warning(f"Timeout al obtener datos del enchufe (IP: {ip_address})")
         return {
             "id": device_id,
@@ -696,48 +1200,123 @@ async def get_real_energy_data(device_id, ip_address, user_id=None, timeout=3):
             "error": str(e)
         }
 
+# Lecturas de enchufes: pasado SNAPSHOT_LIMITE_OBSOLETO se muestran como obsoletas
+# (con su último valor, nunca como 0 kWh); si el poller no ha intentado leer un
+# enchufe en SNAPSHOT_RENOVAR_TRAS segundos, la web lo relee en segundo plano
+SNAPSHOT_LIMITE_OBSOLETO = int(os.environ.get('SNAPSHOT_LIMITE_OBSOLETO', 300))
+SNAPSHOT_RENOVAR_TRAS = int(os.environ.get('SNAPSHOT_RENOVAR_TRAS', 90))
+
 def get_energy_data(receipt_number):
-    cache_key = f"energy_data_user_{receipt_number}"
-    cached = get_cache(cache_key)
-    if cached:
-        return cached
+    """
+    Devuelve la última lectura de los enchufes del usuario.
+    Solo lee los snapshots que mantiene poller_telemetria.py: la página nunca
+    espera a los enchufes, sin importar cuántos tenga el hogar.
+    """
+    etiquetas = [f"receipt:{receipt_number}"]
     
-    devices = []
-    try:
-        user = get_user_by_receipt(receipt_number)
-        if user:
-            user_id = user[0]
-            device_records = get_devices_by_user(user_id)
-            if device_records:
-                async def gather_devices():
-                    # Timeout global más corto
-                    tasks = [get_real_energy_data(device_id, ip_address, user_id, timeout=2) 
-                            for device_id, name, ip_address in device_records]
-                    return await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout=10)
-                
-                try:
-                    devices = asyncio.run(gather_devices())
-                    # Filtrar excepciones
-                    devices = [d for d in devices if not isinstance(d, Exception)]
-                except asyncio.TimeoutError:
-                    logging.warning("Timeout global al obtener datos de dispositivos")
-                    # Devolver datos básicos sin consumo en tiempo real
-                    devices = [{
+    def leer_snapshots():
+        devices = []
+        try:
+            user = get_user_by_receipt(receipt_number)
+            if user:
+                etiquetas.extend((f"user:{user[0]}", f"consumo:{user[0]}"))
+                conn = get_db_connection()
+                c = conn.cursor()
+                c.execute("""SELECT d.id, d.name, d.ip_address, s.consumption_kwh, s.status, s.error, s.updated_at,
+                                    s.read_ts, s.checked_ts, s.failures, s.retry_at_ts
+                             FROM devices d
+                             LEFT JOIN device_snapshots s ON s.device_id = d.id
+                             WHERE d.user_id = ?""", (user[0],))
+                rows = c.fetchall()
+                conn.close()
+                ahora = int(time.time())
+                atrasados = []
+                for (device_id, name, ip_address, consumption_kwh, status, error, updated_at, read_ts, checked_ts,
+                     fallos, reintentar_ts) in rows:
+                    circuito = circuito_enchufes.estado(fallos, reintentar_ts, ahora)
+                    device = {
                         "id": device_id,
                         "name": name,
-                        "consumption": 0.0,
-                        "status": False,
+                        "consumption": round(consumption_kwh or 0.0, 2),
+                        "status": bool(status),
                         "ip_address": ip_address,
-                        "error": "timeout"
-                    } for device_id, name, ip_address in device_records]
-    except Exception as e:
-        logging.error(f"Error al obtener dispositivos: {e}")
+                        "updated_at": updated_at,
+                        "read_ts": read_ts,
+                        "fallos": fallos or 0,
+                        "reintentar_ts": reintentar_ts
+                    }
+                    if error:
+                        device["error"] = error
+                    elif read_ts is None:
+                        # El poller aún no ha leído este enchufe
+                        device["error"] = "sin_lectura"
+                    devices.append(device)
+                    # Los enchufes con el circuito abierto no se releen hasta su próximo intento
+                    if ((checked_ts is None or ahora - checked_ts > SNAPSHOT_RENOVAR_TRAS)
+                            and circuito != circuito_enchufes.ABIERTO):
+                        atrasados.append((device_id, ip_address))
+                if atrasados:
+                    renovar_snapshots(user[0], atrasados)
+        except Exception as e:
+            logging.error(f"Error al obtener dispositivos: {e}")
+        
+        return devices
     
-    # Cache por 30 segundos
-    with _cache_lock:
-        _cache[cache_key] = (devices, time.time())
+    # Fresco 30 segundos; después se sirve el anterior mientras se relee en segundo plano
+    return vigencia_lecturas(obtener_con_renovacion(f"energy_data_user_{receipt_number}", leer_snapshots,
+                                                    fresco=CACHE_TTL_TIEMPO_REAL, tags=etiquetas))
+
+def vigencia_lecturas(devices):
+    """
+    Copias de las lecturas con su edad, si están obsoletas y el estado del
+    circuito calculados al servirlas: la lista en cache puede llevar hasta
+    CACHE_TTL_OBSOLETO segundos guardada
+    """
+    ahora = int(time.time())
+    vigentes = []
+    for device in devices:
+        read_ts = device.get('read_ts')
+        edad = ahora - read_ts if read_ts is not None else None
+        vigentes.append(dict(device,
+                             edad_segundos=edad,
+                             obsoleto=edad is None or edad > SNAPSHOT_LIMITE_OBSOLETO,
+                             circuito=circuito_enchufes.estado(device.get('fallos'), device.get('reintentar_ts'),
+                                                               ahora)))
+    return vigentes
+
+def renovar_snapshots(user_id, dispositivos):
+    """Relee en segundo plano los enchufes que el poller no ha consultado a tiempo"""
+    for device_id, ip_address in dispositivos:
+        bucle_async.lanzar_compartido(
+            f"renovar_snapshot_{device_id}",
+            lambda device_id=device_id, ip_address=ip_address: _renovar_snapshot(user_id, device_id, ip_address))
+
+async def _renovar_snapshot(user_id, device_id, ip_address):
+    lectura = await get_real_energy_data(device_id, ip_address, user_id, usar_cache=False)
+    lectura['user_id'] = user_id
+    # La escritura en SQLite no debe bloquear el loop
+    await asyncio.get_running_loop().run_in_executor(executor, save_device_snapshots, [lectura])
+
+# Tiempo máximo de espera para órdenes y lecturas directas a un enchufe
+TIMEOUT_ENCHUFE_DIRECTO = 10  # segundos
+
+def controlar_enchufe(device_id, ip_address, action):
+    """Enciende o apaga un enchufe usando el loop asyncio persistente"""
+    async def control_plug():
+        async with pool_enchufes.usar(ip_address) as plug:
+            await plug.update()
+            if action == 'on':
+                await plug.turn_on()
+            else:
+                await plug.turn_off()
+        return f"Dispositivo {device_id} {'encendido' if action == 'on' else 'apagado'}"
     
-    return devices
+    try:
+        with metricas.medir('enchufes'):
+            return bucle_async.ejecutar(control_plug(), timeout=TIMEOUT_ENCHUFE_DIRECTO)
+    except TimeoutError:
+        metricas.incrementar('enervirgil_enchufe_timeouts_total', origen='orden')
+        raise
 
 def get_recommendations(total_consumption, devices, receipt_number):
     recommendations = []
@@ -851,7 +1430,7 @@ def obtener_consumo_completo(nombre_dispositivo):
     Obtiene el consumo usando cache, base local y Google API como último recurso
     """
     cache_key = f"consumo_completo_{nombre_dispositivo.lower()}"
-    cached = get_cache(cache_key)
+    cached = get_cache_persistente(cache_key)
     if cached:
         return cached
     
@@ -859,7 +1438,7 @@ def obtener_consumo_completo(nombre_dispositivo):
     consumo_local = obtener_consumo_local(nombre_dispositivo)
     if consumo_local is not None:
         result = (consumo_local, "Base de datos local")
-        set_cache(cache_key, result)
+        set_cache_persistente(cache_key, result)
         return result
     
     # Solo usar Google API si no hay datos locales y en background
@@ -868,17 +1447,18 @@ def obtener_consumo_completo(nombre_dispositivo):
             consumo_google = obtener_consumo_google(nombre_dispositivo)
             if consumo_google is not None:
                 result = (consumo_google, "Google API")
-                set_cache(cache_key, result)
+                set_cache_persistente(cache_key, result)
                 return result
         except Exception as e:
             logging.error(f"Error en Google API: {e}")
         return None, "No encontrado"
     
-    # Ejecutar en background para no bloquear
-    future = executor.submit(fetch_google_async)
+    # Ejecutar en background para no bloquear (una sola búsqueda por aparato a la vez)
+    future = vuelo_unico.enviar(cache_key, executor, fetch_google_async)
     try:
         # Timeout muy corto para Google API
-        result = future.result(timeout=2)
+        with metricas.medir('google'):
+            result = future.result(timeout=2)
         return result
     except:
         # Si Google falla o es lento, devolver sin datos
@@ -889,7 +1469,7 @@ def obtener_consumo_google(nombre_dispositivo):
     Busca patrones de consumo (optimizado con timeout corto)
     """
     cache_key = f"google_consumo_{nombre_dispositivo.lower()}"
-    cached = get_cache(cache_key)
+    cached = get_cache_persistente(cache_key)
     if cached:
         return cached
     
@@ -927,7 +1507,7 @@ def obtener_consumo_google(nombre_dispositivo):
                 if match:
                     value = float(match.group(1).replace(',', '.'))
                     result = round(value * multiplier, 3)
-                    set_cache(cache_key, result)
+                    set_cache_persistente(cache_key, result)
                     return result
         
         return None
@@ -941,7 +1521,7 @@ def obtener_fragmentos_google(nombre_dispositivo):
     Obtiene fragmentos (optimizado para ser asíncrono)
     """
     cache_key = f"google_fragmentos_{nombre_dispositivo.lower()}"
-    cached = get_cache(cache_key)
+    cached = get_cache_persistente(cache_key)
     if cached:
         return cached
     
@@ -966,17 +1546,18 @@ def obtener_fragmentos_google(nombre_dispositivo):
                     full_snippet = f"<strong>{title}</strong><br>{snippet}" if title else snippet
                     fragmentos.append(full_snippet)
             
-            set_cache(cache_key, fragmentos)
+            set_cache_persistente(cache_key, fragmentos)
             return fragmentos
             
         except Exception as e:
             logging.error(f"Error obteniendo fragmentos: {e}")
             return []
     
-    # Ejecutar en background
-    future = executor.submit(fetch_fragments)
+    # Ejecutar en background (una sola búsqueda por aparato a la vez)
+    future = vuelo_unico.enviar(cache_key, executor, fetch_fragments)
     try:
-        return future.result(timeout=1)  # Timeout muy corto
+        with metricas.medir('google'):
+            return future.result(timeout=1)  # Timeout muy corto
     except:
         return []  # Si falla, devolver lista vacía
 
@@ -1017,12 +1598,12 @@ def register():
         password = request.form['password']
         hashed_password = safe_generate_password_hash(password)
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("INSERT INTO users (username, full_name, phone, dni, receipt_number, password) VALUES (?, ?, ?, ?, ?, ?)",
-                      (username, full_name, phone, dni, receipt_number, hashed_password))
-            conn.commit()
-            conn.close()
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("INSERT INTO users (username, full_name, phone, dni, receipt_number, password) VALUES (?, ?, ?, ?, ?, ?)",
+                          (username, full_name, phone, dni, receipt_number, hashed_password))
+                user_id = c.lastrowid
+            invalidar_usuario(user_id)
             session['success_message'] = f"Usuario '{username}' creado con éxito"
             return redirect(url_for('login'))
         except sqlite3.IntegrityError as e:
@@ -1379,11 +1960,7 @@ def dashboard():
     
     # Usar cache para datos que no cambian frecuentemente
     cache_key = f"dashboard_{receipt_number}"
-    cached_data = get_cache(cache_key)
-    
-    if cached_data:
-        cached_data['show_complete_profile'] = False
-        return render_template('dashboard.html', **cached_data)
+    etiquetas = [f"receipt:{receipt_number}"]
     
     # Obtener datos en paralelo para mejorar rendimiento
     def get_dashboard_data():
@@ -1392,6 +1969,9 @@ def dashboard():
         total_cost = total_consumption * COST_PER_KWH
         recommendations = get_recommendations(total_consumption, energy_data, receipt_number)
         consumption_data = generate_consumption_data(receipt_number)
+        user = get_user_by_receipt(receipt_number)
+        if user:
+            etiquetas.extend((f"user:{user[0]}", f"consumo:{user[0]}"))
         
         return {
             'devices': energy_data,
@@ -1404,10 +1984,10 @@ def dashboard():
     
     # Ejecutar en background si es necesario
     try:
-        dashboard_data = get_dashboard_data()
-        # Cache por 30 segundos
-        with _cache_lock:
-            _cache[cache_key] = (dashboard_data, time.time())
+        # Fresco 30 segundos; después se sirve el anterior mientras se recalcula en segundo plano
+        dashboard_data = obtener_con_renovacion(cache_key, get_dashboard_data, fresco=CACHE_TTL_TIEMPO_REAL,
+                                                tags=etiquetas)
+        dashboard_data = dict(dashboard_data, devices=vigencia_lecturas(dashboard_data['devices']))
         return render_template('dashboard.html', **dashboard_data)
     except Exception as e:
         logging.error(f"Error en dashboard: {e}")
@@ -1429,41 +2009,23 @@ def generate_consumption_data(receipt_number):
             'monthly': {'labels': [], 'data': []}
         }
     user_id = user[0]
+    # Fin del día de hoy (hora de Lima): cada serie termina en el bucket actual
+    fin = (datetime.now(LIMA_TZ) + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    inicio_meses = fin.replace(day=1)
+    for _ in range(11):
+        inicio_meses = (inicio_meses - timedelta(days=1)).replace(day=1)
+    
     conn = get_db_connection()
-    c = conn.cursor()
-    current_date = datetime.now()
-    daily_labels = [(current_date - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(6, -1, -1)]
-    daily_data = []
-    for i in range(7):
-        start_date = (current_date - timedelta(days=i)).replace(hour=0, minute=0, second=0, microsecond=0)
-        end_date = start_date + timedelta(days=1)
-        c.execute("SELECT SUM(consumption_kwh) FROM consumption WHERE user_id = ? AND timestamp >= ? AND timestamp < ?",
-                  (user_id, start_date, end_date))
-        result = c.fetchone()[0]
-        daily_data.append(round(result or 0, 2))
-    weekly_labels = [f'Semana {i+1}' for i in range(4)]
-    weekly_data = []
-    for i in range(4):
-        start_date = (current_date - timedelta(days=(i+1)*7)).replace(hour=0, minute=0, second=0, microsecond=0)
-        end_date = start_date + timedelta(days=7)
-        c.execute("SELECT SUM(consumption_kwh) FROM consumption WHERE user_id = ? AND timestamp >= ? AND timestamp < ?",
-                  (user_id, start_date, end_date))
-        result = c.fetchone()[0]
-        weekly_data.append(round(result or 0, 2))
-    monthly_labels = [(current_date - timedelta(days=i*30)).strftime('%Y-%m') for i in range(11, -1, -1)]
-    monthly_data = []
-    for i in range(12):
-        start_date = (current_date - timedelta(days=(i+1)*30)).replace(hour=0, minute=0, second=0, microsecond=0)
-        end_date = start_date + timedelta(days=30)
-        c.execute("SELECT SUM(consumption_kwh) FROM consumption WHERE user_id = ? AND timestamp >= ? AND timestamp < ?",
-                  (user_id, start_date, end_date))
-        result = c.fetchone()[0]
-        monthly_data.append(round(result or 0, 2))
+    daily = agregados_consumo.serie_consumo(conn, 'user', user_id, fin - timedelta(days=7), fin, 'day')
+    weekly = agregados_consumo.serie_consumo(conn, 'user', user_id, fin - timedelta(days=28), fin, 'week')
+    monthly = agregados_consumo.serie_consumo(conn, 'user', user_id, inicio_meses, fin, 'month')
     conn.close()
+    
+    weekly['labels'] = [f'Semana {i+1}' for i in range(len(weekly['labels']))]
     return {
-        'daily': {'labels': daily_labels, 'data': daily_data},
-        'weekly': {'labels': weekly_labels, 'data': weekly_data},
-        'monthly': {'labels': monthly_labels, 'data': monthly_data}
+        'daily': daily,
+        'weekly': weekly,
+        'monthly': monthly
     }
 
 @app.route('/detalles_dispositivos', methods=['GET'])
@@ -1491,7 +2053,7 @@ def detalles_dispositivos():
         c.execute("SELECT id, name FROM devices WHERE user_id = ?", (user_id,))
         devices = [dict(id=row[0], name=row[1]) for row in c.fetchall()]
         conn.close()
-        set_cache(cache_key, devices)
+        set_cache(cache_key, devices, tags=(f"user:{user_id}",))
     
     detalle = None
     if selected_device_id:
@@ -1507,8 +2069,9 @@ def detalles_dispositivos():
             
             if row:
                 device_name, ip_address, fecha_registro = row
-                c.execute("SELECT timestamp, consumption_kwh FROM consumption WHERE device_id = ? ORDER BY timestamp DESC LIMIT 20", (selected_device_id,))
-                historial = c.fetchall()
+                c.execute("SELECT ts, consumption_kwh FROM consumption WHERE device_id = ? ORDER BY ts DESC LIMIT 20", (selected_device_id,))
+                historial = [(agregados_consumo.desde_epoch(ts).strftime('%Y-%m-%d %H:%M:%S'), consumo)
+                             for ts, consumo in c.fetchall()]
                 
                 # Obtener consumo estimado (rápido, usa cache)
                 consumo_estimado, fuente = obtener_consumo_completo(device_name)
@@ -1527,7 +2090,8 @@ def detalles_dispositivos():
                 }
                 
                 # Cache por 5 minutos
-                set_cache(detail_cache_key, detalle)
+                set_cache(detail_cache_key, detalle, tags=(f"user:{user_id}", f"device:{selected_device_id}",
+                                                           f"historial:{selected_device_id}"))
             
             conn.close()
     
@@ -1547,28 +2111,18 @@ def dispositivos():
         if not user:
             return jsonify({"error": "Usuario no encontrado"}), 404
         user_id = user[0]
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT ip_address FROM devices WHERE user_id = ? AND id = ?", (user_id, device_id))
-        ip_address = c.fetchone()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT ip_address FROM devices WHERE user_id = ? AND id = ?", (user_id, device_id))
+            ip_address = c.fetchone()
         if ip_address:
             ip_address = ip_address[0]
             try:
-                async def control_plug():
-                    plug = SmartPlug(ip_address)
-                    await plug.update()
-                    if action == 'on':
-                        await plug.turn_on()
-                    else:
-                        await plug.turn_off()
-                    return f"Dispositivo {device_id} {'encendido' if action == 'on' else 'apagado'}"
-                
-                message = asyncio.run(control_plug())
+                message = controlar_enchufe(device_id, ip_address, action)
                 return jsonify({"message": message})
             except Exception as e:
                 logging.error(f"Error al controlar dispositivo: {e}")
                 return jsonify({"error": "Error al controlar dispositivo"}), 500
-        conn.close()
     user = get_user_by_receipt(session['receipt_number'])
     plug_ids = set()
     if user:
@@ -1587,28 +2141,18 @@ def control_device():
     if not user:
         return jsonify({"error": "Usuario no encontrado"}), 404
     user_id = user[0]
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT ip_address FROM devices WHERE user_id = ? AND id = ?", (user_id, device_id))
-    ip_address = c.fetchone()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT ip_address FROM devices WHERE user_id = ? AND id = ?", (user_id, device_id))
+        ip_address = c.fetchone()
     if ip_address:
         ip_address = ip_address[0]
         try:
-            async def control_plug():
-                plug = SmartPlug(ip_address)
-                await plug.update()
-                if action == 'on':
-                    await plug.turn_on()
-                else:
-                    await plug.turn_off()
-                return f"Dispositivo {device_id} {'encendido' if action == 'on' else 'apagado'}"
-            
-            message = asyncio.run(control_plug())
+            message = controlar_enchufe(device_id, ip_address, action)
             return jsonify({"message": message})
         except Exception as e:
             logging.error(f"Error al controlar dispositivo: {e}")
             return jsonify({"error": "Error al controlar dispositivo"}), 500
-    conn.close()
     return jsonify({"error": "Dispositivo no encontrado"}), 404
 
 @app.route('/delete_device', methods=['POST'])
@@ -1626,9 +2170,19 @@ def delete_device():
     conn = get_db_connection()
     c = conn.cursor()
     # Solo permite eliminar dispositivos del usuario autenticado
+    c.execute("SELECT ip_address FROM devices WHERE id = ? AND user_id = ?", (device_id, user_id))
+    row = c.fetchone()
     c.execute("DELETE FROM devices WHERE id = ? AND user_id = ?", (device_id, user_id))
+    c.execute("DELETE FROM device_snapshots WHERE device_id = ?", (device_id,))
     conn.commit()
     conn.close()
+    
+    # La conexión reutilizable de ese enchufe ya no sirve
+    if row:
+        pool_enchufes.invalidar(row[0])
+    
+    # Limpiar cache relacionado
+    invalidar_cache(f"user:{user_id}", f"device:{device_id}")
     return redirect(url_for('dispositivos'))
 
 @app.route('/add_plug', methods=['POST'])
@@ -1663,9 +2217,7 @@ def add_plug():
             conn.close()
             
             # Limpiar cache relacionado
-            clear_cache_pattern(f"devices_user_{user_id}")
-            clear_cache_pattern(f"energy_data_user_{receipt_number}")
-            clear_cache_pattern(f"dashboard_{receipt_number}")
+            invalidar_cache(f"user:{user_id}")
             
             # Obtener consumo estimado en background
             def get_consumption_async():
@@ -1715,11 +2267,10 @@ def reset_password():
         new_hashed_password = safe_generate_password_hash(new_password)
         
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("UPDATE users SET password = ? WHERE username = ?", (new_hashed_password, username))
-            conn.commit()
-            conn.close()
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("UPDATE users SET password = ? WHERE username = ?", (new_hashed_password, username))
+            invalidar_usuario(user[0])
             
             session['success_message'] = "Contraseña actualizada exitosamente. Ahora puedes iniciar sesión."
             return redirect(url_for('login'))
@@ -1775,14 +2326,15 @@ def complete_profile():
             conn.commit()
             conn.close()
             
+            # Limpiar cache (también lo asociado al recibo anterior)
+            invalidar_usuario(session['user_id'])
+            invalidar_cache(f"user:{session['user_id']}", f"receipt:{session.get('receipt_number')}",
+                            f"receipt:{receipt_number}")
+            
             # Actualizar sesión
             if receipt_number:
                 session['receipt_number'] = receipt_number
             
-            # Limpiar cache
-            clear_cache_pattern(f"user_google_{session.get('google_id')}")
-            clear_cache_pattern(f"user_email_{session.get('email')}")
-            
             session['success_message'] = "Perfil completado exitosamente."
             return redirect(url_for('dashboard'))
             
@@ -1818,26 +2370,177 @@ def clear_oauth_session():
 
 @app.route('/api/consumo_dispositivo/<int:device_id>')
 def api_consumo_dispositivo(device_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT ip_address FROM devices WHERE id = ?", (device_id,))
-    row = c.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT d.ip_address, s.failures, s.retry_at_ts
+                     FROM devices d LEFT JOIN device_snapshots s ON s.device_id = d.id
+                     WHERE d.id = ?""", (device_id,))
+        row = c.fetchone()
     if not row:
         return jsonify({"error": "Dispositivo no encontrado"}), 404
-    ip_address = row[0]
+    ip_address, fallos, reintentar_ts = row
+    ahora = int(time.time())
+    if not circuito_enchufes.permite_intento(fallos, reintentar_ts, ahora):
+        # Enchufe caído: responder de inmediato en lugar de esperar el timeout
+        return jsonify({"error": "El enchufe no responde", "reintentar_en": reintentar_ts - ahora}), 503
     try:
         async def get_consumption():
-            plug = SmartPlug(ip_address)
-            await plug.update()
-            consumo = plug.emeter_realtime.get("power", 0) / 1000  # kWh
+            async with pool_enchufes.usar(ip_address) as plug:
+                await plug.update()
+                consumo = plug.emeter_realtime.get("power", 0) / 1000  # kWh
             return round(consumo, 3)
         
-        consumo_actual = asyncio.run(get_consumption())
+        # Las lecturas simultáneas del mismo enchufe comparten la consulta en curso
+        with metricas.medir('enchufes'):
+            consumo_actual = bucle_async.ejecutar_compartido(f"consumo_{ip_address}", get_consumption,
+                                                             timeout=TIMEOUT_ENCHUFE_DIRECTO)
         return jsonify({"consumo_actual": consumo_actual})
     except Exception as e:
+        if isinstance(e, TimeoutError):
+            metricas.incrementar('enervirgil_enchufe_timeouts_total', origen='directa')
         return jsonify({"error": str(e)}), 500
 
+# Máximo de puntos por serie: bucket=60 durante un año eran 527.040 puntos (12 MB de JSON)
+SERIE_MAX_BUCKETS = 5000
+SEGUNDOS_BUCKET = {'hour': 3600, 'day': 86400, 'week': 7 * 86400, 'month': 28 * 86400}
+
+@app.route('/api/consumo_serie')
+def api_consumo_serie():
+    """
+    Serie de consumo para gráficos.
+    Parámetros: bucket (hour, day, week, month o segundos), dias (rango hacia atrás)
+    y device_id opcional (si no se indica, la serie es del usuario)
+    """
+    if 'username' not in session:
+        return jsonify({"error": "No autenticado"}), 401
+    user = get_user_by_receipt(session.get('receipt_number'))
+    if not user:
+        return jsonify({"error": "Usuario no encontrado"}), 404
+    
+    bucket = request.args.get('bucket', 'day')
+    if bucket.isdigit():
+        bucket = max(60, int(bucket))
+    elif bucket not in ('hour', 'day', 'week', 'month'):
+        return jsonify({"error": "Bucket inválido"}), 400
+    dias = min(max(request.args.get('dias', 7, type=int), 1), 366)
+    segundos_bucket = bucket if isinstance(bucket, int) else SEGUNDOS_BUCKET[bucket]
+    if dias * 86400 / segundos_bucket > SERIE_MAX_BUCKETS:
+        return jsonify({"error": f"Demasiados puntos: con bucket={request.args.get('bucket')} "
+                                 f"el máximo es {SERIE_MAX_BUCKETS * segundos_bucket // 86400} días",
+                        "max_buckets": SERIE_MAX_BUCKETS}), 400
+    device_id = request.args.get('device_id', type=int)
+    
+    conn = get_db_connection()
+    try:
+        ambito, ambito_id = 'user', user[0]
+        if device_id is not None:
+            c = conn.cursor()
+            c.execute("SELECT id FROM devices WHERE id = ? AND user_id = ?", (device_id, user[0]))
+            if not c.fetchone():
+                return jsonify({"error": "Dispositivo no encontrado"}), 404
+            ambito, ambito_id = 'device', device_id
+        fin = datetime.now(LIMA_TZ).replace(tzinfo=None)
+        if not isinstance(bucket, int):
+            # Incluir completo el bucket actual
+            fin = (fin + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        serie = agregados_consumo.serie_consumo(conn, ambito, ambito_id, fin - timedelta(days=dias), fin, bucket)
+    finally:
+        conn.close()
+    return jsonify(serie)
+
+def describir_duracion(segundos):
+    segundos = max(0, int(segundos))
+    if segundos < 60:
+        return f"{segundos} s"
+    if segundos < 3600:
+        return f"{segundos // 60} min"
+    if segundos < 86400:
+        return f"{segundos // 3600} h"
+    return f"{segundos // 86400} d"
+
+@app.template_filter('hace')
+def hace(ts):
+    """Describe cuánto hace de un momento en segundos epoch ("hace 3 min")"""
+    if ts is None:
+        return "nunca"
+    return f"hace {describir_duracion(time.time() - ts)}"
+
+@app.template_filter('dentro_de')
+def dentro_de(ts):
+    """Describe cuánto falta para un momento en segundos epoch ("en 3 min")"""
+    if ts is None:
+        return "ahora"
+    return f"en {describir_duracion(ts - time.time())}"
+
+# Endpoints de operación: solo con OPS_TOKEN configurado y enviado en la cabecera
+# X-Ops-Token (o como "Authorization: Bearer", que es lo que envía Prometheus)
+OPS_TOKEN = os.environ.get('OPS_TOKEN')
+
+def ops_autorizado():
+    token = request.headers.get('X-Ops-Token', '')
+    autorizacion = request.headers.get('Authorization', '')
+    if not token and autorizacion.startswith('Bearer '):
+        token = autorizacion[len('Bearer '):]
+    return bool(OPS_TOKEN) and hmac.compare_digest(token.encode(), OPS_TOKEN.encode())
+
+@app.route('/ops/cache')
+def ops_cache():
+    """Estadísticas de la cache del worker que atiende la petición"""
+    if not OPS_TOKEN:
+        return jsonify({"error": "No encontrado"}), 404
+    if not ops_autorizado():
+        return jsonify({"error": "No autorizado"}), 401
+    return jsonify(resumen_cache())
+
+@app.route('/ops/enchufes')
+def ops_enchufes():
+    """Concurrencia y colas del pool de enchufes del worker que atiende la petición"""
+    if not OPS_TOKEN:
+        return jsonify({"error": "No encontrado"}), 404
+    if not ops_autorizado():
+        return jsonify({"error": "No autorizado"}), 401
+    return jsonify({"pid": os.getpid(), **pool_enchufes.resumen()})
+
+def metricas_de_estado():
+    """Métricas que se leen al exponerlas: colas, pool de enchufes y cache del worker"""
+    pool = pool_enchufes.resumen()
+    cache = resumen_cache()
+    return [
+        ('enervirgil_executor_cola', 'gauge', 'Tareas esperando un hilo del executor de fondo',
+         [({}, executor._work_queue.qsize())]),
+        ('enervirgil_calculos_en_curso', 'gauge', 'Cálculos coalescidos (single-flight) en curso',
+         [({}, vuelo_unico.en_curso())]),
+        ('enervirgil_escritor_consumo_pendientes', 'gauge', 'Muestras de consumo esperando ser escritas',
+         [({}, escritor_consumo.pendientes())]),
+        ('enervirgil_escritor_consumo_descartadas_total', 'counter', 'Muestras descartadas por cola llena',
+         [({}, escritor_consumo.descartadas)]),
+        ('enervirgil_enchufes_en_curso', 'gauge', 'Consultas a enchufes en curso', [({}, pool['en_curso'])]),
+        ('enervirgil_enchufes_en_cola', 'gauge', 'Consultas a enchufes esperando turno', [({}, pool['en_cola'])]),
+        ('enervirgil_enchufes_esperas_total', 'counter', 'Consultas a enchufes que esperaron turno',
+         [({}, pool['esperas'])]),
+        ('enervirgil_enchufes_espera_segundos_total', 'counter', 'Tiempo total esperando turno para un enchufe',
+         [({}, pool['espera_total'])]),
+        ('enervirgil_enchufes_conexiones', 'gauge', 'Clientes de enchufes abiertos en el pool',
+         [({}, pool['conexiones'])]),
+        ('enervirgil_cache_eventos_total', 'counter', 'Eventos de la cache por espacio de claves',
+         [({'espacio': espacio, 'evento': evento}, datos[evento])
+          for espacio, datos in cache['espacios'].items() for evento in EstadisticasCache.EVENTOS]),
+        ('enervirgil_cache_entradas', 'gauge', 'Entradas en la cache por espacio de claves',
+         [({'espacio': espacio}, datos['entradas']) for espacio, datos in cache['espacios'].items()]),
+        ('enervirgil_cache_bytes', 'gauge', 'Bytes aproximados en la cache por espacio de claves',
+         [({'espacio': espacio}, datos['bytes']) for espacio, datos in cache['espacios'].items()]),
+    ]
+
+@app.route('/metrics')
+def metrics():
+    """Métricas del worker que atiende la petición, en formato de texto de Prometheus"""
+    if not OPS_TOKEN:
+        return jsonify({"error": "No encontrado"}), 404
+    if not ops_autorizado():
+        return jsonify({"error": "No autorizado"}), 401
+    return app.response_class(metricas.registro.exponer(metricas_de_estado()),
+                              content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/energy_data')
 def api_energy_data():
     if 'username' not in session:
@@ -2189,9 +2892,31 @@ def start_automation_scheduler():
     scheduler.add_job(check_automation_rules, 'interval', minutes=5)
     scheduler.start()
 
+def iniciar_worker():
+    """
+    Prepara un proceso worker recién creado (gunicorn lo llama en post_fork):
+    precarga las estimaciones de electrodomésticos guardadas en disco para que
+    las primeras peticiones tras un reciclaje no vuelvan a consultar Google, y
+    programa el registro periódico de las estadísticas de la cache.
+    Las últimas lecturas de los enchufes ya están en device_snapshots.
+    """
+    try:
+        cargadas = cargar_cache_persistente()
+        logging.info(f"Worker {os.getpid()}: {cargadas} estimaciones precargadas en cache")
+    except Exception as e:
+        logging.error(f"Error precargando la cache del worker: {e}")
+    
+    # Estadísticas de la cache en el log a intervalo fijo (0 lo desactiva)
+    minutos = int(os.environ.get('CACHE_LOG_MINUTOS', 15))
+    if minutos > 0:
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(registrar_resumen_cache, 'interval', minutes=minutos)
+        scheduler.start()
+
 if __name__ == '__main__':
     # Verificar y reportar usuarios con hash scrypt incompatible
     migrate_scrypt_passwords()
     
     start_automation_scheduler()
+    iniciar_worker()
     app.run(debug=True)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Benchmark de las rutas críticas de EnerVirgil
+
+Crea una base de datos temporal para cada tamaño, la llena con hogares
+sintéticos (generar_datos_sinteticos.py, misma semilla, mismos datos) y mide las funciones y rutas que más
+pesan en producción: generate_consumption_data, obtener_estadisticas_usuario,
+detalles_dispositivos, get_recommendations, obtener_consumo_local, login y
+dashboard (estas tres últimas rutas con el cliente de pruebas de Flask, con
+la cache vacía y con la cache caliente).
+
+Cada tamaño corre en un proceso aparte (app.py abre DB_PATH al importarse).
+No usa la red: las búsquedas de Google se precargan en cache_persistente y
+las lecturas de enchufes salen de device_snapshots recién escritos.
+
+Al final, los primeros enchufes de la base se apuntan a una flota simulada
+(simulador_enchufes.py, en un hilo) y se miden las rutas que hablan con los
+enchufes: un ciclo completo del poller, get_real_energy_data,
+controlar_enchufe y get_energy_data sobre los snapshots que deja el poller.
+Los enchufes sin simular quedan con el circuito abierto y el poller los
+salta, como a los enchufes caídos en producción.
+
+El resultado es JSON (por defecto en bench_output.txt) para comparar entre
+commits.
+
+Uso:
+    python benchmark_rendimiento.py                       # tamaños xs y s
+    python benchmark_rendimiento.py --tamanos xs,s,m,l    # hasta 10k usuarios y 10M muestras
+    python benchmark_rendimiento.py --repeticiones 50 --salida resultados.json
+    python benchmark_rendimiento.py --modo-enchufes puertos  # sin direcciones 127.x.y.z (macOS, Windows)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+import generar_datos_sinteticos
+
+# tamaño -> (usuarios, muestras de consumo, enchufes simulados)
+TAMANOS = {
+    'xs': (10, 1_000, 50),
+    's': (100, 100_000, 500),
+    'm': (1_000, 1_000_000, 2_000),
+    'l': (10_000, 10_000_000, 5_000),
+}
+DIAS_HISTORIAL = 90
+
+def resumir_tiempos(tiempos):
+    """Estadísticas en milisegundos de una lista de duraciones en segundos"""
+    ordenados = sorted(t * 1000 for t in tiempos)
+    return {
+        'n': len(ordenados),
+        'min_ms': round(ordenados[0], 3),
+        'mediana_ms': round(statistics.median(ordenados), 3),
+        'p95_ms': round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * 0.95))], 3),
+        'max_ms': round(ordenados[-1], 3),
+        'media_ms': round(statistics.fmean(ordenados), 3),
+    }
+
+def medir(funcion, repeticiones, preparar=None):
+    """
+    Ejecuta funcion(i) `repeticiones` veces (tras una de calentamiento) y
+    resume los tiempos; preparar(i), si se indica, corre antes de cada una
+    sin contar en la medición
+    """
+    if preparar:
+        preparar(0)
+    funcion(0)
+    tiempos = []
+    for i in range(repeticiones):
+        if preparar:
+            preparar(i)
+        inicio = time.perf_counter()
+        funcion(i)
+        tiempos.append(time.perf_counter() - inicio)
+    return resumir_tiempos(tiempos)
+
+def sembrar_base(db_path, usuarios, muestras, semilla=42):
+    """
+    Llena una base recién creada por init_db con hogares sintéticos
+    (generar_datos_sinteticos.py) y la deja lista para medir sin red
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        resumen = generar_datos_sinteticos.generar(conn, usuarios, dias=DIAS_HISTORIAL, muestras=muestras,
+                                                   semilla=semilla)
+        ahora = int(time.time())
+        # Snapshots recientes: la web no intenta releer enchufes que no existen
+        conn.execute("UPDATE device_snapshots SET read_ts = ?, checked_ts = ?", (ahora, ahora))
+        # Los fragmentos de Google de cada aparato ya están en la cache persistente
+        conn.executemany("INSERT OR REPLACE INTO cache_persistente (key, value, expires) VALUES (?, ?, ?)",
+                         ((f"google_fragmentos_{aparato}",
+                           json.dumps([f"<strong>{aparato}</strong><br>Fragmento de prueba"]), ahora + 86400)
+                          for aparato in generar_datos_sinteticos.APARATOS))
+    finally:
+        conn.close()
+    return resumen
+
+def subir_limite_archivos():
+    """Cada enchufe simulado usa hasta tres descriptores (servidor, conexión y cliente)"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    _, maximo = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (maximo, maximo))
+
+def medir_enchufes(aplicacion, db_path, cantidad, repeticiones, semilla, modo):
+    """
+    Apunta los primeros `cantidad` enchufes de la base a una flota simulada
+    y mide el poller, las lecturas directas y las órdenes de encendido
+    """
+    import bucle_async
+    import poller_telemetria
+    import simulador_enchufes
+
+    subir_limite_archivos()
+    simulador = simulador_enchufes.SimuladorEnchufes(cantidad, modo=modo, semilla=semilla).iniciar_en_hilo()
+    try:
+        simulador_enchufes.apuntar_db(db_path, simulador)
+        conn = sqlite3.connect(db_path)
+        simulados = conn.execute("SELECT id, user_id, ip_address FROM devices ORDER BY id LIMIT ?",
+                                 (cantidad,)).fetchall()
+        # El resto, con el circuito abierto hasta mañana: el poller no los espera
+        ahora = int(time.time())
+        conn.execute("""INSERT INTO device_snapshots (device_id, user_id, ip_address, error, checked_ts, failures,
+                                                      retry_at_ts)
+                        SELECT id, user_id, ip_address, 'sin simular', ?, 99, ? FROM devices
+                        ORDER BY id LIMIT -1 OFFSET ?""", (ahora, ahora + 86400, cantidad))
+        conn.commit()
+        conn.close()
+        aplicacion._cache.clear()
+
+        aleatorio = random.Random(semilla)
+        muestra = [aleatorio.choice(simulados) for _ in range(repeticiones + 1)]
+        recibo = lambda i: f"{100_000 + muestra[i][1]}"
+
+        def leer(i):
+            device_id, user_id, ip_address = muestra[i]
+            lectura = bucle_async.ejecutar(aplicacion.get_real_energy_data(device_id, ip_address, user_id,
+                                                                           usar_cache=False))
+            assert 'error' not in lectura, lectura
+
+        def ordenar(i):
+            device_id, _, ip_address = muestra[i]
+            aplicacion.controlar_enchufe(device_id, ip_address, 'on' if i % 2 else 'off')
+
+        ciclos = max(3, repeticiones // 4)
+        rutas = {
+            # El primer ciclo (calentamiento) abre las conexiones del pool, como el poller al arrancar
+            'poller_ciclo': medir(lambda i: bucle_async.ejecutar(poller_telemetria.ejecutar_ciclo()), ciclos),
+            'get_real_energy_data': medir(leer, repeticiones),
+            'controlar_enchufe': medir(ordenar, repeticiones),
+            'get_energy_data_frio': medir(lambda i: aplicacion.get_energy_data(recibo(i)), repeticiones,
+                                          lambda i: aplicacion._cache.clear()),
+        }
+        conn = sqlite3.connect(db_path)
+        leidos = conn.execute(f"""SELECT COUNT(*) FROM device_snapshots
+                                  WHERE error IS NULL AND device_id IN ({','.join('?' * len(simulados))})""",
+                              [device_id for device_id, _, _ in simulados]).fetchone()[0]
+        conn.close()
+        return rutas, {'enchufes': cantidad, 'enchufes_leidos': leidos, 'simulador': simulador.resumen()}
+    finally:
+        simulador.detener_hilo()
+
+def ejecutar_tamano(tamano, repeticiones, semilla, modo_enchufes='ips'):
+    """Siembra una base temporal y mide las rutas (dentro del proceso hijo)"""
+    usuarios, muestras, enchufes = TAMANOS[tamano]
+    directorio = tempfile.mkdtemp(prefix=f"bench_{tamano}_")
+    db_path = os.path.join(directorio, 'ener_virgil.db')
+    os.environ['DB_PATH'] = db_path
+    os.environ['CACHE_BACKEND'] = 'memoria'
+    logging.disable(logging.WARNING)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as aplicacion
+
+    inicio = time.perf_counter()
+    datos = sembrar_base(db_path, usuarios, muestras, semilla)
+    sembrado = time.perf_counter() - inicio
+    conn = sqlite3.connect(db_path)
+    primer_dispositivo = dict(conn.execute("SELECT user_id, MIN(id) FROM devices GROUP BY user_id"))
+    conn.close()
+
+    aleatorio = random.Random(semilla)
+    muestra_usuarios = [aleatorio.randint(1, usuarios) for _ in range(repeticiones + 1)]
+    recibo = lambda i: f"{100_000 + muestra_usuarios[i]}"
+    limpiar_cache = lambda i: aplicacion._cache.clear()
+
+    aplicacion.app.config['TESTING'] = True
+    cliente = aplicacion.app.test_client()
+
+    def iniciar_sesion(i):
+        user_id = muestra_usuarios[i]
+        with cliente.session_transaction() as sesion:
+            sesion['user_id'] = user_id
+            sesion['username'] = f"usuario{user_id}"
+            sesion['receipt_number'] = recibo(i)
+            sesion['auth_method'] = 'local'
+
+    def sesion_sin_cache(i):
+        iniciar_sesion(i)
+        aplicacion._cache.clear()
+
+    def pedir(ruta):
+        def funcion(i):
+            respuesta = cliente.get(ruta(i))
+            assert respuesta.status_code == 200, f"{ruta(i)}: {respuesta.status_code}"
+        return funcion
+
+    def login(i):
+        respuesta = cliente.post('/login', data={'username': f"usuario{muestra_usuarios[i]}",
+                                                 'password': generar_datos_sinteticos.CONTRASENA})
+        assert respuesta.status_code == 302, f"login: {respuesta.status_code}"
+
+    def detalle(i):
+        return f"/detalles_dispositivos?device_id={primer_dispositivo[muestra_usuarios[i]]}"
+
+    dispositivos_ejemplo = aplicacion.get_energy_data(recibo(0))
+    nombres = list(generar_datos_sinteticos.APARATOS) + ['enchufe del cuarto', 'Refrigerador LG', 'foco led sala']
+
+    casos = {
+        'generate_consumption_data': (lambda i: aplicacion.generate_consumption_data(recibo(i)), limpiar_cache),
+        'obtener_estadisticas_usuario': (lambda i: aplicacion.obtener_estadisticas_usuario(muestra_usuarios[i]), None),
+        'get_recommendations': (lambda i: aplicacion.get_recommendations(1.2, dispositivos_ejemplo, recibo(i)), None),
+        'obtener_consumo_local': (lambda i: [aplicacion.obtener_consumo_local(n) for n in nombres], None),
+        'login': (login, None),
+        'dashboard_frio': (pedir(lambda i: '/dashboard'), sesion_sin_cache),
+        'dashboard_caliente': (pedir(lambda i: '/dashboard'), iniciar_sesion),
+        'detalles_dispositivos_frio': (pedir(detalle), sesion_sin_cache),
+        'detalles_dispositivos_caliente': (pedir(detalle), iniciar_sesion),
+    }
+    rutas = {}
+    for nombre, (funcion, preparar) in casos.items():
+        # login es caro a propósito (pbkdf2): menos repeticiones
+        n = max(3, repeticiones // 4) if nombre == 'login' else repeticiones
+        rutas[nombre] = medir(funcion, n, preparar)
+
+    # Va al final: reasigna las IP de la base a la flota simulada
+    rutas_enchufes, flota = medir_enchufes(aplicacion, db_path, min(enchufes, datos['dispositivos']),
+                                           repeticiones, semilla, modo_enchufes)
+    rutas.update(rutas_enchufes)
+
+    return {
+        'tamano': tamano,
+        'usuarios': usuarios,
+        'dispositivos': datos['dispositivos'],
+        'muestras': datos['muestras'],
+        'sembrado_s': round(sembrado, 2),
+        'db_bytes': os.path.getsize(db_path),
+        'rutas': rutas,
+        **flota,
+    }
+
+def commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de rutas críticas de EnerVirgil")
+    parser.add_argument('--tamanos', default='xs,s', help=f"Tamaños separados por comas ({', '.join(TAMANOS)})")
+    parser.add_argument('--repeticiones', type=int, default=20, help="Mediciones por caso")
+    parser.add_argument('--semilla', type=int, default=42, help="Semilla de los datos y de la muestra de usuarios")
+    parser.add_argument('--salida', default='bench_output.txt', help="Archivo JSON de resultados")
+    parser.add_argument('--modo-enchufes', choices=('ips', 'puertos'), default='ips',
+                        help="Direcciones de la flota simulada: una IP 127.x.y.z por enchufe (Linux) "
+                             "o puertos de 127.0.0.1")
+    parser.add_argument('--hijo', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        try:
+            print(json.dumps(ejecutar_tamano(args.hijo, args.repeticiones, args.semilla, args.modo_enchufes)))
+        finally:
+            shutil.rmtree(os.path.dirname(os.environ.get('DB_PATH', '')), ignore_errors=True)
+        return 0
+
+    tamanos = [t.strip() for t in args.tamanos.split(',') if t.strip()]
+    desconocidos = [t for t in tamanos if t not in TAMANOS]
+    if desconocidos:
+        print(f"❌ Tamaños desconocidos: {', '.join(desconocidos)}")
+        return 1
+
+    print("⏱️ BENCHMARK DE ENERVIRGIL")
+    print("=" * 60)
+    resultados = []
+    for tamano in tamanos:
+        usuarios, muestras, enchufes = TAMANOS[tamano]
+        print(f"🔄 {tamano}: {usuarios} usuarios, {muestras:,} muestras, {enchufes} enchufes simulados...")
+        proceso = subprocess.run([sys.executable, os.path.abspath(__file__), '--hijo', tamano,
+                                  '--repeticiones', str(args.repeticiones), '--semilla', str(args.semilla),
+                                  '--modo-enchufes', args.modo_enchufes],
+                                 capture_output=True, text=True)
+        if proceso.returncode != 0:
+            print(f"❌ Falló el tamaño {tamano}:\n{proceso.stderr[-2000:]}")
+            return 1
+        resultado = json.loads(proceso.stdout.strip().splitlines()[-1])
+        resultados.append(resultado)
+        print(f"   Sembrado en {resultado['sembrado_s']}s; "
+              f"{resultado['enchufes_leidos']}/{resultado['enchufes']} enchufes simulados leídos por el poller")
+        for nombre, datos in resultado['rutas'].items():
+            print(f"   {nombre:32} mediana {datos['mediana_ms']:9.2f} ms   p95 {datos['p95_ms']:9.2f} ms")
+
+    informe = {
+        'commit': commit_actual(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'repeticiones': args.repeticiones,
+        'semilla': args.semilla,
+        'resultados': resultados,
+    }
+    with open(args.salida, 'w', encoding='utf-8') as archivo:
+        json.dump(informe, archivo, indent=2, ensure_ascii=False)
+    print("=" * 60)
+    print(f"✅ Resultados en {args.salida}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
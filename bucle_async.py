@@ -0,0 +1,95 @@
+"""
+Bucle asyncio persistente para EnerVirgil
+
+Mantiene un único event loop por proceso corriendo en un hilo en segundo
+plano. Las rutas de Flask (síncronas) le envían corrutinas y esperan el
+resultado con un tiempo límite, en lugar de crear y destruir un loop
+completo con asyncio.run() en cada petición.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+
+_loop = None
+_hilo = None
+_pid = None
+_lock = threading.Lock()
+
+# Operaciones en curso compartidas por clave (solo se usa desde el hilo del loop)
+_en_vuelo = {}
+
+def _ejecutar_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+def obtener_loop():
+    """
+    Devuelve el loop del proceso, arrancándolo la primera vez.
+    Con gunicorn (preload_app) cada worker hereda el módulo tras el fork,
+    así que el loop se crea de nuevo si el PID cambió.
+    """
+    global _loop, _hilo, _pid
+    with _lock:
+        if _loop is None or _pid != os.getpid() or not _hilo.is_alive():
+            _loop = asyncio.new_event_loop()
+            _hilo = threading.Thread(target=_ejecutar_loop, args=(_loop,),
+                                     name='bucle-async', daemon=True)
+            _hilo.start()
+            _pid = os.getpid()
+            _en_vuelo.clear()
+            logging.info(f"Bucle asyncio persistente iniciado (pid {_pid})")
+        return _loop
+
+def ejecutar(coro, timeout=None):
+    """
+    Ejecuta una corrutina en el loop persistente y espera su resultado.
+    Lanza TimeoutError si no termina dentro de `timeout` segundos.
+    """
+    futuro = asyncio.run_coroutine_threadsafe(coro, obtener_loop())
+    try:
+        return futuro.result(timeout)
+    except TimeoutError:
+        futuro.cancel()
+        raise
+
+def ejecutar_compartido(clave, fabrica, timeout=None):
+    """
+    Como ejecutar(), pero las peticiones concurrentes con la misma clave
+    comparten una sola operación en curso. `fabrica` es una función sin
+    argumentos que devuelve la corrutina a ejecutar.
+    """
+    return ejecutar(_compartida(clave, fabrica), timeout)
+
+def lanzar_compartido(clave, fabrica):
+    """
+    Como ejecutar_compartido(), pero sin esperar: la operación sigue en el
+    loop y sus errores solo se registran. Devuelve el Future concurrente.
+    """
+    futuro = asyncio.run_coroutine_threadsafe(_compartida(clave, fabrica), obtener_loop())
+
+    def registrar_error(f):
+        if not f.cancelled() and f.exception() is not None:
+            logging.error(f"Error en tarea en segundo plano {clave}: {f.exception()}")
+    futuro.add_done_callback(registrar_error)
+    return futuro
+
+def _compartida(clave, fabrica):
+    async def esperar_compartida():
+        tarea = _en_vuelo.get(clave)
+        if tarea is None:
+            tarea = asyncio.ensure_future(fabrica())
+            _en_vuelo[clave] = tarea
+
+            def liberar(t):
+                if _en_vuelo.get(clave) is t:
+                    del _en_vuelo[clave]
+                # Marca la excepción como recuperada aunque nadie siga esperando
+                if not t.cancelled():
+                    t.exception()
+            tarea.add_done_callback(liberar)
+        # shield: si un solicitante se rinde, la operación sigue para los demás
+        return await asyncio.shield(tarea)
+
+    return esperar_compartida()
@@ -0,0 +1,289 @@
+"""
+Cache compartida entre procesos para EnerVirgil
+
+Con varios workers de gunicorn, cada uno tenía su propia cache en memoria y
+repetía el mismo trabajo (dashboard, lecturas, búsquedas en Google). Esta
+cache guarda las entradas en un archivo SQLite local (modo WAL) que todos
+los workers del servidor comparten, sin servicios externos.
+
+Tiene la misma interfaz que cache_memoria.CacheLRU: TTL por entrada,
+etiquetas para invalidar, máximo de entradas y de bytes con descarte de las
+menos usadas. Los valores se guardan serializados con pickle. Un error del
+archivo de cache nunca interrumpe una petición: se trata como un fallo de
+cache y se registra.
+
+Los contadores de aciertos, fallos, etc. son de cada proceso; las entradas
+y bytes por espacio se miden sobre el archivo compartido.
+"""
+
+import os
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+
+from cache_memoria import EstadisticasCache
+
+class CacheSQLite:
+    """
+    Cache en un archivo SQLite compartido por todos los procesos.
+
+    ruta: archivo de la cache (distinto de la base de datos principal)
+    max_entradas, max_bytes, ttl, intervalo_barrido, espacios: como en CacheLRU
+    """
+
+    # Segundos entre actualizaciones del último uso de una entrada (para el LRU)
+    PRECISION_USO = 30
+
+    def __init__(self, ruta, max_entradas=5000, max_bytes=32 * 1024 * 1024, ttl=300, intervalo_barrido=60,
+                 espacios=()):
+        self.ruta = ruta
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.intervalo_barrido = intervalo_barrido
+        self._local = threading.local()
+        self._proximo_barrido = 0
+        self.estadisticas = EstadisticasCache(espacios)
+
+    def _conexion(self):
+        # Una conexión por hilo y por proceso (los workers nacen por fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.ruta, timeout=1, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("""CREATE TABLE IF NOT EXISTS cache_entries
+                        (key TEXT PRIMARY KEY,
+                         value BLOB NOT NULL,
+                         expires REAL NOT NULL,
+                         size INTEGER NOT NULL,
+                         last_used REAL NOT NULL)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS cache_tags
+                        (tag TEXT NOT NULL,
+                         key TEXT NOT NULL,
+                         PRIMARY KEY (tag, key)) WITHOUT ROWID""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_tags_key ON cache_tags(key)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_expires ON cache_entries(expires)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_last_used ON cache_entries(last_used)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, clave, defecto=None):
+        """Devuelve el valor vigente de la clave"""
+        ahora = time.time()
+        espacio = self.estadisticas.espacio_de(clave)
+        try:
+            conn = self._conexion()
+            fila = conn.execute("SELECT value, expires, last_used FROM cache_entries WHERE key = ?",
+                                (clave,)).fetchone()
+            if fila is None:
+                self.estadisticas.registrar(espacio, 'fallos')
+                return defecto
+            valor, expira, ultimo_uso = fila
+            if expira <= ahora:
+                self._quitar(conn, clave)
+                self.estadisticas.registrar(espacio, 'expiraciones')
+                self.estadisticas.registrar(espacio, 'fallos')
+                return defecto
+            if ahora - ultimo_uso > self.PRECISION_USO:
+                conn.execute("UPDATE cache_entries SET last_used = ? WHERE key = ?", (ahora, clave))
+            self.estadisticas.registrar(espacio, 'aciertos')
+            return pickle.loads(valor)
+        except Exception as e:
+            logging.warning(f"Cache compartida no disponible (lectura de {clave}): {e}")
+            return defecto
+
+    def set(self, clave, valor, ttl=None, etiquetas=()):
+        """Guarda un valor con su propio TTL (por defecto el de la cache) y sus etiquetas"""
+        ahora = time.time()
+        try:
+            datos = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logging.warning(f"Valor no serializable para la cache compartida ({clave}): {e}")
+            return
+        if len(datos) > self.max_bytes:
+            self.delete(clave)
+            return
+        try:
+            conn = self._conexion()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM cache_tags WHERE key = ?", (clave,))
+                conn.execute("INSERT OR REPLACE INTO cache_entries (key, value, expires, size, last_used) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (clave, sqlite3.Binary(datos), ahora + (self.ttl if ttl is None else ttl),
+                              len(datos), ahora))
+                conn.executemany("INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)",
+                                 [(etiqueta, clave) for etiqueta in set(etiquetas)])
+                if ahora >= self._proximo_barrido:
+                    self._barrer(conn, ahora)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self.estadisticas.registrar(self.estadisticas.espacio_de(clave), 'escrituras')
+        except Exception as e:
+            logging.warning(f"Cache compartida no disponible (escritura de {clave}): {e}")
+
+    def agregar(self, clave, valor, ttl=None):
+        """
+        Guarda el valor solo si la clave no tiene uno vigente, de forma atómica
+        entre procesos. Devuelve True si lo guardó.
+        """
+        ahora = time.time()
+        try:
+            datos = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+            conn = self._conexion()
+            cursor = conn.execute("""INSERT INTO cache_entries (key, value, expires, size, last_used)
+                                     VALUES (?, ?, ?, ?, ?)
+                                     ON CONFLICT(key) DO UPDATE SET
+                                         value = excluded.value, expires = excluded.expires,
+                                         size = excluded.size, last_used = excluded.last_used
+                                     WHERE cache_entries.expires <= ?""",
+                                  (clave, sqlite3.Binary(datos), ahora + (self.ttl if ttl is None else ttl),
+                                   len(datos), ahora, ahora))
+            if cursor.rowcount != 1:
+                return False
+            self.estadisticas.registrar(self.estadisticas.espacio_de(clave), 'escrituras')
+            return True
+        except Exception as e:
+            logging.warning(f"Cache compartida no disponible (reserva de {clave}): {e}")
+            # Sin cache compartida cada proceso calcula por su cuenta
+            return True
+
+    def delete(self, clave):
+        try:
+            if self._quitar(self._conexion(), clave):
+                self.estadisticas.registrar(self.estadisticas.espacio_de(clave), 'invalidaciones')
+        except Exception as e:
+            logging.warning(f"Cache compartida no disponible (borrado de {clave}): {e}")
+
+    def invalidar(self, *etiquetas):
+        """Elimina las entradas que llevan alguna de las etiquetas. Devuelve cuántas eran"""
+        if not etiquetas:
+            return 0
+        marcas = ','.join('?' * len(etiquetas))
+        try:
+            conn = self._conexion()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                claves = [fila[0] for fila in conn.execute(
+                    f"SELECT DISTINCT key FROM cache_tags WHERE tag IN ({marcas})", etiquetas)]
+                cursor = conn.execute(f"""DELETE FROM cache_entries WHERE key IN
+                                          (SELECT key FROM cache_tags WHERE tag IN ({marcas}))""", etiquetas)
+                eliminadas = cursor.rowcount
+                conn.execute(f"""DELETE FROM cache_tags WHERE key IN
+                                 (SELECT key FROM cache_tags WHERE tag IN ({marcas}))""", etiquetas)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            for clave in claves:
+                self.estadisticas.registrar(self.estadisticas.espacio_de(clave), 'invalidaciones')
+            return eliminadas
+        except Exception as e:
+            logging.warning(f"Cache compartida no disponible (invalidación): {e}")
+            return 0
+
+    def modificar(self, funcion, *etiquetas):
+        """
+        Reemplaza el valor de las entradas vigentes que llevan alguna de las
+        etiquetas por funcion(valor), sin tocar su expiración ni etiquetas.
+        Devuelve cuántas cambió
+        """
+        if not etiquetas:
+            return 0
+        marcas = ','.join('?' * len(etiquetas))
+        try:
+            conn = self._conexion()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                filas = conn.execute(f"""SELECT key, value FROM cache_entries
+                                         WHERE expires > ? AND key IN
+                                             (SELECT key FROM cache_tags WHERE tag IN ({marcas}))""",
+                                     (time.time(),) + etiquetas).fetchall()
+                for clave, valor in filas:
+                    datos = pickle.dumps(funcion(pickle.loads(valor)), protocol=pickle.HIGHEST_PROTOCOL)
+                    conn.execute("UPDATE cache_entries SET value = ?, size = ? WHERE key = ?",
+                                 (sqlite3.Binary(datos), len(datos), clave))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return len(filas)
+        except Exception as e:
+            logging.warning(f"Cache compartida no disponible (modificación): {e}")
+            return 0
+
+    def clear(self):
+        conn = self._conexion()
+        conn.execute("DELETE FROM cache_entries")
+        conn.execute("DELETE FROM cache_tags")
+
+    def barrer(self):
+        """Elimina las entradas vencidas y aplica los límites de tamaño"""
+        conn = self._conexion()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._barrer(conn, time.time())
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def resumen(self):
+        """Estadísticas por espacio de claves (ver EstadisticasCache.resumen)"""
+        tamanos = {}
+        try:
+            for clave, tamano in self._conexion().execute("SELECT key, size FROM cache_entries"):
+                espacio = self.estadisticas.espacio_de(clave)
+                entradas, total = tamanos.get(espacio, (0, 0))
+                tamanos[espacio] = (entradas + 1, total + tamano)
+        except Exception as e:
+            logging.warning(f"Cache compartida no disponible (resumen): {e}")
+        return self.estadisticas.resumen(tamanos)
+
+    def __len__(self):
+        return self._conexion().execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+    def __contains__(self, clave):
+        return self.get(clave) is not None
+
+    @property
+    def bytes(self):
+        return self._conexion().execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+
+    def _quitar(self, conn, clave):
+        borradas = conn.execute("DELETE FROM cache_entries WHERE key = ?", (clave,)).rowcount
+        conn.execute("DELETE FROM cache_tags WHERE key = ?", (clave,))
+        return borradas
+
+    def _barrer(self, conn, ahora):
+        # Dentro de la transacción del llamador
+        vencidas = [fila[0] for fila in conn.execute("SELECT key FROM cache_entries WHERE expires <= ?", (ahora,))]
+        conn.execute("DELETE FROM cache_tags WHERE key IN (SELECT key FROM cache_entries WHERE expires <= ?)",
+                     (ahora,))
+        conn.execute("DELETE FROM cache_entries WHERE expires <= ?", (ahora,))
+        for clave in vencidas:
+            self.estadisticas.registrar(self.estadisticas.espacio_de(clave), 'expiraciones')
+        cantidad, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        if cantidad > self.max_entradas or total > self.max_bytes:
+            # Descartar las menos usadas hasta quedar en el 90% de ambos límites
+            sobrantes = max(cantidad - int(self.max_entradas * 0.9), 0)
+            exceso = total - int(self.max_bytes * 0.9)
+            descartar = []
+            for clave, tamano in conn.execute("SELECT key, size FROM cache_entries ORDER BY last_used"):
+                if sobrantes <= 0 and exceso <= 0:
+                    break
+                descartar.append((clave,))
+                sobrantes -= 1
+                exceso -= tamano
+            conn.executemany("DELETE FROM cache_tags WHERE key = ?", descartar)
+            conn.executemany("DELETE FROM cache_entries WHERE key = ?", descartar)
+            for (clave,) in descartar:
+                self.estadisticas.registrar(self.estadisticas.espacio_de(clave), 'descartes')
+        self._proximo_barrido = ahora + self.intervalo_barrido
@@ -0,0 +1,250 @@
+"""
+Cache en memoria acotada (LRU + TTL) para EnerVirgil
+
+Cada entrada tiene su propio tiempo de vida. La cache tiene un máximo de
+entradas y un presupuesto aproximado de bytes; al superarse se descartan las
+entradas usadas hace más tiempo. Las entradas vencidas se eliminan al leerlas
+y, además, con un barrido periódico, de modo que la memoria del worker no
+crece con la cantidad de usuarios.
+
+Las entradas pueden llevar etiquetas con las entidades de las que dependen
+(usuario, dispositivo, recibo); invalidar una etiqueta elimina exactamente
+sus entradas, sin recorrer la cache completa. modificar() cambia en sitio el
+valor de las entradas de una etiqueta (p. ej. para marcarlas vencidas).
+
+Cada cache lleva estadísticas por espacio de claves (prefijo como
+"dashboard_" o "user_receipt_"): aciertos, fallos, expiraciones, descartes,
+invalidaciones, escrituras, entradas y bytes aproximados.
+"""
+
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+def estimar_tamano(valor, _profundidad=0):
+    """Tamaño aproximado en bytes de un valor (recorre contenedores hasta 4 niveles)"""
+    tamano = sys.getsizeof(valor)
+    if _profundidad >= 4:
+        return tamano
+    if isinstance(valor, dict):
+        for clave, item in valor.items():
+            tamano += estimar_tamano(clave, _profundidad + 1) + estimar_tamano(item, _profundidad + 1)
+    elif isinstance(valor, (list, tuple, set, frozenset)):
+        for item in valor:
+            tamano += estimar_tamano(item, _profundidad + 1)
+    return tamano
+
+class EstadisticasCache:
+    """
+    Contadores por espacio de claves, seguros entre hilos.
+
+    espacios: prefijos de clave conocidos; una clave pertenece al prefijo más
+              largo con que empieza y, si no coincide ninguno, a "otros"
+    """
+
+    EVENTOS = ('aciertos', 'fallos', 'expiraciones', 'descartes', 'invalidaciones', 'escrituras')
+
+    def __init__(self, espacios=()):
+        self.espacios = sorted(espacios, key=len, reverse=True)
+        self._contadores = {}
+        self._tamanos = {}  # espacio -> [entradas, bytes]
+        self._lock = threading.Lock()
+
+    def espacio_de(self, clave):
+        for prefijo in self.espacios:
+            if clave.startswith(prefijo):
+                return prefijo.rstrip('_')
+        return 'otros'
+
+    def registrar(self, espacio, evento, cantidad=1):
+        with self._lock:
+            contadores = self._contadores.get(espacio)
+            if contadores is None:
+                contadores = self._contadores[espacio] = dict.fromkeys(self.EVENTOS, 0)
+            contadores[evento] += cantidad
+
+    def ajustar_tamano(self, espacio, entradas, tamano):
+        with self._lock:
+            actual = self._tamanos.setdefault(espacio, [0, 0])
+            actual[0] += entradas
+            actual[1] += tamano
+
+    def reiniciar_tamanos(self):
+        with self._lock:
+            self._tamanos.clear()
+
+    def resumen(self, tamanos=None):
+        """
+        Devuelve {espacio: {eventos..., entradas, bytes, tasa_aciertos}}.
+        tamanos: {espacio: (entradas, bytes)} medido por el backend; por
+                 defecto, el llevado con ajustar_tamano()
+        """
+        with self._lock:
+            contadores = {espacio: dict(valores) for espacio, valores in self._contadores.items()}
+            if tamanos is None:
+                tamanos = {espacio: tuple(valores) for espacio, valores in self._tamanos.items()}
+        resumen = {}
+        for espacio in set(contadores) | set(tamanos):
+            datos = contadores.get(espacio) or dict.fromkeys(self.EVENTOS, 0)
+            datos['entradas'], datos['bytes'] = tamanos.get(espacio, (0, 0))
+            consultas = datos['aciertos'] + datos['fallos']
+            datos['tasa_aciertos'] = round(datos['aciertos'] / consultas, 3) if consultas else None
+            resumen[espacio] = datos
+        return resumen
+
+class CacheLRU:
+    """
+    Cache LRU con TTL por entrada.
+
+    max_entradas: número máximo de claves
+    max_bytes: presupuesto aproximado de memoria para los valores
+    ttl: tiempo de vida por defecto en segundos
+    intervalo_barrido: segundos mínimos entre barridos de entradas vencidas
+    espacios: prefijos de clave para las estadísticas (ver EstadisticasCache)
+    """
+
+    def __init__(self, max_entradas=5000, max_bytes=32 * 1024 * 1024, ttl=300, intervalo_barrido=60,
+                 espacios=()):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.intervalo_barrido = intervalo_barrido
+        self.bytes = 0
+        # clave -> (valor, expira, tamaño, etiquetas); el orden es de menos a más reciente
+        self._entradas = OrderedDict()
+        # etiqueta -> claves que la llevan
+        self._por_etiqueta = {}
+        self._lock = threading.Lock()
+        self._proximo_barrido = time.monotonic() + intervalo_barrido
+        self.estadisticas = EstadisticasCache(espacios)
+
+    def get(self, clave, defecto=None):
+        """Devuelve el valor vigente de la clave (y la marca como usada)"""
+        ahora = time.monotonic()
+        espacio = self.estadisticas.espacio_de(clave)
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.estadisticas.registrar(espacio, 'fallos')
+                return defecto
+            if entrada[1] <= ahora:
+                self._quitar(clave, 'expiraciones')
+                self.estadisticas.registrar(espacio, 'fallos')
+                return defecto
+            self._entradas.move_to_end(clave)
+            self.estadisticas.registrar(espacio, 'aciertos')
+            return entrada[0]
+
+    def set(self, clave, valor, ttl=None, etiquetas=()):
+        """Guarda un valor con su propio TTL (por defecto el de la cache) y sus etiquetas"""
+        ahora = time.monotonic()
+        tamano = estimar_tamano(valor)
+        if tamano > self.max_bytes:
+            # Nunca cabría: no desplazar toda la cache por un valor
+            self.delete(clave)
+            return
+        with self._lock:
+            self._guardar(clave, valor, ttl, etiquetas, tamano, ahora)
+
+    def agregar(self, clave, valor, ttl=None):
+        """Guarda el valor solo si la clave no tiene uno vigente. Devuelve True si lo guardó"""
+        ahora = time.monotonic()
+        tamano = estimar_tamano(valor)
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada[1] > ahora:
+                return False
+            self._guardar(clave, valor, ttl, (), tamano, ahora)
+            return True
+
+    def _guardar(self, clave, valor, ttl, etiquetas, tamano, ahora):
+        # Con el lock tomado
+        if clave in self._entradas:
+            self._quitar(clave)
+        etiquetas = frozenset(etiquetas)
+        self._entradas[clave] = (valor, ahora + (self.ttl if ttl is None else ttl), tamano, etiquetas)
+        self.bytes += tamano
+        for etiqueta in etiquetas:
+            self._por_etiqueta.setdefault(etiqueta, set()).add(clave)
+        espacio = self.estadisticas.espacio_de(clave)
+        self.estadisticas.registrar(espacio, 'escrituras')
+        self.estadisticas.ajustar_tamano(espacio, 1, tamano)
+        if ahora >= self._proximo_barrido:
+            self._barrer(ahora)
+        while len(self._entradas) > self.max_entradas or self.bytes > self.max_bytes:
+            self._quitar(next(iter(self._entradas)), 'descartes')
+
+    def delete(self, clave):
+        with self._lock:
+            if clave in self._entradas:
+                self._quitar(clave, 'invalidaciones')
+
+    def invalidar(self, *etiquetas):
+        """Elimina las entradas que llevan alguna de las etiquetas. Devuelve cuántas eran"""
+        eliminadas = 0
+        with self._lock:
+            for etiqueta in etiquetas:
+                for clave in list(self._por_etiqueta.get(etiqueta, ())):
+                    self._quitar(clave, 'invalidaciones')
+                    eliminadas += 1
+        return eliminadas
+
+    def modificar(self, funcion, *etiquetas):
+        """
+        Reemplaza el valor de las entradas que llevan alguna de las etiquetas
+        por funcion(valor), sin tocar su expiración, etiquetas ni tamaño
+        estimado (pensado para cambios pequeños, como marcarlas vencidas).
+        Devuelve cuántas cambió
+        """
+        modificadas = 0
+        with self._lock:
+            claves = set()
+            for etiqueta in etiquetas:
+                claves.update(self._por_etiqueta.get(etiqueta, ()))
+            for clave in claves:
+                valor, expira, tamano, etiquetas_entrada = self._entradas[clave]
+                self._entradas[clave] = (funcion(valor), expira, tamano, etiquetas_entrada)
+                modificadas += 1
+        return modificadas
+
+    def clear(self):
+        with self._lock:
+            self._entradas.clear()
+            self._por_etiqueta.clear()
+            self.bytes = 0
+            self.estadisticas.reiniciar_tamanos()
+
+    def barrer(self):
+        """Elimina todas las entradas vencidas"""
+        with self._lock:
+            self._barrer(time.monotonic())
+
+    def resumen(self):
+        """Estadísticas por espacio de claves (ver EstadisticasCache.resumen)"""
+        return self.estadisticas.resumen()
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def __contains__(self, clave):
+        return self.get(clave) is not None
+
+    def _quitar(self, clave, motivo=None):
+        _, _, tamano, etiquetas = self._entradas.pop(clave)
+        self.bytes -= tamano
+        espacio = self.estadisticas.espacio_de(clave)
+        self.estadisticas.ajustar_tamano(espacio, -1, -tamano)
+        if motivo:
+            self.estadisticas.registrar(espacio, motivo)
+        for etiqueta in etiquetas:
+            claves = self._por_etiqueta[etiqueta]
+            claves.discard(clave)
+            if not claves:
+                del self._por_etiqueta[etiqueta]
+
+    def _barrer(self, ahora):
+        vencidas = [clave for clave, (_, expira, _, _) in self._entradas.items() if expira <= ahora]
+        for clave in vencidas:
+            self._quitar(clave, 'expiraciones')
+        self._proximo_barrido = ahora + self.intervalo_barrido
@@ -0,0 +1,49 @@
+"""
+Cortacircuitos (circuit breaker) por enchufe para EnerVirgil
+
+Un enchufe apagado o desconectado hacía esperar el timeout completo en cada
+sondeo y en cada lectura directa. Tras UMBRAL_FALLOS lecturas fallidas
+seguidas el circuito se abre y nadie vuelve a intentarlo hasta reintentar_ts;
+el plazo crece de forma exponencial con cada fallo, con variación aleatoria
+(jitter) para que los enchufes caídos a la vez no se reintenten a la vez.
+Cuando vence el plazo se permite un intento de prueba (semiabierto): si
+funciona el circuito se cierra, si falla se vuelve a abrir con más espera.
+
+El estado vive en device_snapshots (failures, retry_at_ts) para que el
+poller y los workers web lo compartan.
+"""
+
+import os
+import random
+
+UMBRAL_FALLOS = int(os.environ.get('PLUG_CIRCUITO_FALLOS', 3))
+ESPERA_BASE = int(os.environ.get('PLUG_CIRCUITO_ESPERA_BASE', 30))  # segundos
+ESPERA_MAXIMA = int(os.environ.get('PLUG_CIRCUITO_ESPERA_MAXIMA', 3600))  # segundos
+
+CERRADO = 'cerrado'
+ABIERTO = 'abierto'
+SEMIABIERTO = 'semiabierto'
+
+def espera_tras_fallos(fallos, aleatorio=random.random):
+    """Segundos hasta el siguiente intento tras `fallos` fallos seguidos (0 si el circuito sigue cerrado)"""
+    if fallos < UMBRAL_FALLOS:
+        return 0
+    espera = min(ESPERA_MAXIMA, ESPERA_BASE * 2 ** (fallos - UMBRAL_FALLOS))
+    # Jitter: entre la mitad y el total de la espera
+    return int(espera * (0.5 + aleatorio() / 2))
+
+def proximo_intento(fallos, ahora):
+    """Momento (epoch) del siguiente intento permitido, o None si el circuito está cerrado"""
+    espera = espera_tras_fallos(fallos)
+    return ahora + espera if espera else None
+
+def estado(fallos, reintentar_ts, ahora):
+    """Estado del circuito de un enchufe"""
+    if not fallos or fallos < UMBRAL_FALLOS:
+        return CERRADO
+    if reintentar_ts is not None and ahora < reintentar_ts:
+        return ABIERTO
+    return SEMIABIERTO
+
+def permite_intento(fallos, reintentar_ts, ahora):
+    return estado(fallos, reintentar_ts, ahora) != ABIERTO
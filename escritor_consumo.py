@@ -0,0 +1,152 @@
+"""
+Escritor diferido (write-behind) de muestras de consumo para EnerVirgil
+
+Las lecturas se encolan en memoria y un único hilo escritor las inserta en
+lotes con executemany, en una sola transacción por vaciado (por tamaño o
+por tiempo). Así miles de commits por minuto se convierten en unos pocos.
+"""
+
+import os
+import queue
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+_FIN = object()
+
+def _en_bucle_async():
+    """True si el hilo actual está ejecutando un bucle de asyncio"""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+class EscritorConsumo:
+    """
+    Cola acotada de muestras de consumo con un hilo escritor.
+
+    abrir_conexion: función que devuelve una conexión sqlite3
+    max_lote: número de muestras que fuerza un vaciado
+    intervalo: segundos máximos que una muestra espera en la cola
+    max_cola: tamaño máximo de la cola; al llenarse, encolar() espera
+              hasta espera_cola segundos (contrapresión) y luego descarta.
+              Desde un bucle de asyncio nunca espera: descarta al momento
+              para no congelar el bucle (lecturas, órdenes y timeouts)
+    al_escribir: función opcional (conn, lote) ejecutada dentro de la misma
+                 transacción que inserta el lote
+    al_confirmar: función opcional (lote) ejecutada tras confirmar el lote
+    """
+
+    def __init__(self, abrir_conexion, max_lote=500, intervalo=2.0, max_cola=10000, espera_cola=1.0,
+                 al_escribir=None, al_confirmar=None):
+        self.abrir_conexion = abrir_conexion
+        self.al_escribir = al_escribir
+        self.al_confirmar = al_confirmar
+        self.max_lote = max_lote
+        self.intervalo = intervalo
+        self.espera_cola = espera_cola
+        self.descartadas = 0
+        self.escritas = 0
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._hilo = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.detener)
+
+    def _asegurar_hilo(self):
+        # Tras un fork (gunicorn) el hilo del proceso padre no existe en el hijo
+        if self._hilo is not None and self._pid == os.getpid() and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._hilo is None or self._pid != os.getpid() or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._ejecutar, name='escritor-consumo', daemon=True)
+                self._pid = os.getpid()
+                self._hilo.start()
+
+    def encolar(self, user_id, device_id, consumption_kwh, ts=None):
+        """
+        Encola una muestra (ts en segundos epoch, por defecto ahora).
+        Devuelve False si se descartó por cola llena.
+        """
+        self._asegurar_hilo()
+        muestra = (user_id, device_id, consumption_kwh, int(time.time()) if ts is None else ts)
+        try:
+            if _en_bucle_async():
+                self._cola.put_nowait(muestra)
+            else:
+                self._cola.put(muestra, timeout=self.espera_cola)
+            return True
+        except queue.Full:
+            self.descartadas += 1
+            logging.warning(f"Cola de consumo llena, muestra descartada (total descartadas: {self.descartadas})")
+            return False
+
+    def vaciar(self):
+        """Espera a que todas las muestras encoladas estén escritas"""
+        if self._hilo is not None and self._hilo.is_alive():
+            self._cola.join()
+
+    def detener(self):
+        """Escribe lo pendiente y termina el hilo escritor"""
+        if self._hilo is None or self._pid != os.getpid() or not self._hilo.is_alive():
+            return
+        self._cola.put(_FIN)
+        self._hilo.join(timeout=30)
+
+    def pendientes(self):
+        return self._cola.qsize()
+
+    def _ejecutar(self):
+        conn = self.abrir_conexion()
+        try:
+            terminar = False
+            while not terminar:
+                lote = []
+                primera = self._cola.get()
+                if primera is _FIN:
+                    self._cola.task_done()
+                    break
+                lote.append(primera)
+
+                # Acumular hasta llenar el lote o agotar el intervalo
+                limite = time.monotonic() + self.intervalo
+                while len(lote) < self.max_lote:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    try:
+                        muestra = self._cola.get(timeout=restante)
+                    except queue.Empty:
+                        break
+                    if muestra is _FIN:
+                        self._cola.task_done()
+                        terminar = True
+                        break
+                    lote.append(muestra)
+
+                self._escribir(conn, lote)
+                for _ in lote:
+                    self._cola.task_done()
+        finally:
+            conn.close()
+
+    def _escribir(self, conn, lote):
+        try:
+            conn.executemany("INSERT INTO consumption (user_id, device_id, consumption_kwh, ts) VALUES (?, ?, ?, ?)",
+                             lote)
+            if self.al_escribir:
+                self.al_escribir(conn, lote)
+            conn.commit()
+            self.escritas += len(lote)
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error guardando lote de {len(lote)} muestras de consumo: {e}")
+            return
+        if self.al_confirmar:
+            try:
+                self.al_confirmar(lote)
+            except Exception as e:
+                logging.error(f"Error tras guardar lote de consumo: {e}")
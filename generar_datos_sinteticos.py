@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Generador de datos sintéticos de consumo para EnerVirgil
+
+Llena users, devices, consumption y device_snapshots con hogares realistas
+para reproducir en local los problemas de escala:
+
+- Cada hogar tiene una mezcla de aparatos de CONSUMOS_TIPICOS (app.py),
+  elegidos según lo común que es cada uno.
+- Cada aparato sigue una curva diaria según su uso (continuo con ciclos de
+  compresor, noche, día, comidas, mañana y noche, tarde u ocasional) con un
+  consumo en espera (standby), y su energía diaria media coincide con la de
+  CONSUMOS_TIPICOS.
+- Hay huecos (enchufe sin conexión unas horas) y cortes de luz (todo el
+  hogar sin muestras).
+
+Las muestras guardan la potencia leída en kW, igual que el poller. Con la
+misma semilla y la misma fecha final (--hasta) el resultado es idéntico.
+Para escribir decenas de millones de filas rápido, los índices de
+consumption se quitan durante la carga, las filas se insertan por lotes en
+una sola transacción y los índices y agregados se reconstruyen al final.
+
+Uso:
+    DB_PATH=prueba.db python generar_datos_sinteticos.py --usuarios 1000 --dias 90
+    DB_PATH=prueba.db python generar_datos_sinteticos.py --usuarios 10000 --muestras 10000000 --semilla 7
+    DB_PATH=prueba.db python generar_datos_sinteticos.py --usuarios 50 --intervalo 5 --hasta 2024-06-30
+"""
+
+import sys
+import time
+import random
+import sqlite3
+import argparse
+from datetime import datetime
+
+import pytz
+
+LIMA_TZ = pytz.timezone('America/Lima')
+DESFASE_LIMA = -5 * 3600  # Lima no tiene horario de verano
+
+# Peso relativo de cada hora del día (hora local); se normaliza a media 1
+PERFILES = {
+    'continuo': [1] * 24,
+    'noche': [0.1] * 6 + [0.3] * 12 + [2, 3, 3, 3, 2, 1],
+    'dia': [0] * 8 + [1.5] * 10 + [0.5] * 6,
+    'comidas': [0] * 6 + [1, 2, 1] + [0] * 3 + [2, 2, 0.5] + [0] * 4 + [1, 2, 1] + [0] * 2,
+    'manana_noche': [0] * 5 + [2, 3, 2] + [0] * 10 + [1, 2, 2, 1] + [0] * 2,
+    'tarde': [0.2] * 10 + [1, 2, 3, 3, 3, 2, 1, 0.5] + [0.2] * 6,
+    'ocasional': [0] * 8 + [1] * 12 + [0] * 4,
+}
+
+# aparato -> (probabilidad de que un hogar lo tenga, perfil, fracción en espera)
+APARATOS = {
+    'refrigerador': (0.95, 'continuo', 0.0),
+    'televisor': (0.9, 'noche', 0.03),
+    'router': (0.85, 'continuo', 0.0),
+    'foco led': (0.7, 'noche', 0.0),
+    'laptop': (0.6, 'dia', 0.02),
+    'microondas': (0.6, 'comidas', 0.02),
+    'lavadora': (0.6, 'ocasional', 0.01),
+    'cargador': (0.5, 'noche', 0.05),
+    'terma': (0.4, 'manana_noche', 0.01),
+    'ventilador': (0.4, 'tarde', 0.0),
+    'computadora': (0.3, 'dia', 0.03),
+    'hervidor': (0.3, 'comidas', 0.0),
+    'plancha': (0.3, 'ocasional', 0.0),
+    'consola': (0.2, 'noche', 0.05),
+    'monitor': (0.2, 'dia', 0.03),
+    'aire acondicionado': (0.1, 'tarde', 0.01),
+}
+
+# Días de uso por semana de los aparatos ocasionales
+PROBABILIDAD_USO_OCASIONAL = 2 / 7
+# Probabilidad diaria de un hueco por enchufe y de un corte de luz por hogar
+PROBABILIDAD_HUECO = 0.02
+PROBABILIDAD_CORTE = 0.01
+LOTE = 50_000
+# Contraseña de todos los usuarios generados (usuarioN / sintetico)
+CONTRASENA = 'sintetico'
+
+NOMBRES = ('Ana', 'Luis', 'María', 'José', 'Rosa', 'Carlos', 'Lucía', 'Jorge', 'Carmen', 'Miguel')
+APELLIDOS = ('Quispe', 'Flores', 'Rojas', 'García', 'Mendoza', 'Huamán', 'Torres', 'Castillo', 'Vargas', 'Ramos')
+
+def perfil_normalizado(nombre):
+    pesos = PERFILES[nombre]
+    media = sum(pesos) / len(pesos)
+    return [p / media for p in pesos]
+
+def catalogo_aparatos():
+    """Aparatos con su consumo típico (kWh/día) tomado de CONSUMOS_TIPICOS"""
+    from app import CONSUMOS_TIPICOS
+    return {nombre: (probabilidad, perfil, espera, CONSUMOS_TIPICOS[nombre])
+            for nombre, (probabilidad, perfil, espera) in APARATOS.items()}
+
+def elegir_aparatos(aleatorio, catalogo):
+    """Mezcla de aparatos de un hogar (al menos uno)"""
+    elegidos = [nombre for nombre, (probabilidad, _, _, _) in catalogo.items() if aleatorio.random() < probabilidad]
+    return elegidos or [aleatorio.choice(list(catalogo))]
+
+def intervalos_sin_datos(aleatorio, inicio, dias, probabilidad, horas_max):
+    """Periodos [desde, hasta) sin muestras: en cada día, con `probabilidad`, uno de 1 a horas_max horas"""
+    intervalos = []
+    for dia in range(dias):
+        if aleatorio.random() < probabilidad:
+            desde = inicio + dia * 86400 + aleatorio.randrange(86400)
+            intervalos.append((desde, desde + aleatorio.randint(1, horas_max) * 3600))
+    return intervalos
+
+def muestras_aparato(aleatorio, catalogo, nombre, inicio, fin, intervalo, sin_datos):
+    """Genera (ts, kW) de un aparato entre inicio y fin, saltando los periodos sin datos"""
+    _, perfil, espera, kwh_dia = catalogo[nombre]
+    pesos = perfil_normalizado(perfil)
+    media_kw = kwh_dia / 24
+    espera_kw = media_kw * espera
+    activo_kw = media_kw - espera_kw
+    ocasional = perfil == 'ocasional'
+    if ocasional:
+        activo_kw /= PROBABILIDAD_USO_OCASIONAL
+    ciclo = perfil == 'continuo' and nombre == 'refrigerador'
+
+    sin_datos = sorted(sin_datos)
+    indice_hueco = 0
+    dia_actual, usa_hoy = None, True
+    uniforme, azar = aleatorio.uniform, aleatorio.random
+    ts = inicio
+    while ts < fin:
+        while indice_hueco < len(sin_datos) and sin_datos[indice_hueco][1] <= ts:
+            indice_hueco += 1
+        if indice_hueco < len(sin_datos) and sin_datos[indice_hueco][0] <= ts:
+            ts = sin_datos[indice_hueco][1]
+            continue
+        local = int(ts) + DESFASE_LIMA
+        if ocasional:
+            dia = local // 86400
+            if dia != dia_actual:
+                dia_actual, usa_hoy = dia, azar() < PROBABILIDAD_USO_OCASIONAL
+        peso = pesos[local // 3600 % 24] if usa_hoy else 0.0
+        if ciclo:
+            # Compresor: funciona ~40% del tiempo a 2.5 veces la potencia media
+            potencia = activo_kw * 2.5 if azar() < 0.4 else activo_kw * 0.05
+        else:
+            potencia = espera_kw + activo_kw * peso * uniforme(0.7, 1.3)
+        yield int(ts), round(potencia, 4)
+        ts += intervalo
+
+def indices_de(conn, tabla):
+    return [(nombre, sql) for nombre, sql in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (tabla,))]
+
+def generar(conn, usuarios, dias=90, intervalo_min=15.0, muestras=None, semilla=42, hasta=None,
+            agregados=True, progreso=None):
+    """
+    Genera `usuarios` hogares con los `dias` de historial anteriores a la
+    fecha `hasta` (por defecto hoy) en la conexión sqlite3 `conn`, cuyo esquema ya creó
+    init_db. Si se indica `muestras`, el intervalo entre muestras se ajusta
+    para acercarse a ese total. Devuelve un resumen con los totales.
+    """
+    catalogo = catalogo_aparatos()
+    if hasta is None:
+        hasta = datetime.now(LIMA_TZ).date()
+    fin = int(LIMA_TZ.localize(datetime.combine(hasta, datetime.min.time())).timestamp())
+    inicio = fin - dias * 86400
+
+    c = conn.cursor()
+    primer_usuario = (c.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0] or 0) + 1
+    primer_dispositivo = (c.execute("SELECT COALESCE(MAX(id), 0) FROM devices").fetchone()[0] or 0) + 1
+
+    # Hogares y aparatos primero: el intervalo puede depender del total de enchufes
+    hogares = []
+    device_id = primer_dispositivo
+    for user_id in range(primer_usuario, primer_usuario + usuarios):
+        aleatorio_hogar = random.Random(f"{semilla}-{user_id}")
+        aparatos = []
+        for nombre in elegir_aparatos(aleatorio_hogar, catalogo):
+            aparatos.append((device_id, nombre))
+            device_id += 1
+        hogares.append((user_id, aleatorio_hogar, aparatos))
+    total_dispositivos = device_id - primer_dispositivo
+    if muestras:
+        intervalo = max(1.0, dias * 86400 * total_dispositivos / muestras)
+    else:
+        intervalo = intervalo_min * 60
+
+    from werkzeug.security import generate_password_hash
+    contrasena = generate_password_hash(CONTRASENA, method='pbkdf2:sha256')
+    columnas_usuario = {fila[1] for fila in c.execute("PRAGMA table_info(users)")}
+    con_fecha = 'created_at' in columnas_usuario
+    fecha_alta = datetime.fromtimestamp(inicio, LIMA_TZ).strftime('%Y-%m-%d %H:%M:%S')
+
+    indices = indices_de(conn, 'consumption')
+    c.execute("PRAGMA synchronous=OFF")
+    inicio_carga = time.perf_counter()
+    c.execute("BEGIN")
+    try:
+        for nombre, _ in indices:
+            c.execute(f"DROP INDEX {nombre}")
+
+        c.executemany(
+            "INSERT INTO users (id, username, full_name, phone, dni, receipt_number, password"
+            + (", created_at" if con_fecha else "") + ") VALUES (?, ?, ?, ?, ?, ?, ?" + (", ?" if con_fecha else "") + ")",
+            ((user_id, f"usuario{user_id}",
+              f"{aleatorio_hogar.choice(NOMBRES)} {aleatorio_hogar.choice(APELLIDOS)}",
+              f"9{user_id:08d}", f"{10_000_000 + user_id}", f"{100_000 + user_id}", contrasena)
+             + ((fecha_alta,) if con_fecha else ())
+             for user_id, aleatorio_hogar, _ in hogares))
+        c.executemany("INSERT INTO devices (id, user_id, name, ip_address, created_at) VALUES (?, ?, ?, ?, ?)",
+                      ((device_id, user_id, nombre,
+                        f"10.{device_id >> 16 & 255}.{device_id >> 8 & 255}.{device_id & 255}", fecha_alta)
+                       for user_id, _, aparatos in hogares for device_id, nombre in aparatos))
+
+        ultimas = {}
+        total = 0
+
+        def filas():
+            for user_id, aleatorio_hogar, aparatos in hogares:
+                cortes = intervalos_sin_datos(aleatorio_hogar, inicio, dias, PROBABILIDAD_CORTE, 4)
+                for device_id, nombre in aparatos:
+                    sin_datos = cortes + intervalos_sin_datos(aleatorio_hogar, inicio, dias, PROBABILIDAD_HUECO, 6)
+                    # Desfase propio de cada enchufe para que no muestreen todos a la vez
+                    desfase = aleatorio_hogar.random() * intervalo
+                    ultima = None
+                    for ts, kw in muestras_aparato(aleatorio_hogar, catalogo, nombre, inicio + desfase, fin,
+                                                   intervalo, sin_datos):
+                        ultima = (ts, kw)
+                        yield user_id, device_id, kw, ts
+                    if ultima:
+                        ultimas[device_id] = (user_id, ultima)
+                if progreso:
+                    progreso(user_id - primer_usuario + 1, usuarios)
+
+        generador = filas()
+        while True:
+            lote = [fila for _, fila in zip(range(LOTE), generador)]
+            if not lote:
+                break
+            c.executemany("INSERT INTO consumption (user_id, device_id, consumption_kwh, ts) VALUES (?, ?, ?, ?)",
+                          lote)
+            total += len(lote)
+
+        c.executemany("""INSERT OR REPLACE INTO device_snapshots
+                         (device_id, user_id, ip_address, consumption_kwh, status, error, updated_at, read_ts,
+                          checked_ts, failures, retry_at_ts)
+                         SELECT id, ?, ip_address, ?, ?, NULL, ?, ?, ?, 0, NULL FROM devices WHERE id = ?""",
+                      ((user_id, kw, 1 if kw > 0 else 0,
+                        datetime.fromtimestamp(ts, LIMA_TZ).strftime('%Y-%m-%d %H:%M:%S'), ts, ts, device_id)
+                       for device_id, (user_id, (ts, kw)) in ultimas.items()))
+
+        for _, sql in indices:
+            c.execute(sql)
+        c.execute("COMMIT")
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+    carga = time.perf_counter() - inicio_carga
+
+    filas_agregados = None
+    if agregados:
+        import agregados_consumo
+        # Solo los hogares nuevos: los agregados ya retenidos de la base no se tocan
+        filas_agregados = agregados_consumo.recalcular_agregados(
+            conn, usuarios=range(primer_usuario, primer_usuario + usuarios))
+    conn.execute("ANALYZE")
+
+    return {
+        'usuarios': usuarios,
+        'dispositivos': total_dispositivos,
+        'muestras': total,
+        'intervalo_s': round(intervalo, 1),
+        'desde': datetime.fromtimestamp(inicio, LIMA_TZ).strftime('%Y-%m-%d'),
+        'hasta': datetime.fromtimestamp(fin, LIMA_TZ).strftime('%Y-%m-%d'),
+        'primer_usuario': primer_usuario,
+        'carga_s': round(carga, 2),
+        'agregados': filas_agregados,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de datos sintéticos de consumo de EnerVirgil")
+    parser.add_argument('--usuarios', type=int, default=100, help="Hogares a generar")
+    parser.add_argument('--dias', type=int, default=90, help="Días de historial")
+    parser.add_argument('--intervalo', type=float, default=15, help="Minutos entre muestras de cada enchufe")
+    parser.add_argument('--muestras', type=int, default=None,
+                        help="Total aproximado de muestras (ajusta el intervalo; ignora --intervalo)")
+    parser.add_argument('--semilla', type=int, default=42, help="Semilla (mismo valor, mismos datos)")
+    parser.add_argument('--hasta', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(), default=None,
+                        help="Fecha final AAAA-MM-DD (por defecto hoy); fíjala para datos idénticos entre días")
+    parser.add_argument('--sin-agregados', action='store_true', help="No reconstruir consumption_rollups")
+    parser.add_argument('--forzar', action='store_true', help="Agregar datos aunque la base ya tenga usuarios")
+    args = parser.parse_args()
+
+    # Cargar variables de entorno y crear el esquema en DB_PATH
+    sys.path.insert(0, '.')
+    import load_env
+    from app import DB_PATH
+
+    print("🏭 GENERADOR DE DATOS SINTÉTICOS")
+    print("=" * 60)
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    try:
+        existentes = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        if existentes and not args.forzar:
+            print(f"❌ {DB_PATH} ya tiene {existentes} usuarios; usa una base nueva (DB_PATH) o --forzar")
+            return 1
+
+        def progreso(hechos, total):
+            if hechos % max(1, total // 10) == 0 or hechos == total:
+                print(f"   {hechos}/{total} hogares")
+
+        resumen = generar(conn, args.usuarios, dias=args.dias, intervalo_min=args.intervalo, muestras=args.muestras,
+                          semilla=args.semilla, hasta=args.hasta, agregados=not args.sin_agregados,
+                          progreso=progreso)
+    finally:
+        conn.close()
+    print(f"✅ {resumen['usuarios']} hogares, {resumen['dispositivos']} enchufes, {resumen['muestras']:,} muestras "
+          f"cada {resumen['intervalo_s']}s ({resumen['desde']} a {resumen['hasta']}) en {resumen['carga_s']}s")
+    if resumen['agregados'] is not None:
+        print(f"✅ {resumen['agregados']} filas de agregados")
+    print(f"   Base: {DB_PATH}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,7 @@
 # Configuración de Gunicorn para EnerVirgil
 import os
+import sys
+import subprocess
 
 # Configuración del servidor
 bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
@@ -27,4 +29,28 @@ tmp_upload_dir = None
 
 # Configuración SSL (para HTTPS)
 keyfile = None
-certfile = None
\ No newline at end of file
+certfile = None
+
+# Poller de telemetría: el proceso maestro lo lanza una sola vez (no por worker)
+# Poner POLLER_EMBEBIDO=false si se ejecuta como servicio aparte
+poller_embebido = os.environ.get('POLLER_EMBEBIDO', 'true').lower() == 'true'
+_poller = None
+
+def when_ready(server):
+    global _poller
+    if poller_embebido:
+        _poller = subprocess.Popen([sys.executable, 'poller_telemetria.py'])
+        server.log.info(f"Poller de telemetría iniciado (pid {_poller.pid})")
+
+def post_fork(server, worker):
+    # Cada worker nuevo (también tras max_requests) arranca con la cache precargada
+    from app import iniciar_worker
+    iniciar_worker()
+
+def on_exit(server):
+    if _poller and _poller.poll() is None:
+        _poller.terminate()
+        try:
+            _poller.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            _poller.kill()
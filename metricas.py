@@ -0,0 +1,231 @@
+"""
+Métricas de peticiones en formato Prometheus para EnerVirgil
+
+Cada petición de Flask registra su latencia total en un histograma por
+endpoint y, aparte, el tiempo que pasó en cada componente: SQLite, enchufes,
+Google, plantillas y cache. Los componentes se miden con medir() o sumar()
+solo en el hilo de la petición; fuera de una petición (poller, hilos de
+fondo) no cuestan nada más que una consulta a un threading.local.
+
+También hay contadores (p. ej. timeouts de enchufes) y, al exponer, se
+agregan las métricas de estado que entrega la aplicación (colas, cache).
+
+Las métricas son de cada proceso: con varios workers de gunicorn cada
+uno expone las suyas.
+"""
+
+import time
+import sqlite3
+import threading
+from bisect import bisect_left
+
+# Límites (segundos) de los buckets de los histogramas
+LIMITES = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+COMPONENTES = ('sqlite', 'enchufes', 'google', 'plantilla', 'cache')
+
+_local = threading.local()
+_perf_counter = time.perf_counter
+
+class Histograma:
+    __slots__ = ('cuentas', 'suma')
+
+    def __init__(self):
+        self.cuentas = [0] * (len(LIMITES) + 1)  # el último es +Inf
+        self.suma = 0.0
+
+    def observar(self, valor):
+        self.cuentas[bisect_left(LIMITES, valor)] += 1
+        self.suma += valor
+
+class Registro:
+    """Histogramas y contadores con etiquetas, seguros entre hilos"""
+
+    def __init__(self):
+        self._histogramas = {}  # (nombre, etiquetas) -> Histograma
+        self._contadores = {}  # (nombre, etiquetas) -> valor
+        self._ayuda = {}  # nombre -> (tipo, texto)
+        self._lock = threading.Lock()
+
+    def describir(self, nombre, tipo, ayuda):
+        self._ayuda[nombre] = (tipo, ayuda)
+
+    def observar(self, nombre, etiquetas, valor):
+        """etiquetas: tupla de pares (clave, valor)"""
+        with self._lock:
+            histograma = self._histogramas.get((nombre, etiquetas))
+            if histograma is None:
+                histograma = self._histogramas[(nombre, etiquetas)] = Histograma()
+            histograma.observar(valor)
+
+    def incrementar(self, nombre, etiquetas=(), cantidad=1):
+        with self._lock:
+            self._contadores[(nombre, etiquetas)] = self._contadores.get((nombre, etiquetas), 0) + cantidad
+
+    def exponer(self, estado=()):
+        """
+        Texto en formato de exposición de Prometheus. estado: métricas leídas
+        en el momento, como [(nombre, tipo, ayuda, [(etiquetas dict, valor)])]
+        """
+        with self._lock:
+            histogramas = {clave: (list(h.cuentas), h.suma) for clave, h in self._histogramas.items()}
+            contadores = dict(self._contadores)
+        lineas = []
+        for nombre in sorted({n for n, _ in histogramas}):
+            self._cabecera(lineas, nombre, 'histogram')
+            for (n, etiquetas), (cuentas, suma) in sorted(histogramas.items()):
+                if n != nombre:
+                    continue
+                acumulado = 0
+                for limite, cuenta in zip(LIMITES + ('+Inf',), cuentas):
+                    acumulado += cuenta
+                    lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas + (('le', str(limite)),))} {acumulado}")
+                lineas.append(f"{nombre}_sum{_etiquetas(etiquetas)} {suma:.6f}")
+                lineas.append(f"{nombre}_count{_etiquetas(etiquetas)} {acumulado}")
+        for nombre in sorted({n for n, _ in contadores}):
+            self._cabecera(lineas, nombre, 'counter')
+            for (n, etiquetas), valor in sorted(contadores.items()):
+                if n == nombre:
+                    lineas.append(f"{nombre}{_etiquetas(etiquetas)} {valor}")
+        for nombre, tipo, ayuda, muestras in estado:
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            for etiquetas, valor in muestras:
+                lineas.append(f"{nombre}{_etiquetas(tuple(sorted(etiquetas.items())))} {_numero(valor)}")
+        return "\n".join(lineas) + "\n"
+
+    def _cabecera(self, lineas, nombre, tipo_defecto):
+        tipo, ayuda = self._ayuda.get(nombre, (tipo_defecto, nombre))
+        lineas.append(f"# HELP {nombre} {ayuda}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    return '{' + ','.join(f'{clave}="{_escapar(valor)}"' for clave, valor in etiquetas) + '}'
+
+def _numero(valor):
+    if valor is None:
+        return 'NaN'
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+registro = Registro()
+registro.describir('enervirgil_peticion_segundos', 'histogram', 'Latencia de las peticiones por endpoint')
+registro.describir('enervirgil_peticion_componente_segundos', 'histogram',
+                   'Tiempo de cada petición dentro de un componente (sqlite, enchufes, google, plantilla, cache)')
+registro.describir('enervirgil_peticiones_total', 'counter', 'Peticiones atendidas por endpoint y código de estado')
+
+# Medición por petición
+
+def iniciar_peticion():
+    _local.tiempos = {}
+
+def terminar_peticion(endpoint, estado, duracion):
+    """Registra la petición en curso del hilo y deja de acumular tiempos"""
+    tiempos = getattr(_local, 'tiempos', None)
+    _local.tiempos = None
+    endpoint = (('endpoint', endpoint or 'sin_ruta'),)
+    registro.observar('enervirgil_peticion_segundos', endpoint, duracion)
+    registro.incrementar('enervirgil_peticiones_total', endpoint + (('estado', str(estado)),))
+    for componente, segundos in (tiempos or {}).items():
+        registro.observar('enervirgil_peticion_componente_segundos', endpoint + (('componente', componente),),
+                          segundos)
+
+def sumar(componente, segundos):
+    """Suma tiempo de un componente a la petición en curso del hilo (si la hay)"""
+    tiempos = getattr(_local, 'tiempos', None)
+    if tiempos is not None:
+        tiempos[componente] = tiempos.get(componente, 0.0) + segundos
+
+class medir:
+    """Context manager que suma el tiempo del bloque a un componente de la petición"""
+    __slots__ = ('componente', 'inicio')
+
+    def __init__(self, componente):
+        self.componente = componente
+
+    def __enter__(self):
+        self.inicio = _perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        sumar(self.componente, _perf_counter() - self.inicio)
+        return False
+
+def incrementar(nombre, cantidad=1, **etiquetas):
+    registro.incrementar(nombre, tuple(sorted(etiquetas.items())), cantidad)
+
+class CursorMedido(sqlite3.Cursor):
+    """Cursor sqlite3 que suma el tiempo de sus consultas al componente sqlite"""
+
+    def execute(self, *args):
+        inicio = _perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            sumar('sqlite', _perf_counter() - inicio)
+
+    def executemany(self, *args):
+        inicio = _perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            sumar('sqlite', _perf_counter() - inicio)
+
+    def fetchone(self):
+        inicio = _perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            sumar('sqlite', _perf_counter() - inicio)
+
+    def fetchall(self):
+        inicio = _perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            sumar('sqlite', _perf_counter() - inicio)
+
+    def fetchmany(self, *args):
+        inicio = _perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            sumar('sqlite', _perf_counter() - inicio)
+
+# Plantillas (señales de Flask)
+
+def _antes_de_plantilla(sender, **extra):
+    _local.plantilla_inicio = _perf_counter()
+
+def _plantilla_renderizada(sender, **extra):
+    inicio = getattr(_local, 'plantilla_inicio', None)
+    if inicio is not None:
+        _local.plantilla_inicio = None
+        sumar('plantilla', _perf_counter() - inicio)
+
+def instrumentar(app):
+    """Registra en la app Flask la medición de peticiones y plantillas"""
+    from flask import g, request, before_render_template, template_rendered
+
+    @app.before_request
+    def _iniciar_metricas():
+        g.metricas_inicio = _perf_counter()
+        iniciar_peticion()
+
+    @app.after_request
+    def _estado_metricas(response):
+        g.metricas_estado = response.status_code
+        return response
+
+    @app.teardown_request
+    def _registrar_metricas(exc):
+        inicio = g.pop('metricas_inicio', None)
+        if inicio is not None:
+            terminar_peticion(request.endpoint, g.pop('metricas_estado', 500), _perf_counter() - inicio)
+
+    before_render_template.connect(_antes_de_plantilla, app, weak=False)
+    template_rendered.connect(_plantilla_renderizada, app, weak=False)
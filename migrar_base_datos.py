@@ -13,7 +13,7 @@ from datetime import datetime
 sys.path.insert(0, '.')
 import load_env
 
-DB_PATH = 'ener_virgil.db'
+DB_PATH = os.environ.get('DB_PATH', 'ener_virgil.db')
 BACKUP_PATH = 'ener_virgil_backup.db'
 
 def hacer_backup():
@@ -0,0 +1,211 @@
+"""
+Perfilado bajo demanda de peticiones individuales de EnerVirgil
+
+Cuando un dashboard concreto es lento en producción, /metrics dice cuánto
+tardó pero no en qué. Con PROFILER_SECRETO configurado, un operador puede
+pedir que una petición se perfile con cProfile enviando un token firmado en
+la cabecera X-Perfil o en el parámetro _perfil:
+
+    python perfilador.py firmar --minutos 30
+    curl -H "X-Perfil: <token>" https://.../dashboard
+
+El token es "<expira>.<firma>", con la firma HMAC-SHA256 del secreto sobre
+el epoch de expiración. Si llega por parámetro se guarda además en una
+cookie hasta que expira, para poder perfilar redirecciones que el operador
+no controla, como la vuelta de Google a google_callback.
+
+Cada perfil se guarda en PROFILER_DIR (solo se conservan los últimos
+PROFILER_MAX_ARCHIVOS) y se puede leer con pstats o con
+`python perfilador.py ver`. Si PROFILER_TOP > 0, las funciones con más
+tiempo propio se resumen además en la cabecera X-Perfil-Top.
+
+Sin PROFILER_SECRETO no se registra ningún hook: no cuesta nada.
+"""
+
+import os
+import sys
+import time
+import hmac
+import pstats
+import hashlib
+import logging
+import argparse
+import cProfile
+
+PROFILER_SECRETO = os.environ.get('PROFILER_SECRETO', '')
+PROFILER_DIR = os.environ.get('PROFILER_DIR', 'perfiles')
+PROFILER_MAX_ARCHIVOS = int(os.environ.get('PROFILER_MAX_ARCHIVOS', 50))
+PROFILER_TOP = int(os.environ.get('PROFILER_TOP', 5))
+
+CABECERA = 'X-Perfil'
+PARAMETRO = '_perfil'
+COOKIE = 'perfil'
+
+logger = logging.getLogger(__name__)
+
+def firma(secreto, expira):
+    return hmac.new(secreto.encode(), str(expira).encode(), hashlib.sha256).hexdigest()
+
+def firmar(secreto, minutos=30, ahora=None):
+    """Token "<expira>.<firma>" válido durante `minutos`"""
+    expira = int((ahora if ahora is not None else time.time()) + minutos * 60)
+    return f"{expira}.{firma(secreto, expira)}"
+
+def token_valido(secreto, token, ahora=None):
+    """Momento de expiración del token si es auténtico y no ha vencido; si no, None"""
+    expira, _, recibida = (token or '').partition('.')
+    if not secreto or not expira.isdigit() or not recibida:
+        return None
+    if int(expira) < (ahora if ahora is not None else time.time()):
+        return None
+    if not hmac.compare_digest(recibida.encode(), firma(secreto, expira).encode()):
+        return None
+    return int(expira)
+
+def funciones_principales(perfil, cantidad):
+    """[(función, segundos propios, llamadas)] de las `cantidad` funciones con más tiempo propio"""
+    estadisticas = pstats.Stats(perfil).stats
+    filas = sorted(estadisticas.items(), key=lambda fila: fila[1][2], reverse=True)[:cantidad]
+    principales = []
+    for (archivo, linea, nombre), (_, llamadas, propio, _, _) in filas:
+        # Las funciones nativas vienen como ('~', 0, '<built-in method ...>')
+        funcion = f"{nombre}@{os.path.basename(archivo)}:{linea}" if linea else nombre
+        principales.append((funcion, propio, llamadas))
+    return principales
+
+def resumir_cabecera(principales):
+    resumen = '; '.join(f"{funcion}={segundos * 1000:.1f}ms/{llamadas}" for funcion, segundos, llamadas in principales)
+    # Las cabeceras HTTP solo admiten latin-1
+    return resumen.encode('ascii', 'replace').decode('ascii')
+
+def rotar(directorio, maximo):
+    """Borra los perfiles más antiguos hasta dejar `maximo`"""
+    try:
+        archivos = [os.path.join(directorio, nombre) for nombre in os.listdir(directorio) if nombre.endswith('.prof')]
+        archivos.sort(key=os.path.getmtime)
+        for ruta in archivos[:max(0, len(archivos) - maximo)]:
+            os.remove(ruta)
+    except OSError as e:
+        logger.warning(f"No se pudieron rotar los perfiles de {directorio}: {e}")
+
+def guardar(perfil, endpoint, duracion, directorio=PROFILER_DIR, maximo=PROFILER_MAX_ARCHIVOS):
+    """Escribe el perfil en el directorio y rota; devuelve el nombre del archivo o None"""
+    ahora = time.time()
+    nombre = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(ahora))}.{int(ahora * 1000) % 1000:03d}"
+              f"_{endpoint or 'sin_ruta'}_{os.getpid()}_{int(duracion * 1000)}ms.prof")
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        perfil.dump_stats(os.path.join(directorio, nombre))
+    except OSError as e:
+        logger.warning(f"No se pudo guardar el perfil de {endpoint}: {e}")
+        return None
+    rotar(directorio, maximo)
+    return nombre
+
+def instrumentar(app, secreto=PROFILER_SECRETO):
+    """Registra en la app Flask el perfilado de peticiones firmadas (nada si no hay secreto)"""
+    if not secreto:
+        return
+    from flask import g, request
+
+    def token_de_peticion():
+        token = request.headers.get(CABECERA)
+        if token:
+            return token, False
+        if PARAMETRO.encode() in request.query_string:
+            token = request.args.get(PARAMETRO)
+            if token:
+                return token, True
+        return request.cookies.get(COOKIE), False
+
+    def terminar():
+        perfil = g.pop('perfil', None)
+        if perfil is None:
+            return None
+        perfil.disable()
+        duracion = time.perf_counter() - g.pop('perfil_inicio')
+        archivo = guardar(perfil, request.endpoint, duracion)
+        logger.info(f"Perfil de {request.method} {request.path} ({duracion * 1000:.0f} ms): {archivo}")
+        return perfil, duracion, archivo
+
+    @app.before_request
+    def _iniciar_perfil():
+        token, por_parametro = token_de_peticion()
+        if not token:
+            return
+        expira = token_valido(secreto, token)
+        if expira is None:
+            return
+        if por_parametro:
+            g.perfil_cookie = (token, expira)
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Otro perfilador activo en el proceso (p. ej. otra petición en Python 3.12+)
+            return
+        g.perfil = perfil
+        g.perfil_inicio = time.perf_counter()
+
+    @app.after_request
+    def _guardar_perfil(response):
+        cookie = g.pop('perfil_cookie', None)
+        if cookie:
+            token, expira = cookie
+            response.set_cookie(COOKIE, token, max_age=max(0, expira - int(time.time())),
+                                secure=request.is_secure, httponly=True, samesite='Lax')
+        resultado = terminar()
+        if resultado is not None:
+            perfil, duracion, archivo = resultado
+            response.headers['X-Perfil-Duracion'] = f"{duracion * 1000:.1f}ms"
+            if archivo:
+                response.headers['X-Perfil-Archivo'] = archivo
+            if PROFILER_TOP > 0:
+                response.headers['X-Perfil-Top'] = resumir_cabecera(funciones_principales(perfil, PROFILER_TOP))
+        return response
+
+    @app.teardown_request
+    def _cerrar_perfil(exc):
+        # Si la vista lanzó una excepción after_request no corre: se guarda igual
+        terminar()
+
+def main():
+    parser = argparse.ArgumentParser(description="Perfilado de peticiones de EnerVirgil")
+    subcomandos = parser.add_subparsers(dest='comando', required=True)
+    parser_firmar = subcomandos.add_parser('firmar', help="Genera un token para la cabecera X-Perfil o _perfil")
+    parser_firmar.add_argument('--minutos', type=int, default=30, help="Minutos de validez del token")
+    parser_ver = subcomandos.add_parser('ver', help="Muestra las funciones más costosas de perfiles guardados")
+    parser_ver.add_argument('archivos', nargs='*', help=f"Archivos .prof (por defecto el último de {PROFILER_DIR})")
+    parser_ver.add_argument('--orden', default='cumulative', help="Orden de pstats (cumulative, tottime, calls...)")
+    parser_ver.add_argument('--lineas', type=int, default=25, help="Funciones a mostrar")
+    args = parser.parse_args()
+
+    if args.comando == 'firmar':
+        import load_env  # PROFILER_SECRETO puede estar en .env
+        secreto = os.environ.get('PROFILER_SECRETO', '')
+        if not secreto:
+            print("❌ PROFILER_SECRETO no está configurado")
+            return 1
+        print(firmar(secreto, args.minutos))
+        return 0
+
+    archivos = args.archivos
+    if not archivos:
+        try:
+            guardados = [os.path.join(PROFILER_DIR, nombre) for nombre in os.listdir(PROFILER_DIR)
+                         if nombre.endswith('.prof')]
+        except OSError:
+            guardados = []
+        if not guardados:
+            print(f"❌ No hay perfiles en {PROFILER_DIR}")
+            return 1
+        archivos = [max(guardados, key=os.path.getmtime)]
+    print("🔬 PERFIL DE PETICIONES")
+    print("=" * 60)
+    for archivo in archivos:
+        print(f"📄 {archivo}")
+    pstats.Stats(*archivos).strip_dirs().sort_stats(args.orden).print_stats(args.lineas)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Servicio de sondeo de telemetría de EnerVirgil
+
+Recorre todos los enchufes registrados en la tabla devices cada cierto
+intervalo, guarda la última lectura de cada uno en device_snapshots y
+registra el consumo. Las rutas web solo leen esos snapshots, por lo que
+nunca esperan a los enchufes.
+
+Uso:
+    python poller_telemetria.py                 # sondeo continuo
+    python poller_telemetria.py --intervalo 60  # cada 60 segundos
+    python poller_telemetria.py --una-vez       # un solo ciclo
+"""
+
+import os
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+# Cargar variables de entorno y funciones de la aplicación
+sys.path.insert(0, '.')
+import load_env
+
+from app import get_db_connection, get_real_energy_data, save_device_snapshots, pool_enchufes
+import retencion_consumo
+import circuito_enchufes
+
+INTERVALO_DEFECTO = int(os.environ.get('POLLER_INTERVALO', 30))  # segundos
+TIMEOUT_ENCHUFE = int(os.environ.get('POLLER_TIMEOUT_ENCHUFE', 3))  # segundos
+RETENCION_INTERVALO_HORAS = int(os.environ.get('RETENCION_INTERVALO_HORAS', 24))
+
+def obtener_dispositivos():
+    """
+    Obtiene todos los enchufes registrados y, aparte, los que tienen el
+    circuito abierto (no se sondean hasta su próximo intento)
+    """
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT d.id, d.user_id, d.ip_address, s.failures, s.retry_at_ts
+                     FROM devices d LEFT JOIN device_snapshots s ON s.device_id = d.id""")
+        filas = c.fetchall()
+    ahora = int(time.time())
+    dispositivos, en_espera = [], []
+    for device_id, user_id, ip_address, fallos, reintentar_ts in filas:
+        if circuito_enchufes.permite_intento(fallos, reintentar_ts, ahora):
+            dispositivos.append((device_id, user_id, ip_address))
+        else:
+            en_espera.append((device_id, user_id, ip_address))
+    return dispositivos, en_espera
+
+async def sondear_dispositivos(dispositivos, timeout=TIMEOUT_ENCHUFE):
+    """Lee todos los enchufes en paralelo y devuelve sus lecturas"""
+    tareas = [get_real_energy_data(device_id, ip_address, user_id, timeout=timeout, usar_cache=False)
+              for device_id, user_id, ip_address in dispositivos]
+    resultados = await asyncio.gather(*tareas, return_exceptions=True)
+
+    lecturas = []
+    for (device_id, user_id, ip_address), resultado in zip(dispositivos, resultados):
+        if isinstance(resultado, Exception):
+            resultado = {
+                "id": device_id,
+                "consumption": 0.0,
+                "status": False,
+                "ip_address": ip_address,
+                "error": str(resultado)
+            }
+        resultado['user_id'] = user_id
+        lecturas.append(resultado)
+    return lecturas
+
+def ejecutar_retencion_programada():
+    """Aplica la retención de muestras de consumo (trabajo diario)"""
+    conn = get_db_connection()
+    try:
+        retencion_consumo.ejecutar_retencion(conn)
+    except Exception as e:
+        logging.error(f"Error en la retención de consumo: {e}")
+    finally:
+        conn.close()
+
+async def ejecutar_ciclo():
+    """Ejecuta un ciclo completo de sondeo"""
+    inicio = time.monotonic()
+    dispositivos, en_espera = obtener_dispositivos()
+    # Cerrar conexiones de enchufes eliminados, cuya IP cambió o con el circuito abierto
+    pool_enchufes.conservar(ip_address for _, _, ip_address in dispositivos)
+    lecturas = await sondear_dispositivos(dispositivos)
+    save_device_snapshots(lecturas)
+
+    errores = sum(1 for l in lecturas if l.get('error'))
+    pool = pool_enchufes.resumen()
+    logging.info(f"Ciclo de sondeo: {len(lecturas)} enchufes, {errores} con error, "
+                 f"{len(en_espera)} con el circuito abierto, {time.monotonic() - inicio:.2f}s "
+                 f"(cola máx {pool['en_cola_max']}, espera máx {pool['espera_maxima']:.2f}s)")
+
+async def ejecutar(intervalo, una_vez=False):
+    """Bucle principal del poller"""
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, detener.set)
+        except NotImplementedError:
+            # Windows no soporta add_signal_handler
+            pass
+
+    scheduler = None
+    if not una_vez:
+        # La retención corre en un hilo aparte y borra en lotes cortos
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(ejecutar_retencion_programada, 'interval', hours=RETENCION_INTERVALO_HORAS,
+                          next_run_time=datetime.now() + timedelta(minutes=5))
+        scheduler.start()
+
+    logging.info(f"Poller de telemetría iniciado (intervalo: {intervalo}s)")
+    while not detener.is_set():
+        inicio = time.monotonic()
+        try:
+            await ejecutar_ciclo()
+        except Exception as e:
+            logging.error(f"Error en ciclo de sondeo: {e}")
+
+        if una_vez:
+            break
+
+        # Esperar el resto del intervalo (o hasta recibir señal de parada)
+        espera = max(0, intervalo - (time.monotonic() - inicio))
+        try:
+            await asyncio.wait_for(detener.wait(), timeout=espera)
+        except asyncio.TimeoutError:
+            pass
+
+    if scheduler:
+        scheduler.shutdown(wait=False)
+    logging.info("Poller de telemetría detenido")
+
+def main():
+    parser = argparse.ArgumentParser(description="Poller de telemetría de enchufes EnerVirgil")
+    parser.add_argument('--intervalo', type=int, default=INTERVALO_DEFECTO,
+                        help="Segundos entre ciclos de sondeo")
+    parser.add_argument('--una-vez', action='store_true',
+                        help="Ejecuta un solo ciclo y termina")
+    args = parser.parse_args()
+
+    asyncio.run(ejecutar(args.intervalo, args.una_vez))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Pool de conexiones SmartPlug para EnerVirgil
+
+Reutiliza un cliente SmartPlug por dirección IP en lugar de crear uno nuevo
+(con su conexión TCP y la consulta inicial de sysinfo) en cada lectura.
+Cada enchufe tiene su propio candado, así que las lecturas y las órdenes de
+encendido/apagado al mismo enchufe se serializan en vez de chocar.
+
+Además limita cuántos enchufes se consultan a la vez: en todo el proceso
+(max_concurrencia) y por red /24 de destino, que en la práctica es la red
+de un hogar (max_por_red). Las consultas que superan el límite esperan
+turno en lugar de abrir cientos de sockets contra enchufes baratos que
+luego no responden a tiempo. La espera en cola se mide en resumen().
+"""
+
+import time
+import asyncio
+import logging
+import threading
+import ipaddress
+import contextlib
+
+from kasa import SmartPlug
+
+class _Entrada:
+    __slots__ = ('plug', 'lock', 'ultimo_uso')
+
+    def __init__(self, plug):
+        self.plug = plug
+        self.lock = asyncio.Lock()
+        self.ultimo_uso = time.monotonic()
+
+class _Red:
+    __slots__ = ('semaforo', 'usuarios', 'en_cola')
+
+    def __init__(self, limite):
+        self.semaforo = asyncio.Semaphore(limite)
+        self.usuarios = 0  # consultas esperando o en curso hacia esta red
+        self.en_cola = 0
+
+def separar_direccion(ip_address):
+    """Separa "host:puerto" (p. ej. enchufes simulados); sin puerto se usa el de Kasa"""
+    host, separador, puerto = ip_address.rpartition(':')
+    if separador and puerto.isdigit() and ':' not in host:
+        return host, int(puerto)
+    return ip_address, None
+
+def red_de(ip_address):
+    """Red /24 de una dirección IPv4; para otros destinos, el propio destino"""
+    host, _ = separar_direccion(ip_address)
+    try:
+        return str(ipaddress.ip_network(f"{host}/24", strict=False))
+    except ValueError:
+        return host
+
+class PoolEnchufes:
+    """
+    Registro de clientes SmartPlug reutilizables, uno por IP (o "IP:puerto").
+    Los clientes quedan ligados al event loop que los creó; si el pool se usa
+    desde otro loop (por ejemplo tras un fork) se descarta su contenido.
+
+    max_concurrencia: consultas simultáneas a enchufes en el proceso (0 = sin límite)
+    max_por_red: consultas simultáneas a una misma red /24 (0 = sin límite)
+    """
+
+    def __init__(self, expiracion_inactivo=300, max_concurrencia=0, max_por_red=0):
+        self.expiracion_inactivo = expiracion_inactivo
+        self.max_concurrencia = max_concurrencia
+        self.max_por_red = max_por_red
+        self._entradas = {}
+        self._redes = {}
+        self._global = None
+        self._lock = threading.Lock()
+        self._loop = None
+        self._ultima_purga = time.monotonic()
+        self._metricas = {
+            'consultas': 0,
+            'en_curso': 0,
+            'en_cola': 0,
+            'en_cola_max': 0,
+            'esperas': 0,  # consultas que tuvieron que esperar turno
+            'espera_total': 0.0,
+            'espera_maxima': 0.0,
+        }
+
+    def _obtener(self, ip_address):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._loop is not loop:
+                self._entradas.clear()
+                self._redes.clear()
+                self._global = asyncio.Semaphore(self.max_concurrencia) if self.max_concurrencia else None
+                self._loop = loop
+            entrada = self._entradas.get(ip_address)
+            if entrada is None:
+                host, puerto = separar_direccion(ip_address)
+                entrada = _Entrada(SmartPlug(host, port=puerto))
+                self._entradas[ip_address] = entrada
+            return entrada
+
+    @contextlib.asynccontextmanager
+    async def usar(self, ip_address):
+        """Presta el cliente del enchufe con su candado y su turno de concurrencia tomados"""
+        await self._purgar_si_toca()
+        entrada = self._obtener(ip_address)
+        # Primero el candado del enchufe: quien espera a su propio enchufe no ocupa turno
+        async with entrada.lock:
+            async with self._turno(ip_address):
+                try:
+                    yield entrada.plug
+                except BaseException:
+                    # Tras un error o timeout la conexión puede quedar a medias
+                    await entrada.plug.protocol.close()
+                    raise
+                finally:
+                    entrada.ultimo_uso = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def _turno(self, ip_address):
+        """Espera turno en el límite de la red de destino y en el del proceso"""
+        metricas = self._metricas
+        red = None
+        if self.max_por_red:
+            clave_red = red_de(ip_address)
+            # resumen() recorre _redes desde los hilos de las peticiones (/metrics, /ops/enchufes)
+            with self._lock:
+                red = self._redes.get(clave_red)
+                if red is None:
+                    red = self._redes[clave_red] = _Red(self.max_por_red)
+                red.usuarios += 1
+        semaforos = [s for s in (red.semaforo if red else None, self._global) if s is not None]
+        esperar = any(s.locked() for s in semaforos)
+        inicio = time.monotonic()
+        adquiridos = []
+        try:
+            if esperar:
+                metricas['en_cola'] += 1
+                metricas['en_cola_max'] = max(metricas['en_cola_max'], metricas['en_cola'])
+                if red:
+                    red.en_cola += 1
+            try:
+                # Siempre en el mismo orden (red y luego proceso) para no bloquearse entre sí
+                for semaforo in semaforos:
+                    await semaforo.acquire()
+                    adquiridos.append(semaforo)
+            finally:
+                if esperar:
+                    metricas['en_cola'] -= 1
+                    if red:
+                        red.en_cola -= 1
+            if esperar:
+                espera = time.monotonic() - inicio
+                metricas['esperas'] += 1
+                metricas['espera_total'] += espera
+                metricas['espera_maxima'] = max(metricas['espera_maxima'], espera)
+            metricas['consultas'] += 1
+            metricas['en_curso'] += 1
+            try:
+                yield
+            finally:
+                metricas['en_curso'] -= 1
+        finally:
+            for semaforo in reversed(adquiridos):
+                semaforo.release()
+            if red:
+                with self._lock:
+                    red.usuarios -= 1
+                    if not red.usuarios and self._redes.get(clave_red) is red:
+                        del self._redes[clave_red]
+
+    def invalidar(self, ip_address):
+        """
+        Descarta el cliente de una IP (dispositivo eliminado o IP cambiada).
+        Puede llamarse desde cualquier hilo.
+        """
+        with self._lock:
+            entrada = self._entradas.pop(ip_address, None)
+            loop = self._loop
+        if entrada is not None and loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._cerrar(entrada)))
+
+    def conservar(self, ips_vigentes):
+        """Invalida todos los clientes cuya IP ya no está registrada"""
+        vigentes = set(ips_vigentes)
+        with self._lock:
+            sobrantes = [ip for ip in self._entradas if ip not in vigentes]
+        for ip in sobrantes:
+            self.invalidar(ip)
+
+    async def _cerrar(self, entrada):
+        async with entrada.lock:
+            await entrada.plug.protocol.close()
+
+    async def _purgar_si_toca(self):
+        """Cierra los clientes que llevan más de expiracion_inactivo sin usarse"""
+        ahora = time.monotonic()
+        if ahora - self._ultima_purga < self.expiracion_inactivo / 2:
+            return
+        self._ultima_purga = ahora
+        with self._lock:
+            inactivas = [(ip, e) for ip, e in self._entradas.items()
+                         if not e.lock.locked() and ahora - e.ultimo_uso > self.expiracion_inactivo]
+            for ip, _ in inactivas:
+                del self._entradas[ip]
+        for ip, entrada in inactivas:
+            await self._cerrar(entrada)
+        if inactivas:
+            logging.info(f"Pool de enchufes: {len(inactivas)} conexiones inactivas cerradas")
+
+    def resumen(self):
+        """Límites, consultas en curso y en cola, y tiempos de espera por turno"""
+        with self._lock:
+            datos = dict(self._metricas)
+            redes_en_cola = {red: r.en_cola for red, r in self._redes.items() if r.en_cola}
+            conexiones = len(self._entradas)
+        datos['espera_media'] = round(datos['espera_total'] / datos['esperas'], 4) if datos['esperas'] else None
+        datos['espera_total'] = round(datos['espera_total'], 3)
+        datos['espera_maxima'] = round(datos['espera_maxima'], 3)
+        datos.update({
+            'max_concurrencia': self.max_concurrencia,
+            'max_por_red': self.max_por_red,
+            'conexiones': conexiones,
+            'redes_en_cola': redes_en_cola,
+        })
+        return datos
+
+    def __len__(self):
+        return len(self._entradas)
@@ -12,7 +12,7 @@ from datetime import datetime
 sys.path.insert(0, '.')
 import load_env
 
-DB_PATH = 'ener_virgil.db'
+DB_PATH = os.environ.get('DB_PATH', 'ener_virgil.db')
 
 def verificar_estructura_db():
     """Verifica la estructura actual de la base de datos"""
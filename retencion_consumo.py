@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Retención de muestras de consumo para EnerVirgil
+
+La tabla consumption recibe una fila por enchufe en cada sondeo y nunca se
+vaciaba. Este trabajo:
+  - elimina las muestras crudas más antiguas que RETENCION_DIAS (su consumo
+    ya está sumado en consumption_rollups por hora, día y mes),
+  - elimina las muestras y agregados de dispositivos que ya no existen,
+  - conserva los agregados por hora solo RETENCION_HORAS_DIAS; los de día y
+    mes se mantienen,
+borrando siempre en lotes pequeños para no bloquear al escritor de consumo.
+
+Después de la retención los agregados son el único registro del consumo
+anterior a RETENCION_DIAS. `agregados_consumo.py --recalcular` lo respeta:
+solo reconstruye desde la muestra cruda más antigua que queda; con
+--completo reconstruiría todo y ese historial se perdería.
+
+El poller de telemetría lo ejecuta una vez al día. Uso manual:
+    python retencion_consumo.py              # usa la configuración del entorno
+    python retencion_consumo.py --dias 30    # conserva 30 días de muestras
+    python retencion_consumo.py --vacuum     # además compacta el archivo
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+import pytz
+
+LIMA_TZ = pytz.timezone('America/Lima')
+
+RETENCION_DIAS = int(os.environ.get('RETENCION_DIAS', 90))
+RETENCION_HORAS_DIAS = int(os.environ.get('RETENCION_HORAS_DIAS', 400))
+RETENCION_LOTE = int(os.environ.get('RETENCION_LOTE', 5000))
+RETENCION_PAUSA = float(os.environ.get('RETENCION_PAUSA', 0.05))  # segundos entre lotes
+
+def _borrar_en_lotes(conn, sql_ids, parametros, lote, pausa):
+    """
+    Borra de consumption las filas cuyos ids devuelve sql_ids (con LIMIT ?),
+    un lote por transacción. Devuelve el total de filas borradas.
+    """
+    c = conn.cursor()
+    total = 0
+    while True:
+        c.execute(f"DELETE FROM consumption WHERE id IN ({sql_ids})", parametros + (lote,))
+        borradas = c.rowcount
+        conn.commit()
+        total += borradas
+        if borradas < lote:
+            return total
+        # Dejar pasar al escritor de consumo entre lotes
+        time.sleep(pausa)
+
+def _paginas_libres(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA freelist_count")
+    libres = c.fetchone()[0]
+    c.execute("PRAGMA page_size")
+    return libres, c.fetchone()[0]
+
+def ejecutar_retencion(conn, dias=RETENCION_DIAS, dias_horas=RETENCION_HORAS_DIAS,
+                       lote=RETENCION_LOTE, pausa=RETENCION_PAUSA, vacuum=False):
+    """Aplica la política de retención y devuelve un informe de lo eliminado"""
+    inicio = time.monotonic()
+    libres_antes, tam_pagina = _paginas_libres(conn)
+    c = conn.cursor()
+
+    # 1. Muestras crudas fuera de la ventana de retención
+    limite_ts = int(time.time()) - dias * 86400
+    muestras_antiguas = _borrar_en_lotes(
+        conn, "SELECT id FROM consumption WHERE ts < ? LIMIT ?", (limite_ts,), lote, pausa)
+
+    # 2. Dispositivos eliminados (se detectan por sus agregados mensuales)
+    c.execute("""SELECT DISTINCT scope_id FROM consumption_rollups
+                 WHERE scope = 'device' AND granularity = 'month'
+                 AND scope_id NOT IN (SELECT id FROM devices)""")
+    huerfanos = [fila[0] for fila in c.fetchall()]
+    muestras_huerfanas = 0
+    for device_id in huerfanos:
+        muestras_huerfanas += _borrar_en_lotes(
+            conn, "SELECT id FROM consumption WHERE device_id = ? LIMIT ?", (device_id,), lote, pausa)
+        c.execute("DELETE FROM consumption_rollups WHERE scope = 'device' AND scope_id = ?", (device_id,))
+        conn.commit()
+
+    # 3. Agregados por hora antiguos (los de día y mes los sustituyen)
+    limite_hora = (datetime.now(LIMA_TZ) - timedelta(days=dias_horas)).strftime('%Y-%m-%d')
+    c.execute("DELETE FROM consumption_rollups WHERE granularity = 'hour' AND bucket < ?", (limite_hora,))
+    agregados_hora = c.rowcount
+    conn.commit()
+
+    libres_despues, _ = _paginas_libres(conn)
+    informe = {
+        'muestras_antiguas': muestras_antiguas,
+        'muestras_dispositivos_eliminados': muestras_huerfanas,
+        'dispositivos_eliminados': len(huerfanos),
+        'agregados_hora': agregados_hora,
+        'bytes_liberados': max(0, libres_despues - libres_antes) * tam_pagina,
+        'bytes_compactados': 0,
+    }
+
+    if vacuum:
+        # VACUUM devuelve al disco las páginas libres, pero bloquea la base mientras dura
+        tamano_antes = _tamano_base(conn)
+        c.execute("VACUUM")
+        informe['bytes_compactados'] = max(0, tamano_antes - _tamano_base(conn))
+
+    informe['segundos'] = round(time.monotonic() - inicio, 2)
+    logging.info(f"Retención de consumo: {informe['muestras_antiguas']} muestras antiguas, "
+                 f"{informe['muestras_dispositivos_eliminados']} de {informe['dispositivos_eliminados']} "
+                 f"dispositivos eliminados, {informe['agregados_hora']} agregados por hora; "
+                 f"{informe['bytes_liberados'] / 1024 / 1024:.1f} MB liberados "
+                 f"en {informe['segundos']}s")
+    return informe
+
+def _tamano_base(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA page_count")
+    paginas = c.fetchone()[0]
+    c.execute("PRAGMA page_size")
+    return paginas * c.fetchone()[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Retención de muestras de consumo EnerVirgil")
+    parser.add_argument('--dias', type=int, default=RETENCION_DIAS,
+                        help="Días de muestras crudas a conservar")
+    parser.add_argument('--dias-horas', type=int, default=RETENCION_HORAS_DIAS,
+                        help="Días de agregados por hora a conservar")
+    parser.add_argument('--vacuum', action='store_true',
+                        help="Compacta el archivo de la base de datos al terminar")
+    args = parser.parse_args()
+
+    sys.path.insert(0, '.')
+    from app import get_db_connection
+
+    print("🧹 RETENCIÓN DE MUESTRAS DE CONSUMO")
+    print("=" * 60)
+    conn = get_db_connection()
+    try:
+        informe = ejecutar_retencion(conn, dias=args.dias, dias_horas=args.dias_horas, vacuum=args.vacuum)
+    finally:
+        conn.close()
+
+    print(f"🗑️ Muestras antiguas eliminadas: {informe['muestras_antiguas']}")
+    print(f"🗑️ Muestras de dispositivos eliminados: {informe['muestras_dispositivos_eliminados']} "
+          f"({informe['dispositivos_eliminados']} dispositivos)")
+    print(f"🗑️ Agregados por hora eliminados: {informe['agregados_hora']}")
+    print(f"💾 Espacio liberado: {informe['bytes_liberados'] / 1024 / 1024:.1f} MB")
+    if args.vacuum:
+        print(f"💾 Archivo compactado: {informe['bytes_compactados'] / 1024 / 1024:.1f} MB")
+    print(f"⏱️ Duración: {informe['segundos']}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Simulador local de enchufes Kasa/Tapo para EnerVirgil
+
+Levanta cientos de enchufes falsos en la interfaz de loopback que hablan el
+mismo protocolo que usa kasa.SmartPlug (TCP con longitud + XOR). Sirve para
+medir get_energy_data, control_device y el poller sin hardware ni red.
+
+Cada enchufe tiene latencia configurable con variación (jitter), una
+probabilidad de no responder (timeout) o de cortar la conexión, y una curva
+de potencia: constante, ciclo de compresor (refrigerador), diaria (pico de
+noche) o aleatoria. La energía acumulada (total) se integra a partir de la
+curva y el relé responde a las órdenes de encendido y apagado.
+
+Direcciones:
+    --modo ips      127.0.H.N en el puerto 9999, una red /24 por hogar
+                    (solo en Linux, que enruta todo 127.0.0.0/8 a loopback)
+    --modo puertos  127.0.0.1:PUERTO desde --puerto-base; todos los enchufes
+                    comparten una red a efectos de PLUG_MAX_POR_RED
+
+Uso:
+    python simulador_enchufes.py --cantidad 200
+    python simulador_enchufes.py --cantidad 500 --por-hogar 5 --latencia 80 --jitter 40 --prob-timeout 0.02
+    DB_PATH=bench.db python simulador_enchufes.py --apuntar-db   # reasigna las IP de devices al simulador
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import struct
+import asyncio
+import logging
+import argparse
+import threading
+
+from kasa.protocol import TPLinkSmartHomeProtocol
+
+PUERTO_KASA = 9999
+CURVAS = ('constante', 'ciclo', 'diaria', 'aleatoria')
+
+def potencia_curva(curva, base, ahora, fase=0.0, anterior=None, aleatorio=random):
+    """Potencia en vatios de una curva en el instante `ahora` (segundos epoch)"""
+    if curva == 'ciclo':
+        # Compresor: encendido el 40% de un ciclo de 20 minutos
+        return base if ((ahora / 1200 + fase) % 1) < 0.4 else base * 0.05
+    if curva == 'diaria':
+        # Mínimo de madrugada, pico hacia las 20:00 (hora local)
+        hora = time.localtime(ahora).tm_hour + time.localtime(ahora).tm_min / 60
+        return base * (0.55 + 0.45 * math.cos((hora - 20) / 24 * 2 * math.pi))
+    if curva == 'aleatoria':
+        # Paseo aleatorio acotado alrededor de la potencia base
+        previa = base if anterior is None else anterior
+        return min(base * 2, max(0.0, previa + aleatorio.uniform(-0.1, 0.1) * base))
+    return base
+
+class EnchufeSimulado:
+    """Estado de un enchufe falso: relé, curva de potencia y energía acumulada"""
+
+    def __init__(self, host, puerto, curva='constante', potencia_base=100.0, semilla=None):
+        self.host = host
+        self.puerto = puerto
+        self.curva = curva
+        self.potencia_base = potencia_base
+        self.encendido = True
+        self.total_kwh = 0.0
+        self.consultas = 0
+        self._aleatorio = random.Random(semilla)
+        self._fase = self._aleatorio.random()
+        self._potencia = potencia_base
+        self._ultimo_calculo = time.time()
+
+    @property
+    def direccion(self):
+        """Dirección tal como se guarda en devices.ip_address"""
+        return self.host if self.puerto == PUERTO_KASA else f"{self.host}:{self.puerto}"
+
+    def potencia(self):
+        """Potencia actual en vatios; integra la energía desde el cálculo anterior"""
+        ahora = time.time()
+        if self.encendido:
+            self._potencia = potencia_curva(self.curva, self.potencia_base, ahora, self._fase,
+                                            self._potencia, self._aleatorio)
+        else:
+            self._potencia = 0.0
+        self.total_kwh += self._potencia * (ahora - self._ultimo_calculo) / 3_600_000
+        self._ultimo_calculo = ahora
+        return self._potencia
+
+    def sysinfo(self):
+        return {
+            "sw_ver": "1.0.0 Build 000000 Rel.000000", "hw_ver": "1.0", "model": "HS110(US)",
+            "deviceId": f"SIM{self.host.replace('.', '')}{self.puerto}", "oemId": "SIM",
+            "hwId": "SIM", "alias": f"Simulado {self.direccion}", "dev_name": "Enchufe simulado",
+            "relay_state": 1 if self.encendido else 0, "on_time": 0, "active_mode": "none",
+            "feature": "TIM:ENE", "updating": 0, "icon_hash": "", "rssi": -50, "led_off": 0,
+            "longitude_i": 0, "latitude_i": 0, "mac": "00:00:00:00:00:00",
+            "type": "IOT.SMARTPLUGSWITCH", "mic_type": "IOT.SMARTPLUGSWITCH", "err_code": 0,
+        }
+
+    def responder(self, peticion):
+        """Respuesta a una consulta del protocolo Kasa ({modulo: {comando: parámetros}})"""
+        self.consultas += 1
+        respuesta = {}
+        for modulo, comandos in peticion.items():
+            respuesta[modulo] = {}
+            for comando, parametros in (comandos or {}).items():
+                if comando == 'get_sysinfo':
+                    resultado = self.sysinfo()
+                elif comando == 'set_relay_state':
+                    self.potencia()  # cerrar la energía acumulada con el estado anterior
+                    self.encendido = bool((parametros or {}).get('state'))
+                    resultado = {"err_code": 0}
+                elif comando == 'get_realtime':
+                    potencia = self.potencia()
+                    resultado = {"power": round(potencia, 3), "voltage": 220.0,
+                                 "current": round(potencia / 220.0, 3), "total": round(self.total_kwh, 4),
+                                 "err_code": 0}
+                elif comando == 'get_daystat':
+                    resultado = {"day_list": [], "err_code": 0}
+                elif comando == 'get_monthstat':
+                    resultado = {"month_list": [], "err_code": 0}
+                else:
+                    resultado = {"err_code": 0}
+                respuesta[modulo][comando] = resultado
+        return respuesta
+
+class SimuladorEnchufes:
+    """
+    Flota de enchufes simulados.
+
+    cantidad: número de enchufes
+    modo: 'ips' (127.0.H.N:9999) o 'puertos' (127.0.0.1:puerto_base + i)
+    por_hogar: enchufes por red /24 en modo 'ips'
+    latencia, jitter: milisegundos de demora por respuesta (jitter uniforme ±)
+    prob_timeout: probabilidad de que una respuesta nunca llegue
+    prob_corte: probabilidad de cortar la conexión en lugar de responder
+    caidos: cuántos enchufes (los últimos) no escuchan, como si estuvieran apagados
+    curva: una de CURVAS o 'mixta' (se reparten entre los enchufes)
+    semilla: semilla para reproducir curvas, demoras y fallos
+    """
+
+    def __init__(self, cantidad=50, modo='ips', por_hogar=5, puerto_base=10000, latencia=30, jitter=10,
+                 prob_timeout=0.0, prob_corte=0.0, caidos=0, curva='mixta', potencia_base=100.0, semilla=None):
+        self.modo = modo
+        self.latencia = latencia / 1000
+        self.jitter = jitter / 1000
+        self.prob_timeout = prob_timeout
+        self.prob_corte = prob_corte
+        self.caidos = caidos
+        self._aleatorio = random.Random(semilla)
+        self._servidores = []
+        self._conexiones = set()
+        self._loop = None
+        self._hilo = None
+        self.enchufes = []
+        for i in range(cantidad):
+            if modo == 'ips':
+                hogar, indice = divmod(i, por_hogar)
+                # 127.0.0.0/24 queda libre para el resto de servicios locales
+                host, puerto = f"127.{(hogar + 1) // 256}.{(hogar + 1) % 256}.{indice + 1}", PUERTO_KASA
+            else:
+                host, puerto = '127.0.0.1', puerto_base + i
+            curva_enchufe = CURVAS[i % len(CURVAS)] if curva == 'mixta' else curva
+            base = potencia_base * self._aleatorio.uniform(0.2, 2.0)
+            self.enchufes.append(EnchufeSimulado(host, puerto, curva_enchufe, base,
+                                                 semilla=None if semilla is None else semilla + i))
+
+    @property
+    def direcciones(self):
+        return [enchufe.direccion for enchufe in self.enchufes]
+
+    async def iniciar(self):
+        """Abre un servidor por enchufe (salvo los caídos) en el loop actual"""
+        activos = self.enchufes[:len(self.enchufes) - self.caidos]
+        for enchufe in activos:
+            servidor = await asyncio.start_server(
+                lambda r, w, enchufe=enchufe: self._atender(enchufe, r, w), enchufe.host, enchufe.puerto)
+            self._servidores.append(servidor)
+        logging.info(f"Simulador: {len(activos)} enchufes escuchando, {self.caidos} caídos")
+        return self
+
+    async def detener(self):
+        for servidor in self._servidores:
+            servidor.close()
+        for servidor in self._servidores:
+            await servidor.wait_closed()
+        self._servidores.clear()
+        # Los clientes reutilizan sus conexiones: cerrar también las abiertas
+        conexiones = list(self._conexiones)
+        for tarea, escritor in conexiones:
+            escritor.transport.abort()
+        await asyncio.gather(*(tarea for tarea, _ in conexiones), return_exceptions=True)
+
+    async def __aenter__(self):
+        return await self.iniciar()
+
+    async def __aexit__(self, *exc):
+        await self.detener()
+
+    def iniciar_en_hilo(self):
+        """Arranca el simulador en su propio loop y hilo (para benchmarks síncronos)"""
+        self._loop = asyncio.new_event_loop()
+        listo = threading.Event()
+        errores = []
+
+        def correr():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self.iniciar())
+            except Exception as e:
+                errores.append(e)
+                return
+            finally:
+                listo.set()
+            self._loop.run_forever()
+
+        self._hilo = threading.Thread(target=correr, name='simulador-enchufes', daemon=True)
+        self._hilo.start()
+        listo.wait()
+        if errores:
+            raise errores[0]
+        return self
+
+    def detener_hilo(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.detener(), self._loop).result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._hilo.join(10)
+        self._loop.close()
+        self._loop = None
+
+    def resumen(self):
+        return {
+            'enchufes': len(self.enchufes),
+            'escuchando': len(self._servidores),
+            'consultas': sum(enchufe.consultas for enchufe in self.enchufes),
+            'encendidos': sum(1 for enchufe in self.enchufes if enchufe.encendido),
+        }
+
+    async def _atender(self, enchufe, lector, escritor):
+        conexion = (asyncio.current_task(), escritor)
+        self._conexiones.add(conexion)
+        try:
+            while True:
+                longitud = struct.unpack('>I', await lector.readexactly(4))[0]
+                peticion = json.loads(TPLinkSmartHomeProtocol.decrypt(await lector.readexactly(longitud)))
+                demora = max(0.0, self.latencia + self._aleatorio.uniform(-self.jitter, self.jitter))
+                if demora:
+                    await asyncio.sleep(demora)
+                azar = self._aleatorio.random()
+                if azar < self.prob_timeout:
+                    # No responder nunca: el cliente agota su timeout y cierra
+                    await lector.read()
+                    return
+                if azar < self.prob_timeout + self.prob_corte:
+                    return
+                escritor.write(TPLinkSmartHomeProtocol.encrypt(json.dumps(enchufe.responder(peticion))))
+                await escritor.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._conexiones.discard(conexion)
+            escritor.close()
+
+def apuntar_db(db_path, simulador):
+    """
+    Reasigna las IP de la tabla devices (por id) a las direcciones del
+    simulador. Solo para bases de prueba: sobrescribe devices.ip_address.
+    """
+    import sqlite3
+    conn = sqlite3.connect(db_path, timeout=10)
+    try:
+        c = conn.cursor()
+        ids = [fila[0] for fila in c.execute("SELECT id FROM devices ORDER BY id")]
+        pares = list(zip(simulador.direcciones, ids))
+        # Evitar choques con el UNIQUE de ip_address mientras se reasignan
+        c.executemany("UPDATE devices SET ip_address = 'sim-' || id WHERE id = ?", [(i,) for _, i in pares])
+        c.executemany("UPDATE devices SET ip_address = ? WHERE id = ?", pares)
+        c.execute("DELETE FROM device_snapshots")
+        conn.commit()
+        return len(pares), len(ids)
+    finally:
+        conn.close()
+
+async def ejecutar(args):
+    simulador = SimuladorEnchufes(args.cantidad, modo=args.modo, por_hogar=args.por_hogar,
+                                  puerto_base=args.puerto_base, latencia=args.latencia, jitter=args.jitter,
+                                  prob_timeout=args.prob_timeout, prob_corte=args.prob_corte, caidos=args.caidos,
+                                  curva=args.curva, potencia_base=args.potencia, semilla=args.semilla)
+    await simulador.iniciar()
+    print(f"🔌 {len(simulador.enchufes)} enchufes simulados ({args.modo}), {args.caidos} caídos")
+    print(f"   Primero: {simulador.direcciones[0]}  Último: {simulador.direcciones[-1]}")
+    print(f"   Latencia {args.latencia}±{args.jitter} ms, timeouts {args.prob_timeout:.0%}, "
+          f"cortes {args.prob_corte:.0%}, curva {args.curva}")
+    if args.apuntar_db:
+        asignados, total = apuntar_db(args.db, simulador)
+        print(f"✅ {asignados} de {total} dispositivos de {args.db} apuntan al simulador")
+        if asignados < total:
+            print(f"⚠️ {total - asignados} dispositivos quedaron sin enchufe simulado (usa --cantidad {total})")
+    print("Ctrl+C para detener")
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(f"📊 {simulador.resumen()}")
+    finally:
+        await simulador.detener()
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulador local de enchufes Kasa/Tapo")
+    parser.add_argument('--cantidad', type=int, default=50, help="Número de enchufes simulados")
+    parser.add_argument('--modo', choices=('ips', 'puertos'), default='ips' if sys.platform.startswith('linux') else 'puertos',
+                        help="Direcciones 127.0.H.N:9999 o puertos sobre 127.0.0.1")
+    parser.add_argument('--por-hogar', type=int, default=5, help="Enchufes por red /24 en modo ips")
+    parser.add_argument('--puerto-base', type=int, default=10000, help="Primer puerto en modo puertos")
+    parser.add_argument('--latencia', type=float, default=30, help="Milisegundos de demora por respuesta")
+    parser.add_argument('--jitter', type=float, default=10, help="Variación de la demora (± ms)")
+    parser.add_argument('--prob-timeout', type=float, default=0.0, help="Probabilidad de no responder (0-1)")
+    parser.add_argument('--prob-corte', type=float, default=0.0, help="Probabilidad de cortar la conexión (0-1)")
+    parser.add_argument('--caidos', type=int, default=0, help="Enchufes que no escuchan (los últimos)")
+    parser.add_argument('--curva', choices=CURVAS + ('mixta',), default='mixta', help="Curva de potencia")
+    parser.add_argument('--potencia', type=float, default=100.0, help="Potencia base en vatios")
+    parser.add_argument('--semilla', type=int, default=None, help="Semilla para resultados reproducibles")
+    parser.add_argument('--apuntar-db', action='store_true',
+                        help="Reasigna devices.ip_address de la base DB_PATH a los enchufes simulados")
+    parser.add_argument('--db', default=os.environ.get('DB_PATH', 'ener_virgil.db'),
+                        help="Base de datos para --apuntar-db (por defecto DB_PATH)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        asyncio.run(ejecutar(args))
+    except KeyboardInterrupt:
+        print("\n🛑 Simulador detenido")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Verifica los planes de ejecución de las consultas frecuentes de EnerVirgil
+
+Ejecuta EXPLAIN QUERY PLAN sobre cada consulta de CONSULTAS_CRITICAS (app.py)
+y falla si alguna recorre una tabla completa, necesita un B-tree temporal
+para ordenar o ya no se puede preparar contra el esquema actual (salvo las columnas
+opcionales de COLUMNAS_OPCIONALES). Pensado para ejecutarse tras cambiar el esquema o las consultas.
+
+Uso:
+    python verificar_planes_consulta.py
+"""
+
+import sys
+import sqlite3
+
+# Cargar variables de entorno
+sys.path.insert(0, '.')
+import load_env
+
+from app import get_db_connection, CONSULTAS_CRITICAS
+
+# Consultas sobre columnas que pueden no existir en una base válida: consulta -> columna.
+# users.google_id no se puede agregar con ALTER TABLE (es UNIQUE) en bases creadas sin ella
+COLUMNAS_OPCIONALES = {
+    'usuario_por_google_id': 'google_id',
+}
+
+def problemas_del_plan(plan):
+    """Devuelve los pasos del plan que indican un recorrido completo o un ordenamiento temporal"""
+    problemas = []
+    for fila in plan:
+        detalle = fila[-1]
+        if detalle.startswith('SCAN ') or 'TEMP B-TREE' in detalle:
+            problemas.append(detalle)
+    return problemas
+
+def verificar_planes():
+    """Verifica el plan de cada consulta crítica"""
+    print("🔍 VERIFICANDO PLANES DE CONSULTA")
+    print("=" * 60)
+
+    conn = get_db_connection()
+    c = conn.cursor()
+    fallidas = 0
+    omitidas = 0
+    try:
+        for nombre, (sql, parametros) in CONSULTAS_CRITICAS.items():
+            try:
+                c.execute(f"EXPLAIN QUERY PLAN {sql}", parametros)
+            except sqlite3.OperationalError as e:
+                columna = COLUMNAS_OPCIONALES.get(nombre)
+                if columna and str(e) == f"no such column: {columna}":
+                    print(f"⚠️ {nombre}: omitida, la base no tiene la columna opcional {columna}")
+                    omitidas += 1
+                    continue
+                # Una consulta que ya no se puede preparar (columna renombrada, tabla eliminada)
+                # también es una regresión
+                fallidas += 1
+                print(f"❌ {nombre}: no se pudo analizar ({e})")
+                continue
+            plan = c.fetchall()
+            problemas = problemas_del_plan(plan)
+            if problemas:
+                fallidas += 1
+                print(f"❌ {nombre}")
+                for detalle in problemas:
+                    print(f"   {detalle}")
+            else:
+                print(f"✅ {nombre}: {' | '.join(fila[-1] for fila in plan)}")
+    finally:
+        conn.close()
+
+    print("=" * 60)
+    if fallidas:
+        print(f"❌ {fallidas} de {len(CONSULTAS_CRITICAS)} consultas no se pueden preparar o usan recorridos "
+              f"completos u ordenamientos temporales")
+    else:
+        print(f"✅ Las {len(CONSULTAS_CRITICAS) - omitidas} consultas críticas analizadas usan índices"
+              + (f" ({omitidas} omitidas)" if omitidas else ""))
+    return fallidas == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if verificar_planes() else 1)
@@ -0,0 +1,78 @@
+"""
+Coalescencia de peticiones (single-flight) para EnerVirgil
+
+Cuando vence una entrada de cache muy pedida, todas las peticiones
+simultáneas fallan a la vez y cada una recalcula el mismo valor. Con
+VueloUnico solo la primera lo calcula; las demás esperan su resultado.
+Es el equivalente para hilos de bucle_async.ejecutar_compartido.
+"""
+
+import threading
+
+class _Vuelo:
+    __slots__ = ('evento', 'resultado', 'error')
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.error = None
+
+class VueloUnico:
+    """Agrupa por clave las llamadas concurrentes a una misma función"""
+
+    def __init__(self):
+        self._vuelos = {}
+        self._futuros = {}
+        self._lock = threading.Lock()
+
+    def ejecutar(self, clave, funcion, timeout=None):
+        """
+        Ejecuta funcion() una sola vez entre los hilos que piden la misma clave
+        a la vez y devuelve su resultado (o relanza su excepción) a todos.
+        Los que esperan lanzan TimeoutError si pasan timeout segundos.
+        """
+        with self._lock:
+            vuelo = self._vuelos.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = self._vuelos[clave] = _Vuelo()
+
+        if not lider:
+            if not vuelo.evento.wait(timeout):
+                raise TimeoutError(f"Tiempo de espera agotado esperando {clave}")
+            if vuelo.error is not None:
+                raise vuelo.error
+            return vuelo.resultado
+
+        try:
+            vuelo.resultado = funcion()
+            return vuelo.resultado
+        except Exception as e:
+            vuelo.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._vuelos[clave]
+            vuelo.evento.set()
+
+    def enviar(self, clave, executor, funcion):
+        """
+        Envía funcion al executor salvo que ya haya una en curso con la misma
+        clave; en ambos casos devuelve el Future compartido.
+        """
+        with self._lock:
+            futuro = self._futuros.get(clave)
+            if futuro is not None:
+                return futuro
+            futuro = self._futuros[clave] = executor.submit(funcion)
+        futuro.add_done_callback(lambda f: self._terminar(clave, f))
+        return futuro
+
+    def en_curso(self):
+        with self._lock:
+            return len(self._vuelos) + len(self._futuros)
+
+    def _terminar(self, clave, futuro):
+        with self._lock:
+            if self._futuros.get(clave) is futuro:
+                del self._futuros[clave]